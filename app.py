@@ -2,9 +2,32 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import io
+import os
+import sys
+import json
+import time
+import functools
+import cProfile
+import pstats
+import marshal
+import re
+import unicodedata
+import hashlib
+import threading
+import sqlite3
+import tempfile
+import zipfile
+import shutil
+import importlib.util
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape as xml_escape
 from datetime import datetime
 import base64
 from io import BytesIO
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # Importar bibliotecas opcionales con manejo de errores
 try:
@@ -29,6 +52,48 @@ try:
 except ImportError:
     MPL_AVAILABLE = False
 
+try:
+    import xlsxwriter
+    XLSXWRITER_AVAILABLE = True
+except ImportError:
+    XLSXWRITER_AVAILABLE = False
+
+# openpyxl no se usa directamente: pandas lo necesita para leer los .xlsx
+OPENPYXL_AVAILABLE = importlib.util.find_spec('openpyxl') is not None
+
+try:
+    import yaml
+    YAML_AVAILABLE = True
+except ImportError:
+    YAML_AVAILABLE = False
+
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+try:
+    from pyinstrument import Profiler as PyinstrumentProfiler
+    PYINSTRUMENT_AVAILABLE = True
+except ImportError:
+    PYINSTRUMENT_AVAILABLE = False
+
+try:
+    from watchdog.observers import Observer as WatchdogObserver
+    from watchdog.events import FileSystemEventHandler
+    WATCHDOG_AVAILABLE = True
+except ImportError:
+    WATCHDOG_AVAILABLE = False
+
+try:
+    import duckdb
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    DUCKDB_AVAILABLE = True
+except ImportError:
+    DUCKDB_AVAILABLE = False
+
 # Configuración de la página
 st.set_page_config(
     page_title="Control de Normas Gráficas",
@@ -130,17 +195,485 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# INSTRUMENTACIÓN DE RENDIMIENTO
+# Cada etapa registra tiempo, filas x columnas de normas, delta de memoria y acierto de caché
+
+# Registros de la ejecución actual (se guardan en la sesión). Fuera de una sesión (hilo de la API,
+# scripts) no hay dónde mostrarlos y no se registran
+def _perf_state():
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    return st.session_state.setdefault('perf_state', {'records': [], 'cache_misses': {}})
+
+# Función para reiniciar los registros al comienzo de cada ejecución del script
+def reset_perf_records():
+    state = _perf_state()
+    if state is None:
+        return
+    state['records'] = []
+    state['cache_misses'] = {}
+    state['run_started'] = time.perf_counter()
+
+# Función para registrar el primer pintado significativo (tarjetas principales visibles)
+def mark_first_paint():
+    state = _perf_state()
+    started = state.get('run_started') if state is not None else None
+    if started is not None:
+        seconds = round(time.perf_counter() - started, 6)
+        state['records'].append({
+            'stage': 'primer_pintado', 'rows': None, 'norm_cols': None, 'cache': None,
+            'seconds': seconds, 'mem_delta_mb': None
+        })
+        # Historial de la sesión (no se reinicia), para comparar ejecuciones
+        state.setdefault('paint_history', []).append(seconds)
+
+# Función para obtener la memoria residente del proceso (bytes), si es posible
+def _current_rss():
+    if PSUTIL_AVAILABLE:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+# Función para marcar que una función cacheada realmente se ejecutó (fallo de caché)
+def mark_cache_miss(stage):
+    state = _perf_state()
+    if state is None:
+        return
+    misses = state['cache_misses']
+    misses[stage] = misses.get(stage, 0) + 1
+
+# Context manager para medir una etapa del pipeline
+@contextmanager
+def perf_stage(stage, rows=None, cols=None):
+    state = _perf_state()
+    record = {'stage': stage, 'rows': rows, 'norm_cols': cols, 'cache': None}
+    if state is None:
+        # Sin sesión no se mide: el registro se entrega igual para no cambiar a quien lo usa
+        yield record
+        return
+    misses_before = state['cache_misses'].get(stage, 0)
+    rss_before = _current_rss()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = round(time.perf_counter() - start, 6)
+        rss_after = _current_rss()
+        record['mem_delta_mb'] = round((rss_after - rss_before) / 2**20, 3) if rss_before is not None and rss_after is not None else None
+        if record['cache'] is None and stage in CACHED_STAGES:
+            record['cache'] = 'miss' if state['cache_misses'].get(stage, 0) > misses_before else 'hit'
+        state['records'].append(record)
+
+# Etapas envueltas en st.cache_data (para informar acierto/fallo de caché)
+CACHED_STAGES = {'load_data'}
+
+# Función para deducir filas y columnas de normas de los argumentos de una etapa
+def _describe_args(args, kwargs):
+    rows, cols = None, None
+    for value in list(args) + list(kwargs.values()):
+        if rows is None and isinstance(value, pd.DataFrame):
+            rows = len(value)
+        elif rows is None and isinstance(value, dict) and 'total_buses' in value:
+            rows, cols = value['total_buses'], value.get('total_norms')
+        elif cols is None and isinstance(value, list) and value and isinstance(value[0], str):
+            cols = len(value)
+    return rows, cols
+
+# Decorador para medir una etapa del pipeline
+def instrumented(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            rows, cols = _describe_args(args, kwargs)
+            with perf_stage(stage, rows, cols) as record:
+                result = func(*args, **kwargs)
+                if record['rows'] is None and isinstance(result, pd.DataFrame):
+                    record['rows'] = len(result)
+                return result
+        return wrapper
+    return decorator
+
+# Función para resumir los registros por etapa
+def summarize_perf_records(records):
+    if not records:
+        return pd.DataFrame(columns=['Etapa', 'Llamadas', 'Tiempo Total (s)', 'Tiempo Máx. (s)',
+                                     'Filas', 'Columnas Norma', 'Δ Memoria (MB)', 'Caché'])
+    df = pd.DataFrame(records)
+    summary = df.groupby('stage', sort=False).agg(
+        calls=('seconds', 'size'),
+        total=('seconds', 'sum'),
+        max=('seconds', 'max'),
+        rows=('rows', 'max'),
+        cols=('norm_cols', 'max'),
+        mem=('mem_delta_mb', 'sum'),
+        cache=('cache', lambda s: ", ".join(sorted(set(s.dropna()))) or '-')
+    ).reset_index()
+    summary.columns = ['Etapa', 'Llamadas', 'Tiempo Total (s)', 'Tiempo Máx. (s)',
+                       'Filas', 'Columnas Norma', 'Δ Memoria (MB)', 'Caché']
+    return summary.sort_values('Tiempo Total (s)', ascending=False)
+
+# Función para exportar los registros de rendimiento como JSON
+def perf_records_json(records):
+    # El total es la duración de la ejecución completa: las etapas se anidan y se solapan con el
+    # segundo plano, y 'primer_pintado' mide tiempo transcurrido, así que no se pueden sumar
+    rerun = next((r for r in records if r['stage'] == 'rerun'), None)
+    payload = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'streamlit': st.__version__,
+        'total_seconds': round(rerun['seconds'], 6) if rerun else None,
+        'records': records
+    }
+    return json.dumps(payload, indent=2, ensure_ascii=False, default=str)
+
+# EJECUCIÓN EN SEGUNDO PLANO
+# Los artefactos pesados (gráficos, plan de trabajo, reporte completo y su exportación) se
+# calculan en un pool de hilos compartido mientras las tarjetas principales ya están pintadas.
+# Cada sesión guarda sus trabajos por nombre y clave de datos; un fragmento consulta el
+# avance y vuelve a ejecutar la página cuando termina alguno, para pintarlo.
+BACKGROUND_WORKERS = 2
+BACKGROUND_POLL_SECONDS = 0.5
+
+# Pool de hilos compartido entre sesiones (acota los hilos del servidor)
+@st.cache_resource
+def get_background_executor():
+    return ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix='normas-fondo')
+
+# Función para obtener los trabajos en segundo plano de la sesión
+def _background_jobs():
+    return st.session_state.setdefault('background_jobs', {})
+
+# Función para indicar si el cálculo en segundo plano está activo (interruptor de la barra lateral)
+def background_enabled():
+    return st.session_state.get('background_mode', True)
+
+# Función para iniciar una ejecución: los trabajos usados en ella se marcan con su número
+def begin_background_run():
+    st.session_state['background_run'] = st.session_state.get('background_run', 0) + 1
+
+# Función para calcular la clave de datos de los trabajos (archivo, filtros y vocabulario)
+def background_data_key(*parts):
+    text = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+# Función que ejecuta un trabajo en un hilo con el contexto de la sesión (session_state y caché)
+def _run_with_context(ctx, fn, args):
+    if ctx is not None:
+        add_script_run_ctx(threading.current_thread(), ctx)
+    return fn(*args)
+
+# Función para enviar un trabajo; si ya existe uno con la misma clave se reutiliza
+def submit_background(name, label, key, fn, *args):
+    jobs = _background_jobs()
+    job = jobs.get(name)
+    if job is None or job['key'] != key:
+        if job is not None:
+            job['future'].cancel()
+        if background_enabled():
+            future = get_background_executor().submit(_run_with_context, get_script_run_ctx(), fn, args)
+        else:
+            # Modo sincrónico: se calcula aquí mismo, con la misma interfaz de Future
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+        job = {'key': key, 'label': label, 'future': future, 'submitted': time.perf_counter(),
+               'finished': None, 'painted': False}
+        future.add_done_callback(lambda f, job=job: job.__setitem__('finished', time.perf_counter()))
+        jobs[name] = job
+    job['run'] = st.session_state.get('background_run')
+    return job
+
+# Función para mostrar un trabajo: si terminó se dibuja con render, si no se deja un aviso
+def show_background(job, render):
+    future = job['future']
+    if not future.done():
+        st.info(f"⏳ Calculando {job['label']} en segundo plano...")
+        return
+    job['painted'] = True
+    try:
+        result = future.result()
+    except Exception as e:
+        st.error(f"Error al calcular {job['label']}: {str(e)}")
+        return
+    render(result)
+
+# Función para obtener los trabajos usados en la ejecución actual
+def current_background_jobs():
+    run = st.session_state.get('background_run')
+    return [job for job in _background_jobs().values() if job.get('run') == run]
+
+# Función para saber si un trabajo aún debe pintarse (cada trabajo pide una sola re-ejecución)
+def background_needs_paint(job):
+    return not job['painted'] and not job.get('rerun_requested')
+
+# Fragmento que consulta el avance; al terminar un trabajo se vuelve a ejecutar la página
+@st.fragment(run_every=BACKGROUND_POLL_SECONDS)
+def show_background_progress():
+    jobs = current_background_jobs()
+    finished = [job for job in jobs if job['future'].done() and background_needs_paint(job)]
+    if finished:
+        for job in finished:
+            job['rerun_requested'] = True
+        st.rerun()
+    pending = [job['label'] for job in jobs if not job['future'].done()]
+    if pending:
+        st.progress((len(jobs) - len(pending)) / len(jobs),
+                    text=f"Calculando en segundo plano: {', '.join(pending)}")
+
+# Función para resumir los trabajos en segundo plano de la ejecución actual
+def summarize_background_jobs():
+    rows = []
+    for job in current_background_jobs():
+        finished = job['finished']
+        rows.append({
+            'Artefacto': job['label'],
+            'Estado': 'Listo' if job['future'].done() else 'En curso',
+            'Tiempo (s)': round(finished - job['submitted'], 3) if finished is not None else None
+        })
+    return pd.DataFrame(rows, columns=['Artefacto', 'Estado', 'Tiempo (s)'])
+
+# MAPEO DE COLUMNAS
+# Las planillas llegan con encabezados distintos ("Nº Interno", "Patente", "Base", ...). Cada
+# columna se puntúa una vez contra los roles conocidos: nombre normalizado (sin tildes, mayúsculas
+# ni signos) y, para N° Interno y PPU, la forma de sus valores. El mapeo se guarda como perfil
+# bajo la firma de los encabezados, así una planilla con el mismo formato se resuelve al instante
+# y todas las funciones (métricas, filtros, gráficos, fichas por bus) usan las mismas columnas.
+COLUMN_PROFILES_PATH = os.environ.get('NORMAS_PERFILES_COLUMNAS', '')
+COLUMN_SAMPLE_SIZE = 200
+COLUMN_MIN_SCORE = 0.5
+# Fracción mínima de la muestra que debe cumplir el patrón (y ser distinta) para aceptar un prefijo de palabra
+COLUMN_PREFIX_MIN_RATIO = 0.8
+# Versión del puntaje: los perfiles automáticos de otra versión se vuelven a calcular
+COLUMN_RESOLVER_VERSION = 2
+
+# Patente chilena: formato antiguo AB1234 y nuevo BCDF12 (sin guiones, puntos ni espacios)
+PPU_PATTERN = re.compile(r'^(?:[A-Z]{2}\d{4}|[A-Z]{4}\d{2})$')
+INTERNO_PATTERN = re.compile(r'^\d{1,6}$')
+
+# Roles de columna (columnas de información, no normas): alias exactos, palabras completas,
+# prefijos de palabra y patrón de valores con su peso en el puntaje. Un prefijo solo cuenta si
+# los valores cumplen el patrón del rol: así una norma como "Numeración lateral" no se toma
+# como N° Interno ni desaparece de las métricas.
+COLUMN_ROLES = {
+    'N° Interno': {'alias': ['Numero Interno', 'Nro Interno', 'Interno', 'N° Bus', 'Numero Bus'],
+                   'prefijos': ['intern', 'numer'], 'patron': INTERNO_PATTERN, 'peso_valores': 0.3},
+    'PPU': {'alias': ['Patente', 'Placa', 'Placa Patente'], 'prefijos': ['ppu', 'paten', 'placa'],
+            'patron': PPU_PATTERN, 'peso_valores': 0.6},
+    'Unidad': {'alias': ['Unid']},
+    'Marca chasis': {'alias': ['Marca', 'Marca Bus']},
+    'Modelo chasis': {'alias': ['Modelo', 'Tipo']},
+    'Subclase': {'alias': ['Clase', 'Tipo Bus'], 'palabras': ['subclase', 'clase']},
+    'N° plazas': {'alias': ['Plazas', 'Capacidad', 'Numero de plazas']},
+    'Terminal': {'alias': ['Base', 'Ubicacion'], 'palabras': ['terminal']},
+    'Taller': {'alias': ['Servicio']},
+    'TERMINADOS': {'alias': ['Terminado']},
+    'NORMA INSTALADA': {'alias': ['Normas Instaladas', 'Total Instaladas']},
+    'FECHA DE RENOVACION': {'alias': ['Fecha renovacion', 'Fecha']},
+    'CALL CENTER': {'alias': []}
+}
+
+# Función para normalizar un encabezado (sin tildes ni signos, minúsculas, espacios simples)
+def normalize_column_name(name):
+    text = re.sub('[º°]', ' ', str(name))
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii').lower()
+    return " ".join(re.sub(r'[^a-z0-9]+', ' ', text).split())
+
+# Alias normalizados de cada rol (incluido el nombre canónico)
+COLUMN_ROLE_ALIASES = {
+    role: {normalize_column_name(alias) for alias in [role] + rules['alias']}
+    for role, rules in COLUMN_ROLES.items()
+}
+
+# Función para puntuar un encabezado contra un rol solo por el nombre
+def column_name_score(name, role):
+    if str(name) == role:
+        return 2.0
+    key = normalize_column_name(name)
+    if key in COLUMN_ROLE_ALIASES[role]:
+        return 1.0
+    if set(key.split()) & set(COLUMN_ROLES[role].get('palabras', [])):
+        return 0.6
+    return 0.0
+
+# Función para saber si alguna palabra del encabezado empieza con un prefijo del rol
+def column_prefix_match(name, role):
+    prefixes = COLUMN_ROLES[role].get('prefijos', [])
+    return any(word.startswith(prefix) for word in normalize_column_name(name).split() for prefix in prefixes)
+
+# Función para calcular la fracción de una muestra de valores que cumple el patrón de un rol
+def column_pattern_ratio(values, pattern):
+    sample = values.dropna().head(COLUMN_SAMPLE_SIZE)
+    if sample.empty:
+        return 0.0
+    # Enteros leídos como decimales ('1001.0') y patentes con guiones, puntos o espacios
+    text = sample.astype(str).str.strip().str.replace(r'\.0$', '', regex=True)
+    text = text.str.upper().str.replace(r'[\s.\-]', '', regex=True)
+    return float(text.str.match(pattern).mean())
+
+# Función para calcular la fracción de valores distintos en una muestra de la columna
+def column_distinct_ratio(values):
+    sample = values.dropna().head(COLUMN_SAMPLE_SIZE)
+    if sample.empty:
+        return 0.0
+    return sample.astype(str).str.strip().nunique() / len(sample)
+
+# Función para puntuar todas las columnas y asignar cada rol a lo más a una columna (voraz por puntaje)
+def score_columns(df):
+    columns = list(df.columns)
+    candidates = []
+    for role, rules in COLUMN_ROLES.items():
+        pattern = rules.get('patron')
+        weight = rules.get('peso_valores', 0)
+        by_name = False
+        for j, col in enumerate(columns):
+            score = column_name_score(col, role)
+            if score == 0:
+                # Un prefijo sin el patrón de valores no basta (p. ej. una norma "Numeración lateral")
+                if pattern is None or not column_prefix_match(col, role):
+                    continue
+                # Los identificadores son casi todos distintos; una norma en códigos '1'/'0' no
+                ratio = column_pattern_ratio(df.iloc[:, j], pattern)
+                if ratio < COLUMN_PREFIX_MIN_RATIO or column_distinct_ratio(df.iloc[:, j]) < COLUMN_PREFIX_MIN_RATIO:
+                    continue
+                candidates.append((0.6 + weight * ratio, role, j))
+                by_name = True
+                continue
+            by_name = True
+            if pattern is not None and score < 2:
+                score += weight * column_pattern_ratio(df.iloc[:, j], pattern)
+            candidates.append((score, role, j))
+        # Sin coincidencia por nombre, un patrón con peso suficiente identifica la columna solo por sus valores
+        if not by_name and pattern is not None and weight >= COLUMN_MIN_SCORE:
+            for j in range(len(columns)):
+                candidates.append((weight * column_pattern_ratio(df.iloc[:, j], pattern), role, j))
+
+    # Orden estable: a igual puntaje gana el rol y la columna que aparecen primero
+    candidates.sort(key=lambda candidate: -candidate[0])
+    mapping = {}
+    used = set()
+    for score, role, j in candidates:
+        if score < COLUMN_MIN_SCORE or role in mapping or j in used:
+            continue
+        mapping[role] = str(columns[j])
+        used.add(j)
+    return {role: mapping[role] for role in COLUMN_ROLES if role in mapping}
+
+# Función para calcular la firma de los encabezados (clave del perfil de mapeo)
+def header_signature(columns):
+    return hashlib.md5(json.dumps([str(col) for col in columns], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+# Función para obtener la ruta del archivo de perfiles
+def column_profiles_path():
+    return COLUMN_PROFILES_PATH or os.path.join(REPORT_CACHE_DIR, 'perfiles_columnas.json')
+
+# Perfiles de mapeo compartidos entre sesiones (se leen del disco una vez)
+@st.cache_resource
+def get_column_profiles():
+    path = column_profiles_path()
+    profiles = {}
+    if os.path.exists(path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                profiles = json.load(f)
+        except (OSError, ValueError):
+            profiles = {}
+    return {'path': path, 'lock': threading.Lock(), 'profiles': profiles}
+
+# Función para guardar un perfil (en memoria y en disco, con reemplazo atómico del archivo)
+def save_column_profile(signature, profile):
+    store = get_column_profiles()
+    with store['lock']:
+        store['profiles'][signature] = profile
+        try:
+            os.makedirs(os.path.dirname(store['path']) or '.', exist_ok=True)
+            tmp_path = f"{store['path']}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(store['profiles'], f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, store['path'])
+        except OSError:
+            # Sin disco escribible el perfil sigue vigente en memoria
+            pass
+
+# Función para obtener el perfil de mapeo de un DataFrame (lo calcula y guarda si no existe)
+def get_column_profile(df):
+    signature = header_signature(df.columns)
+    profile = get_column_profiles()['profiles'].get(signature)
+    if profile is None or (profile.get('origen') != 'manual' and profile.get('version') != COLUMN_RESOLVER_VERSION):
+        profile = {
+            'version': COLUMN_RESOLVER_VERSION,
+            'origen': 'auto',
+            'creado': datetime.now().isoformat(timespec='seconds'),
+            'columnas': score_columns(df)
+        }
+        save_column_profile(signature, profile)
+    return signature, profile
+
+# Función para resolver las columnas de información: rol -> nombre de columna del DataFrame
+def resolve_columns(df):
+    _, profile = get_column_profile(df)
+    by_name = {str(col): col for col in df.columns}
+    return {role: by_name[name] for role, name in profile['columnas'].items() if name in by_name}
+
+# Función para obtener las columnas que el mapeo automático tomó sin coincidencia exacta de nombre
+# (sin el mapeo se contarían como normas)
+def weak_column_mappings(df):
+    _, profile = get_column_profile(df)
+    if profile.get('origen') == 'manual':
+        return {}
+    return {role: name for role, name in profile['columnas'].items() if column_name_score(name, role) < 1}
+
+# Función para asignar manualmente la columna de un rol (None la deja sin columna)
+def set_column_mapping(df, role, name):
+    signature, profile = get_column_profile(df)
+    columnas = {r: col for r, col in profile['columnas'].items() if r != role and col != name}
+    if name is not None:
+        columnas[role] = name
+    save_column_profile(signature, dict(profile, origen='manual', columnas=columnas,
+                                        creado=datetime.now().isoformat(timespec='seconds')))
+
+# Función para descartar el perfil de un formato (se vuelve a detectar en la próxima lectura)
+def reset_column_mapping(df):
+    store = get_column_profiles()
+    signature = header_signature(df.columns)
+    if signature in store['profiles']:
+        profile = store['profiles'][signature]
+        save_column_profile(signature, dict(profile, version=None, origen='auto'))
+
+# Función para obtener las columnas de agrupación (por tipo de bus se usa el modelo si no hay Subclase)
+def bus_group_columns(mapping):
+    return {
+        'Terminal': mapping.get('Terminal'),
+        'Subclase': mapping.get('Subclase') or mapping.get('Modelo chasis')
+    }
+
+# Función para obtener los valores de una columna de información con 'N/A' en los nulos
+def info_column_values(df, col):
+    if col is None or col not in df.columns:
+        return ['N/A'] * len(df)
+    values = df[col]
+    return values.astype(object).where(values.notna(), 'N/A').tolist()
+
 # Función para cargar los datos
+@instrumented('load_data')
 @st.cache_data
 def load_data(file):
+    mark_cache_miss('load_data')
     try:
         # Intentar cargar con diferentes configuraciones de encabezado
         # El usuario mencionó que los encabezados están en A1 y los datos comienzan en A2
         df = pd.read_excel(file, header=0)  # Intenta con encabezado en fila 0 (A1)
         
-        # Verificar que existan las columnas mínimas necesarias
+        # Verificar que existan las columnas mínimas necesarias (por nombre, con sus alias)
         # Si no existen, intentamos con otras configuraciones
-        if 'N° Interno' not in df.columns and 'PPU' not in df.columns:
+        if not any(column_name_score(col, role) or column_prefix_match(col, role)
+                   for col in df.columns for role in ('N° Interno', 'PPU')):
             st.warning("No se encontraron columnas esperadas. Intentando con otras configuraciones...")
             # Intentar con diferentes configuraciones
             df = pd.read_excel(file, header=1)  # Intenta con encabezado en fila 1 (A2)
@@ -150,50 +683,38 @@ def load_data(file):
         st.error(f"Error al cargar el archivo: {e}")
         return None
 
-# Función para procesar los datos
-def process_data(df):
-    # Verificar y ajustar las columnas del DataFrame
-    required_cols = ['N° Interno', 'PPU']
-    
+# Función para obtener las columnas de normas: todas las que no son de información
+# IMPORTANTE: Excluir explícitamente FECHA DE RENOVACION y NORMA INSTALADA
+def norm_columns(df):
+    info_cols = set(COLUMN_ROLES) | set(resolve_columns(df).values())
+    return [col for col in df.columns if col not in info_cols and
+            'FECHA' not in str(col).upper() and 'NORMA INSTALADA' not in str(col).upper()]
+
+# Función para preparar los datos sin mostrar nada (la usan el dashboard y la API local):
+# devuelve el DataFrame, las columnas de información, las de normas y los cambios hechos
+def prepare_data(df):
+    # Renombrar las columnas de información reconocidas a su nombre canónico (perfil de mapeo)
+    renames = {col: role for role, col in resolve_columns(df).items() if col != role}
+    if renames:
+        df = df.rename(columns=renames)
+
     # Verificar si las columnas requeridas están presentes
+    required_cols = ['N° Interno', 'PPU']
+    created = []
     for col in required_cols:
         if col not in df.columns:
-            # Intentar encontrar columnas con nombres similares
-            if col == 'N° Interno':
-                similar_cols = [c for c in df.columns if 'intern' in c.lower() or 'numer' in c.lower()]
-            elif col == 'PPU':
-                similar_cols = [c for c in df.columns if 'ppu' in c.lower() or 'paten' in c.lower() or 'placa' in c.lower()]
-            else:
-                similar_cols = [c for c in df.columns if col.lower() in c.lower()]
-                
-            if similar_cols:
-                # Renombrar la primera columna similar encontrada
-                df = df.rename(columns={similar_cols[0]: col})
-                st.info(f"Columna '{similar_cols[0]}' renombrada a '{col}'")
-            else:
-                # Si no se encuentra, crear una columna con valores predeterminados
-                df[col] = [f"{col}_{i}" for i in range(len(df))]
-                st.warning(f"Columna '{col}' no encontrada. Se ha creado con valores predeterminados.")
+            # Si no se encuentra, crear una columna con valores predeterminados
+            df[col] = [f"{col}_{i}" for i in range(len(df))]
+            created.append(col)
     
     # Lista de columnas de información básica que NO son normas
-    info_cols = [
-        'N° Interno', 'PPU', 'Unidad', 'Marca chasis', 'Modelo chasis', 'Subclase', 
-        'N° plazas', 'Terminal', 'Taller', 'TERMINADOS', 'NORMA INSTALADA', 'FECHA DE RENOVACION',
-        'CALL CENTER'  # Esta también parece ser una columna de información, no una norma
-    ]
+    info_cols = list(COLUMN_ROLES)
     
     # Filtrar solo las columnas de información que existen en el DataFrame
     cols_info = [col for col in info_cols if col in df.columns]
     
     # Todas las columnas después de la información básica son normas
-    # IMPORTANTE: Excluir explícitamente FECHA DE RENOVACION y NORMA INSTALADA
-    norm_cols = [col for col in df.columns if col not in cols_info and 
-                'FECHA' not in col.upper() and 'NORMA INSTALADA' not in col.upper()]
-    
-    # Asegurarse de que hay columnas de normas
-    if not norm_cols:
-        st.error("No se encontraron columnas de normas. Verificar formato del archivo.")
-        return df, cols_info, []
+    norm_cols = norm_columns(df)
     
     # Para cada norma, determinamos si está instalada, no aplica o falta
     for col in norm_cols:
@@ -201,6 +722,26 @@ def process_data(df):
         df[col] = df[col].astype(str)
         # Reemplazar 'nan' por vacío (norma faltante)
         df[col] = df[col].replace('nan', '').replace('None', '')
+
+    return df, cols_info, norm_cols, {'renombradas': renames, 'creadas': created}
+
+# Función para procesar los datos
+@instrumented('process_data')
+def process_data(df):
+    weak = weak_column_mappings(df)
+    df, cols_info, norm_cols, changes = prepare_data(df)
+    for role, col in weak.items():
+        st.warning(f"La columna '{col}' se tomó como '{role}' por su parecido y no se cuenta como norma. "
+                   "Si es una norma, corrija el mapeo de columnas en la barra lateral.")
+    for col, role in changes['renombradas'].items():
+        st.info(f"Columna '{col}' renombrada a '{role}'")
+    for col in changes['creadas']:
+        st.warning(f"Columna '{col}' no encontrada. Se ha creado con valores predeterminados.")
+    
+    # Asegurarse de que hay columnas de normas
+    if not norm_cols:
+        st.error("No se encontraron columnas de normas. Verificar formato del archivo.")
+        return df, cols_info, []
         
     # Mostrar un resumen de las normas y los valores únicos encontrados
     st.markdown("### Valores encontrados en columnas de normas")
@@ -210,276 +751,2522 @@ def process_data(df):
         unique_values.update([v for v in values if v and v.strip()])
     
     st.write(f"Valores únicos encontrados: {', '.join([repr(v) for v in unique_values if v and v.strip()])}")
-    st.info("Interpretación: '1' o 'instalada' = Instalado, 'no aplica' = No Aplica, '' (vacío) = Pendiente")
+    st.info(f"Interpretación: {describe_status_vocabulary(get_status_vocabulary())}")
         
     return df, cols_info, norm_cols
 
-# Función para calcular métricas
-def calculate_metrics(df, norm_cols):
+# CARPETA VIGILADA
+# La oficina de planificación deja la planilla actualizada en una carpeta compartida. Un hilo
+# revisa la carpeta (por sondeo, o al instante con watchdog/inotify si está instalado), detecta
+# la planilla más reciente por fecha de modificación y hash, la lee con load_data y reemplaza
+# el conjunto de datos compartido de una sola vez. Las sesiones consultan la versión y se
+# vuelven a ejecutar cuando cambia. Un archivo sin cambios nunca se vuelve a leer.
+WATCH_FOLDER = os.environ.get('NORMAS_CARPETA', '')
+WATCH_INTERVAL_SECONDS = 5
+WATCH_SETTLE_SECONDS = 2
+WATCH_EXTENSIONS = ('.xlsx', '.xls')
+
+# Función para listar las planillas de la carpeta con su fecha de modificación y tamaño
+def list_watched_workbooks(path):
+    files = {}
+    for entry in os.scandir(path):
+        # Se ignoran los archivos de bloqueo de Excel ('~$planilla.xlsx')
+        if entry.is_file() and entry.name.lower().endswith(WATCH_EXTENSIONS) and not entry.name.startswith('~$'):
+            stat = entry.stat()
+            files[entry.path] = {'mtime': stat.st_mtime, 'size': stat.st_size}
+    return files
+
+# Función para revisar la carpeta una vez; devuelve True si se reemplazó el conjunto de datos
+def scan_watched_folder(watcher):
+    watcher['last_scan'] = datetime.now()
+    files = list_watched_workbooks(watcher['path'])
+    if not files:
+        return False
+
+    newest = max(files, key=lambda p: files[p]['mtime'])
+    info = files[newest]
+    # Un archivo modificado hace muy poco puede estar copiándose todavía
+    if time.time() - info['mtime'] < WATCH_SETTLE_SECONDS:
+        return False
+    known = watcher['fingerprints'].get(newest)
+    if known is not None and known['mtime'] == info['mtime'] and known['size'] == info['size']:
+        return False
+
+    with open(newest, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()
+    watcher['fingerprints'][newest] = dict(info, hash=digest)
+
+    # Archivo tocado pero con el mismo contenido, o que ya falló: no se vuelve a leer
+    current = watcher['dataset']
+    if (current is not None and current['hash'] == digest) or digest == watcher['failed_hash']:
+        return False
+
+    start = time.perf_counter()
+    df = load_data(BytesIO(content))
+    if df is None:
+        watcher['failed_hash'] = digest
+        watcher['error'] = f"No se pudo leer '{os.path.basename(newest)}'"
+        return False
+
+    # Reemplazo atómico: las sesiones leen siempre un conjunto de datos completo
+    watcher['dataset'] = {
+        'version': (current['version'] if current is not None else 0) + 1,
+        'path': newest,
+        'name': os.path.basename(newest),
+        'hash': digest,
+        'mtime': info['mtime'],
+        'df': df,
+        'loaded_at': datetime.now(),
+        'seconds': round(time.perf_counter() - start, 3)
+    }
+    watcher['error'] = None
+    return True
+
+# Función que revisa la carpeta en un ciclo hasta que se detiene el vigilante
+def _watch_folder_loop(watcher):
+    while not watcher['stop'].is_set():
+        try:
+            scan_watched_folder(watcher)
+        except Exception as e:
+            watcher['error'] = str(e)
+        # Espera el intervalo de sondeo o un aviso de watchdog, lo que ocurra primero
+        watcher['wake'].wait(WATCH_INTERVAL_SECONDS)
+        watcher['wake'].clear()
+
+# Vigilante compartido por todas las sesiones (uno por carpeta)
+@st.cache_resource
+def get_folder_watcher(path):
+    watcher = {
+        'path': path,
+        'fingerprints': {},
+        'dataset': None,
+        'failed_hash': None,
+        'error': None,
+        'last_scan': None,
+        'mode': 'sondeo',
+        'stop': threading.Event(),
+        'wake': threading.Event()
+    }
+    # La primera lectura es sincrónica para que la primera sesión ya tenga datos
+    try:
+        scan_watched_folder(watcher)
+    except Exception as e:
+        watcher['error'] = str(e)
+
+    if WATCHDOG_AVAILABLE:
+        handler = FileSystemEventHandler()
+        handler.on_any_event = lambda event: watcher['wake'].set()
+        observer = WatchdogObserver()
+        observer.schedule(handler, path, recursive=False)
+        observer.daemon = True
+        observer.start()
+        watcher['mode'] = 'inotify (watchdog)'
+
+    threading.Thread(target=_watch_folder_loop, args=(watcher,), daemon=True, name='normas-carpeta').start()
+    return watcher
+
+# Fragmento que avisa a la sesión cuando la carpeta trae una nueva versión de la planilla
+@st.fragment(run_every=WATCH_INTERVAL_SECONDS)
+def show_watched_folder_status(watcher):
+    dataset = watcher['dataset']
+    version = dataset['version'] if dataset is not None else 0
+    if st.session_state.get('watched_version', 0) != version:
+        st.session_state['watched_version'] = version
+        st.rerun()
+
+    if dataset is not None:
+        st.caption(f"📂 {dataset['name']} (versión {version}, leída el "
+                   f"{dataset['loaded_at'].strftime('%d/%m/%Y %H:%M:%S')} en {dataset['seconds']:.1f} s)")
+    else:
+        st.caption("📂 Esperando una planilla en la carpeta...")
+    if watcher['last_scan'] is not None:
+        st.caption(f"Última revisión ({watcher['mode']}): {watcher['last_scan'].strftime('%H:%M:%S')}")
+    if watcher['error']:
+        st.warning(watcher['error'])
+
+# Códigos de estado usados en la matriz de normas (buses x normas)
+ESTADO_PENDIENTE = 0
+ESTADO_INSTALADA = 1
+ESTADO_NO_APLICA = 2
+
+# VOCABULARIO DE ESTADOS
+# Archivo JSON/YAML que define qué textos significan Instalada / No Aplica / Pendiente.
+# Se compila una vez en un clasificador; cada columna se factoriza y solo se clasifican
+# sus valores únicos, que luego se propagan a todas las celdas mediante los códigos.
+VOCABULARY_PATH = os.environ.get(
+    'NORMAS_VOCABULARIO',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'normas_vocabulario.json')
+)
+
+# Vocabulario usado si no se encuentra el archivo (interpretación histórica)
+DEFAULT_STATUS_VOCABULARY = {
+    'orden': ['pendiente', 'instalada', 'no_aplica'],
+    'pendiente': {'exactos': [], 'contiene': []},
+    'instalada': {'exactos': ['1', 'instalada', 'instalado'], 'contiene': ['instalad']},
+    'no_aplica': {'exactos': [], 'contiene': ['no aplica']}
+}
+
+# Código de estado de cada sección del vocabulario
+VOCABULARY_STATUS_CODES = {
+    'pendiente': ESTADO_PENDIENTE,
+    'instalada': ESTADO_INSTALADA,
+    'no_aplica': ESTADO_NO_APLICA
+}
+
+# Función para normalizar un texto de estado (minúsculas, sin tildes, espacios simples)
+def normalize_status_text(value):
+    text = unicodedata.normalize('NFKD', str(value)).encode('ascii', 'ignore').decode('ascii')
+    return " ".join(text.lower().split())
+
+# Función para leer un vocabulario desde un archivo JSON o YAML (ruta o archivo subido)
+def read_status_vocabulary(source, name=None):
+    name = name or str(source)
+    if hasattr(source, 'read'):
+        content = source.read()
+        content = content.decode('utf-8') if isinstance(content, bytes) else content
+    else:
+        with open(source, encoding='utf-8') as f:
+            content = f.read()
+
+    if name.lower().endswith(('.yaml', '.yml')):
+        if not YAML_AVAILABLE:
+            raise ImportError("Para leer vocabularios YAML instala PyYAML con: pip install pyyaml")
+        vocabulary = yaml.safe_load(content)
+    else:
+        vocabulary = json.loads(content)
+
+    if not isinstance(vocabulary, dict) or not any(key in vocabulary for key in VOCABULARY_STATUS_CODES):
+        raise ValueError("El vocabulario debe definir al menos una de las secciones: " + ", ".join(VOCABULARY_STATUS_CODES))
+    return vocabulary
+
+# Función para cargar el vocabulario por defecto (archivo junto a app.py o el histórico)
+def load_status_vocabulary(path=None):
+    path = path or VOCABULARY_PATH
+    if os.path.exists(path):
+        return read_status_vocabulary(path)
+    return DEFAULT_STATUS_VOCABULARY
+
+# Función para compilar el vocabulario en un clasificador (mapa exacto + expresiones regulares)
+def compile_status_vocabulary(vocabulary):
+    order = vocabulary.get('orden') or list(VOCABULARY_STATUS_CODES)
+    exact = {}
+    contains = []
+    # Se recorre en orden inverso para que las secciones primeras tengan prioridad
+    for section in reversed(order):
+        rules = vocabulary.get(section) or {}
+        code = VOCABULARY_STATUS_CODES[section]
+        for value in rules.get('exactos', []):
+            exact[normalize_status_text(value)] = code
+    for section in order:
+        rules = vocabulary.get(section) or {}
+        patterns = [normalize_status_text(value) for value in rules.get('contiene', []) if str(value).strip()]
+        if patterns:
+            contains.append((VOCABULARY_STATUS_CODES[section], re.compile("|".join(map(re.escape, patterns)))))
+    return {'exact': exact, 'contains': contains, 'vocabulary': vocabulary}
+
+# Función para clasificar un arreglo de valores (normalmente los únicos de una columna)
+def classify_status_values(values, matcher):
+    codes = np.full(len(values), ESTADO_PENDIENTE, dtype=np.int8)
+    exact = matcher['exact']
+    for i, value in enumerate(values):
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            continue
+        key = normalize_status_text(value)
+        code = exact.get(key)
+        if code is None:
+            code = next((c for c, pattern in matcher['contains'] if pattern.search(key)), None)
+        if code is not None:
+            codes[i] = code
+    return codes
+
+# Clasificador compilado compartido entre ejecuciones (clave: vocabulario serializado)
+@st.cache_resource
+def _compiled_status_matcher(vocabulary_key):
+    return compile_status_vocabulary(json.loads(vocabulary_key))
+
+# Función para obtener el vocabulario activo (el cargado en la sesión o el por defecto)
+def get_status_vocabulary():
+    try:
+        vocabulary = st.session_state.get('status_vocabulary')
+    except Exception:
+        vocabulary = None
+    return vocabulary or load_status_vocabulary()
+
+# Función para obtener el clasificador compilado del vocabulario activo
+def get_status_matcher():
+    return _compiled_status_matcher(json.dumps(get_status_vocabulary(), sort_keys=True, ensure_ascii=False))
+
+# Función para clasificar un arreglo de valores: factoriza, clasifica los únicos y propaga por código
+def classify_status_array(values, matcher=None):
+    matcher = matcher or get_status_matcher()
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    lookup = classify_status_values(np.asarray(uniques, dtype=object), matcher)
+    # Los vacíos llegan con código -1, que apunta al Pendiente agregado al final de la tabla
+    lookup = np.append(lookup, np.int8(ESTADO_PENDIENTE))
+    return lookup[codes]
+
+# Función para describir el vocabulario activo en una línea
+def describe_status_vocabulary(vocabulary):
+    def section_text(section):
+        rules = vocabulary.get(section) or {}
+        values = [repr(v) for v in rules.get('exactos', [])] + [f"contiene {v!r}" for v in rules.get('contiene', [])]
+        return ", ".join(values) if values else "-"
+    return (f"Instalada: {section_text('instalada')} | No Aplica: {section_text('no_aplica')} | "
+            f"Pendiente: vacío, {section_text('pendiente')} o cualquier otro valor")
+
+# Etiquetas de cada código de estado en los reportes
+STATUS_LABELS = {
+    ESTADO_PENDIENTE: "Pendiente",
+    ESTADO_INSTALADA: "Instalada",
+    ESTADO_NO_APLICA: "No Aplica"
+}
+
+# Función para obtener el ID de cada bus (misma prioridad que en calculate_metrics)
+def get_bus_ids(df):
+    bus_ids = pd.Series([None] * len(df), index=df.index, dtype=object)
+    mapping = resolve_columns(df)
+
+    # Primero la columna de N° Interno (según el mapeo), solo para valores no nulos
+    interno_col = mapping.get('N° Interno')
+    if interno_col is not None:
+        present = df[interno_col].notna()
+        bus_ids[present] = df.loc[present, interno_col].astype(str)
+
+    # Usar PPU como fallback y, como último recurso, el índice
+    missing = bus_ids.isna()
+    if missing.any():
+        ppu_col = mapping.get('PPU')
+        if ppu_col is not None:
+            has_ppu = missing & df[ppu_col].notna()
+            bus_ids[has_ppu] = "PPU_" + df.loc[has_ppu, ppu_col].astype(str)
+            missing = bus_ids.isna()
+        bus_ids[missing] = [f"Bus_{idx}" for idx in df.index[missing.to_numpy()]]
+
+    return bus_ids.tolist()
+
+# Función para construir la matriz de estado de normas (int8: buses x normas)
+# Se factoriza el bloque completo de normas de una vez: cada texto distinto de toda la
+# planilla se clasifica una sola vez y los códigos se reinsertan en la matriz.
+def compute_status_matrix(df, norm_cols, matcher=None):
+    matcher = matcher or get_status_matcher()
+    if len(df) == 0 or len(norm_cols) == 0:
+        return np.full((len(df), len(norm_cols)), ESTADO_PENDIENTE, dtype=np.int8)
+    # El bloque de un DataFrame suele quedar en orden de columnas; se aplana sin copiarlo
+    block = df[list(norm_cols)].to_numpy(dtype=object)
+    return classify_status_array(block.ravel(order='F'), matcher).reshape(block.shape, order='F')
+
+# Función para calcular métricas
+@instrumented('calculate_metrics')
+def calculate_metrics(df, norm_cols, matcher=None):
+    try:
+        total_buses = len(df)
+        metrics = {}
+        
+        # Si no hay buses, devolver métricas predeterminadas
+        if total_buses == 0:
+            return {
+                'efficiency': 0,
+                'total_buses': 0,
+                'total_norms': len(norm_cols),
+                'completed_installations': 0,
+                'pending_installations': 0,
+                'complete_buses': 0,
+                'incomplete_buses': 0,
+                'norm_progress': {},
+                'bus_progress': {}
+            }
+        
+        # Matriz de estado (buses x normas) clasificada con el vocabulario de estados
+        status = compute_status_matrix(df, norm_cols, matcher)
+        is_installed = status == ESTADO_INSTALADA
+        is_not_applicable = status == ESTADO_NO_APLICA
+        # IMPORTANTE: Considerar "no aplica" como una norma completada
+        is_completed = is_installed | is_not_applicable
+        
+        # Eficiencia global de instalación: (instaladas + no aplica) / total
+        total_cells = total_buses * len(norm_cols)
+        completed_cells = int(is_completed.sum())
+        efficiency = (completed_cells / total_cells * 100) if total_cells > 0 else 0
+        
+        metrics['efficiency'] = round(efficiency, 2)
+        metrics['total_buses'] = total_buses
+        metrics['total_norms'] = len(norm_cols)
+        metrics['completed_installations'] = completed_cells
+        metrics['pending_installations'] = int(total_cells - completed_cells)
+        
+        # Buses con instalación completa
+        bus_ids = get_bus_ids(df)
+        completed_per_bus = is_completed.sum(axis=1)
+        installed_per_bus = is_installed.sum(axis=1)
+        applicable_per_bus = len(norm_cols) - is_not_applicable.sum(axis=1)
+        bus_complete = completed_per_bus == len(norm_cols)
+        
+        # Normas faltantes de cada bus, extraídas de una sola vez de la matriz
+        missing_rows, missing_cols = np.nonzero(~is_completed)
+        missing_splits = np.split(missing_cols, np.cumsum(np.bincount(missing_rows, minlength=total_buses))[:-1])
+        norm_names = np.array(norm_cols, dtype=object)
+        
+        buses_complete = []
+        buses_incomplete = []
+        bus_completion_status = {}
+        for i, bus_id in enumerate(bus_ids):
+            if bus_complete[i]:
+                buses_complete.append(bus_id)
+            else:
+                buses_incomplete.append(bus_id)
+                bus_completion_status[bus_id] = norm_names[missing_splits[i]].tolist()
+        
+        metrics['complete_buses'] = len(buses_complete)
+        metrics['incomplete_buses'] = len(buses_incomplete)
+        metrics['bus_completion_status'] = bus_completion_status
+        
+        # Lista de buses completos e incompletos
+        metrics['complete_buses_list'] = buses_complete
+        metrics['incomplete_buses_list'] = buses_incomplete
+        
+        # Calcular porcentaje de avance por norma (instalado O no aplica sobre el total de buses)
+        norm_progress_values = is_completed.sum(axis=0) / total_buses * 100
+        metrics['norm_progress'] = {col: round(float(value), 2) for col, value in zip(norm_cols, norm_progress_values)}
+        
+        # Calcular porcentaje de avance por bus (sobre el total de normas, no solo las aplicables)
+        total_norms = len(norm_cols)
+        progress_values = completed_per_bus / total_norms * 100 if total_norms > 0 else np.zeros(total_buses)
+        
+        # Columnas de información según el mapeo de columnas, con manejo seguro de nulos
+        mapping = resolve_columns(df)
+        group_cols = bus_group_columns(mapping)
+        terminal_col = group_cols['Terminal']
+        subclass_col = group_cols['Subclase']
+        ppus = info_column_values(df, mapping.get('PPU'))
+        # Fechas de renovación interpretadas una vez (datetime64, NaT si falta o no se entiende)
+        fecha_col = mapping.get('FECHA DE RENOVACION')
+        fechas = info_column_values(df, fecha_col)
+        renewal_dates = parse_renewal_dates(fechas if fecha_col is not None else [None] * total_buses)
+        fechas = format_renewal_dates(fechas, renewal_dates)
+        terminals = info_column_values(df, terminal_col)
+        subclasses = info_column_values(df, subclass_col)
+        
+        # Normas instaladas (contador): el de la planilla si existe, si no el calculado
+        contador_col = mapping.get('NORMA INSTALADA')
+        if contador_col is not None:
+            contador = df[contador_col].astype(object).where(df[contador_col].notna(), None).tolist()
+        else:
+            contador = [None] * total_buses
+        
+        bus_progress = {}
+        for i, bus_id in enumerate(bus_ids):
+            bus_progress[bus_id] = {
+                'progress': round(float(progress_values[i]), 2),
+                'completed': int(completed_per_bus[i]),
+                'total_norms': total_norms,
+                'applicable_norms': int(applicable_per_bus[i]),
+                'ppu': ppus[i],
+                'fecha_renovacion': fechas[i],
+                'normas_instaladas_contador': contador[i] if contador[i] is not None else int(installed_per_bus[i]),
+                'terminal': terminals[i],
+                'subclase': subclasses[i],
+                'completo': bool(bus_complete[i]),
+                'normas_faltantes': norm_names[missing_splits[i]].tolist()
+            }
+        
+        metrics['bus_progress'] = bus_progress
+
+        # Índice invertido de normas faltantes (bitsets) para consultas del dashboard y exportaciones
+        bus_groups = {}
+        if terminal_col is not None:
+            bus_groups['Terminal'] = df[terminal_col].fillna('N/A').astype(str).to_numpy()
+        if subclass_col is not None:
+            bus_groups['Subclase'] = df[subclass_col].fillna('N/A').astype(str).to_numpy()
+
+        metrics['status_matrix'] = status
+        metrics['progress_array'] = np.round(progress_values, 2)
+        metrics['renewal_dates'] = renewal_dates
+        metrics['bus_ids'] = bus_ids
+        metrics['bus_groups'] = bus_groups
+        metrics['missing_index'] = build_missing_index(status, bus_ids, norm_cols, bus_groups)
+        # Grupo de pares y contador de la planilla para la auditoría de datos
+        metrics['peer_groups'] = peer_group_values(df, mapping)
+        metrics['installed_counter'] = (pd.to_numeric(pd.Series(contador, dtype=object), errors='coerce').to_numpy(dtype=float)
+                                        if contador_col is not None else None)
+        # Contexto de consultas sobre los buses filtrados (tablas y exportaciones del dashboard)
+        metrics['query_context'] = build_query_context(status, norm_cols, {
+            'interno': bus_ids, 'ppu': ppus, 'terminal': terminals, 'subclase': subclasses, 'renovacion': renewal_dates
+        })
+
+        return metrics
+        
+    except Exception as e:
+        st.error(f"Error al calcular métricas: {str(e)}")
+        # Devolver métricas predeterminadas en caso de error
+        return {
+            'efficiency': 0,
+            'total_buses': total_buses if 'total_buses' in locals() else 0,
+            'total_norms': len(norm_cols),
+            'completed_installations': 0,
+            'pending_installations': 0,
+            'complete_buses': 0,
+            'incomplete_buses': 0,
+            'norm_progress': {},
+            'bus_progress': {}
+        }
+
+# Tabla de conteo de bits por byte (popcount) para los bitsets empaquetados
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# Función para construir el índice invertido norma -> bitset de buses que la tienen pendiente
+def build_missing_index(status_matrix, bus_ids, norm_cols, group_values=None):
+    pending = (status_matrix == ESTADO_PENDIENTE)
+
+    # Una fila de bits empaquetados por norma (bit i = bus i tiene la norma pendiente)
+    bits = np.packbits(pending.T, axis=1) if pending.size else np.zeros((len(norm_cols), 0), dtype=np.uint8)
+
+    # Bitsets por grupo (p. ej. Terminal o Subclase) para cruzar con las normas
+    groups = {}
+    for group_col, values in (group_values or {}).items():
+        values = pd.Series(values).astype(str).to_numpy()
+        groups[group_col] = {
+            value: np.packbits(values == value)
+            for value in pd.unique(values)
+        }
+
+    return {
+        'bus_ids': np.array(bus_ids, dtype=object),
+        'norm_cols': list(norm_cols),
+        'norm_pos': {norm: j for j, norm in enumerate(norm_cols)},
+        'n_buses': len(bus_ids),
+        'bits': bits,
+        'groups': groups
+    }
+
+# Función para obtener el bitset de los buses de uno o varios grupos (unión)
+def index_group_bits(index, group_col, values):
+    n_bytes = index['bits'].shape[1]
+    result = np.zeros(n_bytes, dtype=np.uint8)
+    group = index['groups'].get(group_col, {})
+    for value in values:
+        if str(value) in group:
+            result |= group[str(value)]
+    return result
+
+# Función para combinar las normas pendientes con AND ("todas") u OR ("alguna")
+def index_missing_bits(index, norms, how='all', within=None):
+    rows = [index['norm_pos'][norm] for norm in norms if norm in index['norm_pos']]
+    n_bytes = index['bits'].shape[1]
+
+    if not rows:
+        result = np.zeros(n_bytes, dtype=np.uint8)
+    elif how == 'all':
+        result = np.bitwise_and.reduce(index['bits'][rows], axis=0)
+    else:
+        result = np.bitwise_or.reduce(index['bits'][rows], axis=0)
+
+    if within is not None:
+        result = result & within
+    return result
+
+# Función para contar los buses marcados en un bitset
+def index_count(bits):
+    return int(_POPCOUNT[bits].sum())
+
+# Función para obtener los IDs de bus marcados en un bitset
+def index_buses(index, bits):
+    mask = np.unpackbits(bits, count=index['n_buses']).astype(bool)
+    return index['bus_ids'][mask].tolist()
+
+# Función para contar buses con cada norma pendiente (opcionalmente dentro de un grupo)
+def index_missing_counts(index, within=None):
+    bits = index['bits'] if within is None else index['bits'] & within
+    counts = _POPCOUNT[bits].sum(axis=1, dtype=np.int64)
+    return dict(zip(index['norm_cols'], counts.tolist()))
+
+# Consultas de alto nivel sobre el índice
+def buses_missing_all(index, norms, within=None):
+    return index_buses(index, index_missing_bits(index, norms, 'all', within))
+
+def buses_missing_any(index, norms, within=None):
+    return index_buses(index, index_missing_bits(index, norms, 'any', within))
+
+# Función para obtener el conteo de faltantes por norma y por cada valor de un grupo
+def index_missing_by_group(index, group_col):
+    group = index['groups'].get(group_col, {})
+    data = {value: index_missing_counts(index, within=bits) for value, bits in group.items()}
+    return pd.DataFrame(data, index=index['norm_cols'])
+
+# CO-OCURRENCIA Y KITS DE NORMAS FALTANTES
+# Con P la matriz booleana de normas pendientes (buses x normas), P.T @ P cuenta en un solo
+# producto de matrices cuántos buses tienen pendientes a la vez cada par de normas (la diagonal
+# es el total por norma). Los buses se agrupan por kit: el conjunto exacto de normas que les
+# falta, identificado por un hash de 64 bits de su fila de bits empaquetada.
+COOCCURRENCE_TOP_NORMS = 25
+KIT_TABLE_ROWS = 20
+KIT_SAMPLE_BUSES = 5
+_KIT_HASH_PRIME = np.uint64(0x100000001B3)
+_KIT_HASH_SEED = np.uint64(0xCBF29CE484222325)
+
+# Función para calcular la co-ocurrencia de normas pendientes (conteo y Jaccard)
+@instrumented('norm_cooccurrence')
+def norm_cooccurrence(status_matrix, norm_cols):
+    # float32 usa BLAS y es exacto para conteos de hasta 2^24 buses
+    pending = (status_matrix == ESTADO_PENDIENTE).astype(np.float32)
+    counts = np.rint(pending.T @ pending).astype(np.int64)
+    totals = np.diag(counts)
+    union = totals[:, None] + totals[None, :] - counts
+    with np.errstate(divide='ignore', invalid='ignore'):
+        jaccard = np.where(union > 0, counts / union, 0.0)
+    return {'normas': list(norm_cols), 'conteo': counts, 'jaccard': jaccard, 'faltantes': totals}
+
+# Función para calcular el hash de cada fila de bits empaquetada (FNV-1a por palabras de 64 bits)
+def hash_packed_rows(packed):
+    n_rows, n_bytes = packed.shape
+    width = -(-n_bytes // 8) * 8
+    words = np.zeros((n_rows, width), dtype=np.uint8)
+    words[:, :n_bytes] = packed
+    words = words.view(np.uint64)
+    hashes = np.full(n_rows, _KIT_HASH_SEED, dtype=np.uint64)
+    for j in range(words.shape[1]):
+        hashes = (hashes ^ words[:, j]) * _KIT_HASH_PRIME
+    return hashes
+
+# Función para agrupar los buses por su conjunto de normas faltantes (kit)
+# Devuelve el kit de cada bus (-1 = completo) y, por kit, la fila representativa y sus buses
+@instrumented('missing_kits')
+def missing_kits(status_matrix):
+    pending = status_matrix == ESTADO_PENDIENTE
+    packed = np.packbits(pending, axis=1)
+    _, first, kit, sizes = np.unique(hash_packed_rows(packed), return_index=True, return_inverse=True, return_counts=True)
+    kit = kit.ravel()
+    # Una colisión de hash mezclaría kits distintos: se verifica y, si ocurre, se agrupa por bytes
+    if not np.array_equal(packed, packed[first[kit]]):
+        rows = np.ascontiguousarray(packed).view(np.dtype((np.void, packed.shape[1]))).ravel()
+        _, first, kit, sizes = np.unique(rows, return_index=True, return_inverse=True, return_counts=True)
+        kit = kit.ravel()
+    # El kit vacío (sin normas pendientes) corresponde a los buses completos
+    complete = ~pending[first].any(axis=1)
+    kit_ids = np.cumsum(~complete) - 1
+    kit = np.where(complete[kit], -1, kit_ids[kit])
+    return {'kit': kit, 'filas': first[~complete], 'buses': sizes[~complete]}
+
+# Función para armar la tabla de kits: normas del kit, buses, instalaciones y buses de ejemplo
+def kit_table(status_matrix, bus_ids, norm_cols, kits=None, terminals=None):
+    kits = kits or missing_kits(status_matrix)
+    if len(kits['filas']) == 0:
+        return pd.DataFrame()
+    pending = status_matrix[kits['filas']] == ESTADO_PENDIENTE
+    norm_names = np.array(norm_cols, dtype=object)
+    bus_ids = np.asarray(bus_ids, dtype=object)
+    # Buses de cada kit en orden de planilla (orden estable por kit)
+    order = np.argsort(kits['kit'], kind='stable')
+    order = order[kits['kit'][order] >= 0]
+    starts = np.concatenate([[0], np.cumsum(kits['buses'])[:-1]])
+    n_norms = pending.sum(axis=1)
+    table = pd.DataFrame({
+        'Normas del Kit': [", ".join(norm_names[row]) for row in pending],
+        'N° Normas': n_norms,
+        'Buses': kits['buses'],
+        '% Flota': np.round(kits['buses'] / len(bus_ids) * 100, 1),
+        'Instalaciones': kits['buses'] * n_norms,
+        'Buses de Ejemplo': [", ".join(map(str, bus_ids[order[start:start + min(size, KIT_SAMPLE_BUSES)]]))
+                             for start, size in zip(starts, kits['buses'])]
+    })
+    if terminals is not None:
+        terminals = np.asarray(terminals, dtype=object)
+        table['Terminales'] = [", ".join(sorted(set(map(str, terminals[order[start:start + size]]))))
+                               for start, size in zip(starts, kits['buses'])]
+    table = table.sort_values(['Buses', 'Instalaciones'], ascending=False, kind='stable').reset_index(drop=True)
+    table.insert(0, 'Kit', np.arange(1, len(table) + 1))
+    return table
+
+# Patrones de normas faltantes compartidos entre ejecuciones (mismo conjunto de datos)
+@st.cache_resource(max_entries=8)
+def get_missing_patterns(data_key, _status_matrix, _bus_ids, _norm_cols, _terminals=None):
+    kits = missing_kits(_status_matrix)
+    return {
+        'coocurrencia': norm_cooccurrence(_status_matrix, _norm_cols),
+        'kits': kits,
+        'tabla': kit_table(_status_matrix, _bus_ids, _norm_cols, kits, _terminals)
+    }
+
+# Función para crear el mapa de calor de co-ocurrencia de las normas que más faltan
+def create_cooccurrence_heatmap(cooccurrence, medida='Buses', top=COOCCURRENCE_TOP_NORMS):
+    if not PLOTLY_AVAILABLE:
+        st.warning("No se pueden crear gráficos. Por favor instala plotly: pip install plotly")
+        return None
+
+    totals = cooccurrence['faltantes']
+    top_idx = [j for j in np.argsort(-totals, kind='stable')[:top] if totals[j] > 0]
+    if len(top_idx) < 2:
+        return None
+    names = [cooccurrence['normas'][j] for j in top_idx]
+    if medida == 'Jaccard':
+        values = np.round(cooccurrence['jaccard'][np.ix_(top_idx, top_idx)], 2)
+        color_label, range_color = 'Jaccard', [0, 1]
+    else:
+        values = cooccurrence['conteo'][np.ix_(top_idx, top_idx)]
+        color_label, range_color = 'Buses', None
+
+    fig = px.imshow(
+        values, x=names, y=names,
+        color_continuous_scale='Reds',
+        range_color=range_color,
+        labels={'color': color_label},
+        title=f"Normas que Faltan Juntas (top {len(names)} normas más faltantes)"
+    )
+    fig.update_layout(height=max(450, len(names) * 22), xaxis={'tickangle': -45})
+    return fig
+
+# AUDITORÍA DE "NO APLICA"
+# "No Aplica" cuenta como completada en todas las métricas, así que una celda marcada No Aplica
+# donde los demás buses del mismo grupo (Subclase / Modelo chasis) sí tienen la norma es
+# sospechosa. Los conteos por grupo, estado y norma salen de un solo producto de matrices entre
+# la matriz de pertenencia a grupos y la matriz de estados en columnas por estado (un groupby).
+# Además se concilia el contador NORMA INSTALADA de la planilla con las instaladas calculadas.
+AUDIT_MIN_GROUP = 5
+AUDIT_PEER_SHARE = 0.8
+AUDIT_STATES = (ESTADO_PENDIENTE, ESTADO_INSTALADA, ESTADO_NO_APLICA)
+
+# Función para obtener el grupo de pares de cada bus: Subclase y Modelo chasis (los que existan)
+def peer_group_values(df, mapping=None):
+    mapping = mapping if mapping is not None else resolve_columns(df)
+    cols = [mapping[role] for role in ('Subclase', 'Modelo chasis') if mapping.get(role) is not None]
+    if not cols:
+        return np.full(len(df), 'Sin grupo', dtype=object)
+    parts = [df[col].astype(object).where(df[col].notna(), 'N/A').astype(str) for col in cols]
+    return functools.reduce(lambda left, right: left + ' / ' + right, parts).to_numpy(dtype=object)
+
+# Función para contar, en un solo groupby, los buses de cada grupo en cada estado por norma
+# Devuelve el grupo de cada bus, los nombres de grupo y conteos (grupos x estados x normas)
+@instrumented('status_counts_by_group')
+def status_counts_by_group(status_matrix, groups):
+    codes, labels = pd.factorize(np.asarray(groups, dtype=object))
+    n_buses, n_norms = status_matrix.shape
+    membership = np.zeros((len(labels), n_buses), dtype=np.float32)
+    membership[codes, np.arange(n_buses)] = 1
+    states = np.concatenate([status_matrix == state for state in AUDIT_STATES], axis=1).astype(np.float32)
+    counts = np.rint(membership @ states).astype(np.int64).reshape(len(labels), len(AUDIT_STATES), n_norms)
+    return {'grupo': codes, 'grupos': np.asarray(labels, dtype=object), 'conteo': counts,
+            'tamano': np.bincount(codes, minlength=len(labels))}
+
+# Función para marcar celdas que se apartan de sus pares: No Aplica donde los pares aplican la
+# norma y Pendiente donde los pares la marcan No Aplica (grupos con al menos min_group buses)
+@instrumented('no_aplica_anomalies')
+def no_aplica_anomalies(status_matrix, bus_ids, norm_cols, groups, min_group=AUDIT_MIN_GROUP,
+                        peer_share=AUDIT_PEER_SHARE, group_counts=None):
+    group_counts = group_counts or status_counts_by_group(status_matrix, groups)
+    counts, sizes = group_counts['conteo'], group_counts['tamano']
+    pend, inst, na = (AUDIT_STATES.index(state) for state in (ESTADO_PENDIENTE, ESTADO_INSTALADA, ESTADO_NO_APLICA))
+    # Estado más frecuente del grupo en cada norma (a igualdad: Pendiente, Instalada, No Aplica)
+    mode = np.asarray(AUDIT_STATES)[counts.argmax(axis=1)]
+    status_labels = np.array([STATUS_LABELS[state] for state in range(max(STATUS_LABELS) + 1)], dtype=object)
+
+    frames = []
+    for state, kind in ((ESTADO_NO_APLICA, "No Aplica con pares que la aplican"),
+                        (ESTADO_PENDIENTE, "Pendiente con pares en No Aplica")):
+        rows, cols = np.nonzero(status_matrix == state)
+        group = group_counts['grupo'][rows]
+        # Pares: el grupo sin el propio bus
+        peers = sizes[group] - 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            installed_share = counts[group, inst, cols] / peers
+            na_share = counts[group, na, cols] / peers
+            applicable_share = (counts[group, inst, cols] + counts[group, pend, cols]) / peers
+        share = applicable_share if state == ESTADO_NO_APLICA else na_share
+        flagged = (sizes[group] >= min_group) & (share >= peer_share)
+        rows, cols, group = rows[flagged], cols[flagged], group[flagged]
+        frames.append(pd.DataFrame({
+            'Número Interno': np.asarray(bus_ids, dtype=object)[rows],
+            'Grupo': group_counts['grupos'][group],
+            'Norma': np.asarray(norm_cols, dtype=object)[cols],
+            'Estado': STATUS_LABELS[state],
+            'Estado del Grupo': status_labels[mode[group, cols]],
+            '% Pares Instalada': np.round(installed_share[flagged] * 100, 1),
+            '% Pares No Aplica': np.round(na_share[flagged] * 100, 1),
+            'Buses del Grupo': sizes[group],
+            'Tipo': kind,
+            '_fila': rows
+        }))
+    result = pd.concat(frames, ignore_index=True)
+    return result.sort_values(['Tipo', '% Pares Instalada', 'Número Interno'], ascending=[False, False, True],
+                              kind='stable').reset_index(drop=True)
+
+# Función para conciliar el contador NORMA INSTALADA de la planilla con las instaladas calculadas
+@instrumented('reconcile_installed_counter')
+def reconcile_installed_counter(counter, status_matrix, bus_ids):
+    installed = (status_matrix == ESTADO_INSTALADA).sum(axis=1)
+    with_na = installed + (status_matrix == ESTADO_NO_APLICA).sum(axis=1)
+    counter = np.asarray(counter, dtype=float)
+    has_value = ~np.isnan(counter)
+    result = np.select(
+        [~has_value, counter == installed, counter == with_na],
+        ["Sin dato", "Coincide", "Cuenta también No Aplica"],
+        "No coincide"
+    )
+    detail = pd.DataFrame({
+        'Número Interno': np.asarray(bus_ids, dtype=object),
+        'NORMA INSTALADA (planilla)': counter,
+        'Instaladas (calculado)': installed,
+        'Instaladas + No Aplica': with_na,
+        'Diferencia': counter - installed,
+        'Resultado': result
+    })
+    summary = detail['Resultado'].value_counts().reindex(
+        ["Coincide", "Cuenta también No Aplica", "No coincide", "Sin dato"], fill_value=0
+    )
+    return detail[result != "Coincide"].reset_index(drop=True), summary
+
+# Conteos por grupo compartidos entre ejecuciones (los umbrales se aplican después, sin recalcular)
+@st.cache_resource(max_entries=8)
+def get_group_status_counts(data_key, _status_matrix, _groups):
+    return status_counts_by_group(_status_matrix, _groups)
+
+# CONSULTA DE BUSES
+# Un filtro de texto como "terminal in (A, B) and progreso < 50 and falta('Norma X')" se analiza
+# una vez y se compila a funciones que devuelven máscaras booleanas de NumPy sobre la matriz de
+# estados y los arreglos de atributos de los buses. Las consultas compiladas se guardan por texto
+# y las máscaras por conjunto de datos: los filtros de la barra lateral, las tablas y las
+# exportaciones usan la misma máscara sin recorrer los buses en Python.
+QUERY_MASK_CACHE_SIZE = 64
+
+# Campos consultables: tipo y nombres alternativos (minúsculas, sin tildes)
+QUERY_FIELDS = {
+    'interno': ('texto', ['bus', 'numero']),
+    'ppu': ('texto', ['patente']),
+    'terminal': ('texto', ['base']),
+    'subclase': ('texto', ['subclass', 'clase', 'modelo']),
+    'progreso': ('numero', ['progress', 'avance']),
+    'faltantes': ('numero', ['pendientes', 'missing_count']),
+    'instaladas': ('numero', ['installed_count']),
+    'renovacion': ('fecha', ['renewal', 'fecha']),
+    'completo': ('bandera', ['complete', 'completos'])
+}
+QUERY_FIELD_NAMES = {alias: field for field, (_, aliases) in QUERY_FIELDS.items() for alias in [field] + aliases}
+
+# Funciones sobre normas: todas las normas indicadas deben estar en ese estado
+QUERY_FUNCTIONS = {
+    'falta': ESTADO_PENDIENTE, 'missing': ESTADO_PENDIENTE, 'pendiente': ESTADO_PENDIENTE,
+    'instalada': ESTADO_INSTALADA, 'installed': ESTADO_INSTALADA,
+    'no_aplica': ESTADO_NO_APLICA, 'not_applicable': ESTADO_NO_APLICA
+}
+QUERY_KEYWORDS = {'and': 'and', 'y': 'and', 'or': 'or', 'o': 'or', 'not': 'not', 'no': 'not', 'in': 'in', 'en': 'in'}
+# Palabras clave en español que, entre palabras de un valor sin comillas, son parte del valor
+# ("subclase = Bus no articulado"), salvo que las siga una condición ("terminal = A y completo")
+QUERY_VALUE_KEYWORDS = {'y', 'o', 'no', 'en'}
+QUERY_OPERATORS = {
+    '=': np.equal, '!=': np.not_equal, '<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal
+}
+QUERY_TOKEN_PATTERN = re.compile(
+    r"""\s*(?:(?P<texto>'(?:[^']|'')*'|"(?:[^"]|"")*")|(?P<op><=|>=|!=|<>|==|=|<|>|\(|\)|,)|(?P<palabra>[^\s()'",=<>!]+))"""
+)
+QUERY_HELP = (
+    "Condiciones unidas con and / or / not (o y / o / no) y paréntesis. "
+    "Campos: interno, ppu, terminal, subclase (=, !=, in (A, B), * como comodín); "
+    "progreso, faltantes, instaladas (=, !=, <, <=, >, >=); renovacion (fecha dd/mm/aaaa o aaaa-mm-dd); completo. "
+    "Normas: falta('Norma X'), instalada('Norma X'), no_aplica('Norma X'). "
+    "Los valores con espacios van entre comillas; una comilla dentro del valor se escribe doble ('O''Higgins'). "
+    "Si un valor coincide exactamente con uno de la planilla se usa solo ese; si no, se compara sin tildes ni mayúsculas."
+)
+
+# Función para normalizar un nombre de la consulta (campo, función o palabra clave)
+def _query_name(word):
+    return normalize_column_name(word).replace(' ', '_')
+
+# Función para dividir el texto de una consulta en tokens (tipo, valor, texto original)
+def tokenize_bus_query(text):
+    tokens = []
+    text = text.strip()
+    pos = 0
+    while pos < len(text):
+        match = QUERY_TOKEN_PATTERN.match(text, pos)
+        if match is None:
+            char = text[len(text) - len(text[pos:].lstrip())]
+            if char in "'\"":
+                raise ValueError(f"Comillas sin cerrar: {text[pos:].strip()}")
+            raise ValueError(f"Carácter inesperado '{char}'")
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'texto':
+            # Comilla doble dentro del literal = una comilla ('O''Higgins')
+            tokens.append(('valor', value[1:-1].replace(value[0] * 2, value[0]), value))
+        elif kind == 'op':
+            tokens.append(('op', {'==': '=', '<>': '!='}.get(value, value), value))
+        elif value.lower() in QUERY_KEYWORDS:
+            tokens.append(('clave', QUERY_KEYWORDS[value.lower()], value))
+        else:
+            tokens.append(('palabra', value, value))
+    return tokens
+
+# Función para ver el token actual (tipo, valor) sin consumirlo
+def _query_peek(state, offset=0):
+    pos = state['pos'] + offset
+    return state['tokens'][pos][:2] if pos < len(state['tokens']) else (None, None)
+
+# Función para obtener el texto original de un token (para mensajes y valores sin comillas)
+def _query_raw(state, offset=0):
+    pos = state['pos'] + offset
+    return state['tokens'][pos][2] if pos < len(state['tokens']) else None
+
+# Función para saber si una palabra clave en español es parte de un valor sin comillas:
+# la sigue una palabra que no es un campo ni una función de normas
+def _query_keyword_in_value(state, offset):
+    if _query_peek(state, offset)[0] != 'clave' or _query_raw(state, offset).lower() not in QUERY_VALUE_KEYWORDS:
+        return False
+    kind, word = _query_peek(state, offset + 1)
+    return kind == 'palabra' and _query_name(word) not in QUERY_FIELD_NAMES and _query_name(word) not in QUERY_FUNCTIONS
+
+# Función para consumir un operador o palabra clave esperado
+def _query_expect(state, kind, value):
+    token = _query_peek(state)
+    if token != (kind, value):
+        found = f"'{_query_raw(state)}'" if token[0] is not None else "el final de la consulta"
+        raise ValueError(f"Se esperaba '{value}' y se encontró {found}")
+    state['pos'] += 1
+
+# Función para consumir un valor (entre comillas o palabras sueltas seguidas, como La Florida
+# o Bus no articulado)
+def _query_value(state):
+    kind, value = _query_peek(state)
+    if _query_keyword_in_value(state, 0):
+        kind = 'palabra'
+    elif kind not in ('valor', 'palabra'):
+        found = f"'{_query_raw(state)}'" if kind is not None else "el final de la consulta"
+        raise ValueError(f"Se esperaba un valor y se encontró {found}")
+    words = [_query_raw(state) if kind == 'palabra' else value]
+    state['pos'] += 1
+    while kind == 'palabra' and (_query_peek(state)[0] == 'palabra' or _query_keyword_in_value(state, 0)):
+        words.append(_query_raw(state))
+        state['pos'] += 1
+    return " ".join(words)
+
+# Función para consumir una lista de valores entre paréntesis: (A, B, ...)
+def _query_values(state):
+    _query_expect(state, 'op', '(')
+    values = [_query_value(state)]
+    while _query_peek(state) == ('op', ','):
+        state['pos'] += 1
+        values.append(_query_value(state))
+    _query_expect(state, 'op', ')')
+    return values
+
+# Función para convertir un valor de la consulta al tipo del campo
+def _query_literal(field, value):
+    tipo = QUERY_FIELDS[field][0]
+    if tipo == 'numero':
+        try:
+            return float(value.replace(',', '.'))
+        except ValueError:
+            raise ValueError(f"El campo '{field}' espera un número y recibió '{value}'") from None
+    if tipo == 'fecha':
+        date = _parse_date_values(np.array([value], dtype=object))[0]
+        if np.isnat(date):
+            raise ValueError(f"El campo '{field}' espera una fecha y recibió '{value}'")
+        return date
+    return value
+
+# Función para analizar una condición simple (campo, comparación, lista o función de normas)
+def _query_predicate(state):
+    kind, word = _query_peek(state)
+    if kind != 'palabra':
+        found = f"'{_query_raw(state)}'" if kind is not None else "el final de la consulta"
+        raise ValueError(f"Se esperaba un campo o una función y se encontró {found}")
+    state['pos'] += 1
+    name = _query_name(word)
+
+    if name in QUERY_FUNCTIONS:
+        return ('estado', QUERY_FUNCTIONS[name], tuple(_query_values(state)))
+    if name not in QUERY_FIELD_NAMES:
+        raise ValueError(f"Campo desconocido '{word}'. Campos: {', '.join(QUERY_FIELDS)}")
+    field = QUERY_FIELD_NAMES[name]
+    tipo = QUERY_FIELDS[field][0]
+    if tipo == 'bandera':
+        return ('bandera', field)
+
+    # campo [not] in (A, B, ...)
+    negate = _query_peek(state) == ('clave', 'not') and _query_peek(state, 1) == ('clave', 'in')
+    if negate:
+        state['pos'] += 1
+    if _query_peek(state) == ('clave', 'in'):
+        state['pos'] += 1
+        values = tuple(_query_literal(field, value) for value in _query_values(state))
+        if tipo == 'texto':
+            node = ('en', field, values)
+        else:
+            node = ('or', tuple(('comparar', field, '=', value) for value in values))
+        return ('not', node) if negate else node
+
+    kind, op = _query_peek(state)
+    if kind != 'op' or op not in QUERY_OPERATORS:
+        raise ValueError(f"Se esperaba una comparación o 'in' después de '{word}'")
+    if tipo == 'texto' and op not in ('=', '!='):
+        raise ValueError(f"El campo '{field}' solo admite =, != o in")
+    state['pos'] += 1
+    value = _query_literal(field, _query_value(state))
+    if tipo == 'texto':
+        node = ('en', field, (value,))
+        return ('not', node) if op == '!=' else node
+    return ('comparar', field, op, value)
+
+# Funciones del analizador descendente: or < and < not < (paréntesis | condición)
+def _query_not(state):
+    if _query_peek(state) == ('clave', 'not'):
+        state['pos'] += 1
+        return ('not', _query_not(state))
+    if _query_peek(state) == ('op', '('):
+        state['pos'] += 1
+        node = _query_or(state)
+        _query_expect(state, 'op', ')')
+        return node
+    return _query_predicate(state)
+
+def _query_and(state):
+    nodes = [_query_not(state)]
+    while _query_peek(state) == ('clave', 'and'):
+        state['pos'] += 1
+        nodes.append(_query_not(state))
+    return nodes[0] if len(nodes) == 1 else ('and', tuple(nodes))
+
+def _query_or(state):
+    nodes = [_query_and(state)]
+    while _query_peek(state) == ('clave', 'or'):
+        state['pos'] += 1
+        nodes.append(_query_and(state))
+    return nodes[0] if len(nodes) == 1 else ('or', tuple(nodes))
+
+# Función para analizar una consulta completa a su árbol de condiciones
+def parse_bus_query(text):
+    state = {'tokens': tokenize_bus_query(text), 'pos': 0}
+    if not state['tokens']:
+        return None
+    node = _query_or(state)
+    if state['pos'] < len(state['tokens']):
+        raise ValueError(f"Texto sobrante desde '{_query_raw(state)}'")
+    return node
+
+# Función para buscar las columnas de las normas nombradas (exacto o sin tildes/mayúsculas)
+def _query_norm_positions(context, names):
+    positions = []
+    for name in names:
+        pos = context['norm_pos'].get(name, context['norm_keys'].get(normalize_column_name(name)))
+        if pos is None:
+            raise ValueError(f"Norma desconocida '{name}'")
+        positions.append(pos)
+    return positions
+
+# Función para comparar textos sin distinguir mayúsculas ni tildes ("Maipu" = "Maipú")
+def _query_text_key(value):
+    text = unicodedata.normalize('NFKD', str(value)).encode('ascii', 'ignore').decode('ascii')
+    return " ".join(text.casefold().split())
+
+# Función para obtener los códigos, los valores distintos y sus claves normalizadas de un campo
+# de texto (se factoriza la primera vez que una consulta o un filtro usa el campo)
+def _query_text_codes(context, field):
+    textos = context['textos']
+    if field not in textos:
+        values = pd.Series(context['valores'][field], dtype=object).astype(str).to_numpy(dtype=object)
+        codes, uniques = pd.factorize(values)
+        uniques = np.asarray(uniques, dtype=object)
+        textos[field] = (codes, uniques, np.array([_query_text_key(unique) for unique in uniques], dtype=object))
+    return textos[field]
+
+# Función para marcar los buses cuyo campo de texto coincide con alguno de los valores
+# (se compara contra los valores distintos del campo y se expande con sus códigos). Un valor
+# igual a uno de la planilla elige solo ese ("MAIPU" no incluye "Maipú"); si no, * es comodín
+# y la comparación es sin tildes ni mayúsculas
+def _query_text_mask(context, field, values):
+    codes, uniques, keys = _query_text_codes(context, field)
+    hit = np.zeros(len(uniques), dtype=bool)
+    for value in values:
+        exact = uniques == str(value)
+        if exact.any():
+            hit |= exact
+            continue
+        key = _query_text_key(value)
+        if '*' in key:
+            pattern = re.compile(re.escape(key).replace(r'\*', '.*'))
+            hit |= np.fromiter((pattern.fullmatch(unique) is not None for unique in keys), dtype=bool, count=len(keys))
+        else:
+            hit |= keys == key
+    return hit[codes]
+
+# Función para marcar los buses cuyo campo de texto es exactamente uno de los valores elegidos
+# (filtros de selección múltiple: sin comodines ni comparación sin tildes, sin pasar por texto)
+def bus_values_mask(context, field, values):
+    codes, uniques, _ = _query_text_codes(context, field)
+    return np.isin(uniques, [str(value) for value in values])[codes]
+
+# Función para marcar los buses con las normas en un estado: todas o alguna de ellas
+def norm_status_mask(context, norms, code=ESTADO_PENDIENTE, match_all=True):
+    if not norms:
+        return np.ones(context['n_buses'], dtype=bool)
+    matches = context['status'][:, _query_norm_positions(context, norms)] == code
+    return matches.all(axis=1) if match_all else matches.any(axis=1)
+
+# Función para compilar un nodo del árbol a una función contexto -> máscara booleana
+def _compile_query_node(node):
+    kind = node[0]
+    if kind in ('and', 'or'):
+        parts = [_compile_query_node(child) for child in node[1]]
+        combine = np.logical_and if kind == 'and' else np.logical_or
+        return lambda context: functools.reduce(combine, (part(context) for part in parts))
+    if kind == 'not':
+        part = _compile_query_node(node[1])
+        return lambda context: ~part(context)
+    if kind == 'bandera':
+        return lambda context: context['campos'][node[1]]
+    if kind == 'en':
+        return lambda context: _query_text_mask(context, node[1], node[2])
+    if kind == 'comparar':
+        compare = QUERY_OPERATORS[node[2]]
+        return lambda context: compare(context['campos'][node[1]], node[3])
+    code, names = node[1], node[2]
+    return lambda context: (context['status'][:, _query_norm_positions(context, names)] == code).all(axis=1)
+
+# Consultas compiladas compartidas entre ejecuciones y sesiones (no dependen de los datos)
+@functools.lru_cache(maxsize=256)
+def compile_bus_query(text):
+    node = parse_bus_query(text)
+    return {'texto': text, 'arbol': node, 'evaluar': _compile_query_node(node) if node is not None else None}
+
+# Función para construir el contexto de consulta: matriz de estados y atributos por bus
+def build_query_context(status_matrix, norm_cols, attributes):
+    n_buses, n_norms = status_matrix.shape
+    completed = (status_matrix != ESTADO_PENDIENTE).sum(axis=1)
+    installed = (status_matrix == ESTADO_INSTALADA).sum(axis=1)
+    return {
+        'n_buses': n_buses,
+        'status': status_matrix,
+        'norm_pos': {norm: j for j, norm in enumerate(norm_cols)},
+        'norm_keys': {normalize_column_name(norm): j for j, norm in enumerate(norm_cols)},
+        'valores': {field: np.asarray(values, dtype=object) for field, values in attributes.items() if field != 'renovacion'},
+        'textos': {},
+        'campos': {
+            'progreso': np.round(completed / n_norms * 100, 2) if n_norms else np.zeros(n_buses),
+            'faltantes': n_norms - completed,
+            'instaladas': installed,
+            'renovacion': np.asarray(attributes['renovacion'], dtype='datetime64[ns]'),
+            'completo': completed == n_norms
+        },
+        'mascaras': {},
+        'lock': threading.Lock()
+    }
+
+# Función para obtener los atributos consultables de una planilla sin procesar (columnas según el mapeo)
+def frame_query_attributes(df):
+    mapping = resolve_columns(df)
+    group_cols = bus_group_columns(mapping)
+    fecha_col = mapping.get('FECHA DE RENOVACION')
+    return {
+        'interno': get_bus_ids(df),
+        'ppu': info_column_values(df, mapping.get('PPU')),
+        'terminal': info_column_values(df, group_cols['Terminal']),
+        'subclase': info_column_values(df, group_cols['Subclase']),
+        'renovacion': parse_renewal_dates(info_column_values(df, fecha_col) if fecha_col is not None else [None] * len(df))
+    }
+
+# Contexto de la planilla completa (filtros de la barra lateral); "_" excluye los argumentos de la clave
+@st.cache_resource(max_entries=8)
+def get_query_context(data_key, _df, _norm_cols):
+    return build_query_context(compute_status_matrix(_df, _norm_cols), _norm_cols, frame_query_attributes(_df))
+
+# Función para evaluar una consulta compilada (sin caché)
+def evaluate_bus_query(context, compiled):
+    if compiled['evaluar'] is None:
+        return np.ones(context['n_buses'], dtype=bool)
+    return np.broadcast_to(compiled['evaluar'](context), (context['n_buses'],)).copy()
+
+# Función para obtener la máscara de una consulta; las máscaras se guardan en el contexto
+# (de solo lectura, las más antiguas se descartan al superar QUERY_MASK_CACHE_SIZE)
+@instrumented('bus_query_mask')
+def bus_query_mask(context, text):
+    # Solo se recortan los extremos: los espacios dentro de un literal entre comillas cuentan
+    text = str(text or '').strip()
+    with context['lock']:
+        mask = context['mascaras'].pop(text, None)
+        if mask is not None:
+            context['mascaras'][text] = mask
+            return mask
+    mask = evaluate_bus_query(context, compile_bus_query(text))
+    mask.flags.writeable = False
+    with context['lock']:
+        context['mascaras'][text] = mask
+        while len(context['mascaras']) > QUERY_MASK_CACHE_SIZE:
+            context['mascaras'].pop(next(iter(context['mascaras'])))
+    return mask
+
+# Función para escribir un valor como literal de consulta (comillas simples, las internas dobladas)
+def query_quote(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+# Función para escribir la condición de normas pendientes: todas (una llamada) o alguna (or)
+def query_missing_clause(norms, match_all=True):
+    if not norms:
+        return ''
+    if match_all:
+        return f"falta({', '.join(query_quote(norm) for norm in norms)})"
+    return " or ".join(f"falta({query_quote(norm)})" for norm in norms)
+
+# Función para unir condiciones con "and" (cada una entre paréntesis si hay más de una)
+def combine_bus_queries(parts):
+    parts = [str(part).strip() for part in parts if part and str(part).strip()]
+    if len(parts) == 1:
+        return parts[0]
+    return " and ".join(f"({part})" for part in parts)
+
+# EDICIÓN DE ESTADOS
+# Las correcciones hechas en la grilla editable se guardan en la sesión como celdas cambiadas
+# (fila, norma) -> (estado, valor). Se aplican como deltas: a la planilla en memoria (para que
+# gráficos y reportes las vean) y a la matriz de estados y métricas ya calculadas, actualizando
+# solo los buses y normas tocados en vez de repetir calculate_metrics. La copia descargable de
+# la planilla se genera escribiendo solo esas celdas en el XML de la hoja, sin reescribir el libro
+# con pandas ni openpyxl, así se conservan formatos, anchos y colores.
+EDIT_MAX_ROWS = 200
+# Valor que se escribe si la columna no tiene ya un valor propio para ese estado
+EDIT_STATUS_DEFAULTS = {ESTADO_INSTALADA: 1, ESTADO_NO_APLICA: 'No aplica', ESTADO_PENDIENTE: None}
+
+# Función para obtener las correcciones de la sesión para un archivo (se descartan al cambiar de archivo)
+def get_status_edits(content_hash):
+    edits = st.session_state.get('status_edits')
+    if edits is None or edits['hash'] != content_hash:
+        edits = {'hash': content_hash, 'cambios': {}, 'version': 0}
+        st.session_state['status_edits'] = edits
+    return edits
+
+# Función para calcular la clave de las correcciones (parte de la clave de datos)
+def status_edits_key(cambios):
+    return background_data_key(sorted((str(label), str(norm), code) for (label, norm), (code, _) in cambios.items()))
+
+# Función para elegir el valor a escribir en una columna para un estado: el valor de la planilla
+# más frecuente con ese estado (respeta la convención de la columna) o el valor por defecto
+def edit_cell_value(values, code, matcher=None):
+    if code == ESTADO_PENDIENTE:
+        return None
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    if len(uniques) == 0:
+        return EDIT_STATUS_DEFAULTS[code]
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    matches = classify_status_array(np.asarray(uniques, dtype=object), matcher) == code
+    if not matches.any():
+        return EDIT_STATUS_DEFAULTS[code]
+    value = uniques[int(np.argmax(np.where(matches, counts, -1)))]
+    return value.item() if isinstance(value, np.generic) else value
+
+# Función para aplicar las correcciones a una copia de la planilla (índice original y nombre de columna)
+def apply_cell_edits(df, cambios):
+    # Copia superficial: solo se reemplazan las columnas corregidas
+    df = df.copy(deep=False)
+    by_column = {}
+    for (label, norm), (_, value) in cambios.items():
+        if label in df.index and norm in df.columns:
+            by_column.setdefault(norm, []).append((label, value))
+    for norm, cells in by_column.items():
+        # Columna nueva de tipo objeto para mezclar números y textos sin cambios de tipo implícitos
+        column = df[norm].astype(object, copy=True)
+        labels, values = zip(*cells)
+        column.loc[list(labels)] = list(values)
+        df[norm] = column
+    return df
+
+# Función para aplicar cambios de estado a métricas ya calculadas (copia; no modifica las originales)
+# Solo se recalculan los buses y normas tocados; los totales se ajustan por diferencia
+@instrumented('apply_status_changes')
+def apply_status_changes(metrics, rows, cols, codes):
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    codes = np.asarray(codes, dtype=np.int8)
+    old = metrics['status_matrix'][rows, cols]
+    changed = old != codes
+    rows, cols, codes, old = rows[changed], cols[changed], codes[changed], old[changed]
+    if len(rows) == 0:
+        return metrics
+
+    metrics = dict(metrics)
+    status = metrics['status_matrix'].copy()
+    status[rows, cols] = codes
+    metrics['status_matrix'] = status
+    n_buses, n_norms = status.shape
+    norm_cols = metrics['missing_index']['norm_cols']
+    norm_names = np.array(norm_cols, dtype=object)
+    bus_ids = metrics['bus_ids']
+
+    # Totales globales: solo cambia la diferencia de celdas completadas
+    delta = int((codes != ESTADO_PENDIENTE).sum()) - int((old != ESTADO_PENDIENTE).sum())
+    metrics['completed_installations'] += delta
+    metrics['pending_installations'] -= delta
+    metrics['efficiency'] = round(metrics['completed_installations'] / (n_buses * n_norms) * 100, 2)
+
+    # Buses tocados: avance, faltantes y estado completo
+    bus_rows = np.unique(rows)
+    row_status = status[bus_rows]
+    completed = (row_status != ESTADO_PENDIENTE).sum(axis=1)
+    installed = (row_status == ESTADO_INSTALADA).sum(axis=1)
+    not_applicable = (row_status == ESTADO_NO_APLICA).sum(axis=1)
+    progress = np.round(completed / n_norms * 100, 2)
+    sheet_counter = metrics.get('installed_counter')
+
+    progress_array = metrics['progress_array'].copy()
+    progress_array[bus_rows] = progress
+    metrics['progress_array'] = progress_array
+    bus_progress = dict(metrics['bus_progress'])
+    completion_status = dict(metrics['bus_completion_status'])
+    for k, i in enumerate(bus_rows):
+        bus_id = bus_ids[i]
+        missing = norm_names[row_status[k] == ESTADO_PENDIENTE].tolist()
+        entry = dict(bus_progress[bus_id], progress=float(progress[k]), completed=int(completed[k]),
+                     applicable_norms=n_norms - int(not_applicable[k]), completo=not missing,
+                     normas_faltantes=missing)
+        # El contador de la planilla se respeta; si no hay, es el calculado
+        if sheet_counter is None or np.isnan(sheet_counter[i]):
+            entry['normas_instaladas_contador'] = int(installed[k])
+        bus_progress[bus_id] = entry
+        if missing:
+            completion_status[bus_id] = missing
+        else:
+            completion_status.pop(bus_id, None)
+    metrics['bus_progress'] = bus_progress
+    metrics['bus_completion_status'] = completion_status
+
+    # Contexto de consultas: mismos atributos, campos derivados del estado actualizados
+    context = metrics['query_context']
+    campos = {field: values.copy() for field, values in context['campos'].items()}
+    campos['progreso'][bus_rows] = progress
+    campos['faltantes'][bus_rows] = n_norms - completed
+    campos['instaladas'][bus_rows] = installed
+    campos['completo'][bus_rows] = completed == n_norms
+    metrics['query_context'] = dict(context, status=status, campos=campos, mascaras={}, lock=threading.Lock())
+
+    complete = campos['completo']
+    metrics['complete_buses_list'] = [bus_ids[i] for i in np.flatnonzero(complete)]
+    metrics['incomplete_buses_list'] = [bus_ids[i] for i in np.flatnonzero(~complete)]
+    metrics['complete_buses'] = len(metrics['complete_buses_list'])
+    metrics['incomplete_buses'] = len(metrics['incomplete_buses_list'])
+
+    # Normas tocadas: avance por norma y bits del índice de faltantes
+    norm_progress = dict(metrics['norm_progress'])
+    for j in np.unique(cols):
+        norm_progress[norm_cols[j]] = round(float((status[:, j] != ESTADO_PENDIENTE).sum() / n_buses * 100), 2)
+    metrics['norm_progress'] = norm_progress
+    bits = metrics['missing_index']['bits'].copy()
+    bit_masks = (0x80 >> (rows & 7)).astype(np.uint8)
+    pending = codes == ESTADO_PENDIENTE
+    np.bitwise_or.at(bits, (cols[pending], rows[pending] >> 3), bit_masks[pending])
+    np.bitwise_and.at(bits, (cols[~pending], rows[~pending] >> 3), ~bit_masks[~pending])
+    metrics['missing_index'] = dict(metrics['missing_index'], bits=bits)
+    return metrics
+
+# Función para obtener las métricas de la sesión: se reutilizan mientras no cambien los datos ni
+# los filtros y las correcciones nuevas se aplican como deltas (sin repetir calculate_metrics)
+def session_metrics(base_key, df, norm_cols, cambios):
+    cache = st.session_state.get('metrics_cache')
+    if cache is None or cache['key'] != base_key or not cache['index'].equals(df.index) or cache['norm_cols'] != norm_cols:
+        cache = {'key': base_key, 'index': df.index, 'norm_cols': list(norm_cols), 'cambios': dict(cambios),
+                 'metrics': calculate_metrics(df, norm_cols)}
+        st.session_state['metrics_cache'] = cache
+        return cache['metrics']
+
+    # Celdas cuyo valor cambió desde la última aplicación (incluye correcciones descartadas)
+    touched = [cell for cell in set(cambios) | set(cache['cambios']) if cambios.get(cell) != cache['cambios'].get(cell)]
+    touched = [(label, norm) for label, norm in touched if label in df.index and norm in norm_cols]
+    if touched and 'status_matrix' in cache['metrics']:
+        rows = df.index.get_indexer([label for label, _ in touched])
+        norm_pos = {norm: j for j, norm in enumerate(norm_cols)}
+        cols = [norm_pos[norm] for _, norm in touched]
+        values = np.array([df.at[label, norm] for label, norm in touched], dtype=object)
+        cache['metrics'] = apply_status_changes(cache['metrics'], rows, cols, classify_status_array(values))
+    cache['cambios'] = dict(cambios)
+    return cache['metrics']
+
+# Función para armar la grilla editable (estados como etiquetas) de un conjunto de buses
+def status_edit_grid(metrics, rows, norm_cols):
+    labels = np.array([STATUS_LABELS[code] for code in sorted(STATUS_LABELS)], dtype=object)
+    return pd.DataFrame(labels[metrics['status_matrix'][rows]], columns=list(norm_cols),
+                        index=pd.Index(np.asarray(metrics['bus_ids'], dtype=object)[rows], name='Número Interno'))
+
+# Función para comparar la grilla original con la editada: (posición de fila, norma, estado nuevo)
+def status_grid_changes(original, edited, rows):
+    codes = {label: code for code, label in STATUS_LABELS.items()}
+    changed = (original.to_numpy() != edited.to_numpy()) & edited.notna().to_numpy()
+    return [(rows[i], original.columns[j], codes[edited.iat[i, j]]) for i, j in zip(*np.nonzero(changed))]
+
+# Función para registrar correcciones de la grilla (valor según la convención de cada columna)
+def record_status_edits(edits, df, processed_df, changes):
+    for row, norm, code in changes:
+        label = processed_df.index[row]
+        edits['cambios'][(label, norm)] = (int(code), edit_cell_value(df[norm], code))
+    edits['version'] += 1
+
+# Expresiones para recorrer el XML de una hoja sin cargarla completa (filas y celdas con referencia).
+# Los elementos pueden llevar prefijo de espacio de nombres ('x:row'), como los escribe el OpenXML SDK
+SHEET_DATA_PATTERN = re.compile(rb'<(\w+:)?sheetData\b')
+SHEET_ROW_PATTERN = re.compile(rb'<(?:\w+:)?row\b[^>]*?\br="(\d+)"[^>]*?(/?)>')
+SHEET_CELL_PATTERN = re.compile(rb'<((?:\w+:)?)c\b[^>]*?\br="([A-Z]+)\d+"[^>]*?(?:/>|>.*?</\1c>)', re.S)
+SHEET_STYLE_PATTERN = re.compile(rb'\bs="(\d+)"')
+
+# Función para convertir entre letras de columna de Excel y su número (A=1, AA=27)
+def excel_column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - 64
+    return index
+
+def excel_column_letters(index):
+    letters = ''
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+# Función para escribir el XML de una celda corregida conservando el estilo de la original
+def sheet_cell_xml(ref, style, value, prefix=''):
+    style = f' s="{style.decode()}"' if style else ''
+    c, v, is_, t = (f"{prefix}{tag}" for tag in ('c', 'v', 'is', 't'))
+    if value is None:
+        return f'<{c} r="{ref}"{style}/>'.encode()
+    if isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, bool):
+        number = int(value) if float(value).is_integer() else float(value)
+        return f'<{c} r="{ref}"{style}><{v}>{number}</{v}></{c}>'.encode()
+    text = xml_escape(str(value))
+    return f'<{c} r="{ref}"{style} t="inlineStr"><{is_}><{t} xml:space="preserve">{text}</{t}></{is_}></{c}>'.encode()
+
+# Función para reemplazar (o insertar en orden) celdas dentro del XML de una fila
+def patch_sheet_row(segment, row, values, prefix=''):
+    row_close = f'</{prefix}row>'.encode()
+    if segment.endswith(b'/>'):
+        segment = segment[:-2] + b'>' + row_close
+    pieces, position = [], 0
+    pending = sorted(values.items())
+    for match in SHEET_CELL_PATTERN.finditer(segment):
+        column = excel_column_index(match.group(2).decode())
+        while pending and pending[0][0] < column:
+            pieces.append(segment[position:match.start()])
+            position = match.start()
+            col, value = pending.pop(0)
+            pieces.append(sheet_cell_xml(f"{excel_column_letters(col)}{row}", None, value, prefix))
+        if pending and pending[0][0] == column:
+            style = SHEET_STYLE_PATTERN.search(match.group(0)[:match.group(0).find(b'>')])
+            pieces.append(segment[position:match.start()])
+            pieces.append(sheet_cell_xml(f"{match.group(2).decode()}{row}", style.group(1) if style else None,
+                                         pending.pop(0)[1], prefix))
+            position = match.end()
+    end = segment.rindex(row_close)
+    pieces.append(segment[position:end])
+    pieces.extend(sheet_cell_xml(f"{excel_column_letters(col)}{row}", None, value, prefix) for col, value in pending)
+    pieces.append(segment[end:])
+    return b''.join(pieces)
+
+# Función para aplicar celdas {(fila, columna): valor} al XML de una hoja; solo se reescriben las
+# filas tocadas y el resto del documento se copia tal cual
+def patch_sheet_xml(xml, cells):
+    by_row = {}
+    for (row, col), value in cells.items():
+        by_row.setdefault(row, {})[col] = value
+    sheet_data = SHEET_DATA_PATTERN.search(xml)
+    if sheet_data is None:
+        raise ValueError("El formato de la hoja de la planilla original no es compatible (no se encontró sheetData)")
+    # Los elementos nuevos llevan el mismo prefijo que los de la hoja
+    prefix = (sheet_data.group(1) or b'').decode()
+    row_close = f'</{prefix}row>'.encode()
+    last_row = max(by_row)
+    rows, starts = {}, []
+    for match in SHEET_ROW_PATTERN.finditer(xml):
+        row = int(match.group(1))
+        starts.append((row, match.start()))
+        if row in by_row:
+            end = match.end() if match.group(2) else xml.index(row_close, match.end()) + len(row_close)
+            rows[row] = (match.start(), end)
+        if row > last_row:
+            break
+    # Filas que no existen en el XML (vacías en la planilla): se insertan antes de la fila siguiente
+    pieces, position = [], 0
+    for row in sorted(by_row):
+        if row in rows:
+            start, end = rows[row]
+            segment = xml[start:end]
+        else:
+            following = [offset for r, offset in starts if r > row]
+            start = end = following[0] if following else xml.index(f'</{prefix}sheetData>'.encode())
+            segment = f'<{prefix}row r="{row}"/>'.encode()
+        pieces.append(xml[position:start])
+        pieces.append(patch_sheet_row(segment, row, by_row[row], prefix))
+        position = end
+    pieces.append(xml[position:])
+    return b''.join(pieces)
+
+# Función para ubicar el XML de la primera hoja del libro (la que lee load_data)
+def first_sheet_path(archive):
+    workbook_xml = archive.read('xl/workbook.xml')
+    rels = archive.read('xl/_rels/workbook.xml.rels')
+    rel_id = re.search(rb'<(?:\w+:)?sheet\b[^>]*?\br:id="([^"]+)"', workbook_xml).group(1)
+    for relationship in re.findall(rb'<Relationship\b[^>]*>', rels):
+        if re.search(rb'\bId="' + re.escape(rel_id) + rb'"', relationship):
+            target = re.search(rb'\bTarget="([^"]+)"', relationship).group(1).decode()
+            return target.lstrip('/') if target.startswith('/') else f"xl/{target}"
+    raise ValueError("No se encontró la primera hoja de la planilla original")
+
+# Función para generar una copia de la planilla con solo las celdas corregidas reescritas. El
+# encabezado se ubica con pandas leyendo solo la fila candidata (nrows=0) y las celdas se
+# escriben directamente en el XML de la hoja dentro del .xlsx: el resto del libro (formatos,
+# anchos, colores, otras hojas) se copia sin cambios y no hay que cargar ni guardar el libro completo
+@instrumented('patch_workbook_cells')
+def patch_workbook_cells(content, columns, cambios):
+    if not OPENPYXL_AVAILABLE:
+        raise ImportError("La biblioteca openpyxl (que usa pandas para leer .xlsx) no está instalada")
+    # Encabezado en la fila 1 o 2 (las mismas que prueba load_data). Los nombres se leen con pandas
+    # (sin filas de datos) para que coincidan con los del DataFrame: los repetidos quedan como
+    # "Norma.1" y cada columna corregida apunta a su propia columna de la hoja
+    names = [str(col) for col in columns]
+    header_row, header = None, {}
+    for row in (1, 2):
+        row_names = [str(col) for col in pd.read_excel(BytesIO(content), header=row - 1, nrows=0).columns]
+        if sum(name in row_names for name in names) >= len(names) // 2:
+            header_row = row
+            header = {name: j for j, name in enumerate(row_names, start=1)}
+            break
+    if header_row is None:
+        raise ValueError("No se encontró la fila de encabezados en la planilla original")
+
+    # pandas conserva las filas vacías intermedias, así que la etiqueta es el desplazamiento desde el encabezado
+    cells = {}
+    for (label, norm), (_, value) in cambios.items():
+        if str(norm) in header and int(label) >= 0:
+            cells[(header_row + 1 + int(label), header[str(norm)])] = value
+
+    buffer = BytesIO()
+    with zipfile.ZipFile(BytesIO(content)) as archive, zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as output:
+        sheet_path = first_sheet_path(archive)
+        for info in archive.infolist():
+            data = archive.read(info.filename)
+            if info.filename == sheet_path and cells:
+                data = patch_sheet_xml(data, cells)
+            output.writestr(info, data)
+    return buffer.getvalue(), len(cells)
+
+# CONSOLA SQL
+# Consultas SQL libres sobre los datos ya procesados con una conexión DuckDB en memoria (opcional).
+# Se registran dos tablas Arrow que apuntan a los arreglos existentes sin copiarlos: "buses" (las
+# columnas de información de la planilla más el avance calculado) y "estados" (formato largo, una
+# fila por bus y norma, con los códigos de la matriz de estados). La conexión se crea una vez por
+# conjunto de datos; solo se aceptan consultas SELECT y sin acceso a archivos.
+SQL_PAGE_SIZE = 100
+SQL_MAX_ROWS = 1_000_000
+SQL_RESULT_CACHE_SIZE = 16
+
+# Función para convertir una columna de la planilla a Arrow (texto si mezcla tipos)
+def sql_arrow_column(values):
+    try:
+        return pa.Array.from_pandas(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.Array.from_pandas(values.map(lambda value: None if pd.isna(value) else str(value)))
+
+# Función para construir las tablas de la consola: "buses" y "estados" (formato largo)
+def build_sql_tables(df, norm_cols, status_matrix, bus_ids):
+    n_buses, n_norms = status_matrix.shape
+    norm_set = set(norm_cols)
+    buses = {str(col): sql_arrow_column(df[col]) for col in df.columns if col not in norm_set}
+    completed = (status_matrix != ESTADO_PENDIENTE).sum(axis=1)
+    computed = {
+        'fila': np.arange(n_buses, dtype=np.int32),
+        'progreso': np.round(completed / n_norms * 100, 2) if n_norms else np.zeros(n_buses),
+        'faltantes': (n_norms - completed).astype(np.int32),
+        'instaladas': (status_matrix == ESTADO_INSTALADA).sum(axis=1).astype(np.int32),
+        'no_aplica': (status_matrix == ESTADO_NO_APLICA).sum(axis=1).astype(np.int32),
+        'completo': completed == n_norms
+    }
+    # DuckDB no distingue mayúsculas en los nombres: una columna propia de la planilla tiene prioridad
+    taken = {name.lower() for name in buses}
+    buses.update({name: pa.array(values) for name, values in computed.items() if name not in taken})
+
+    # Códigos de bus y norma como diccionarios: los índices son los mismos arreglos de filas y columnas
+    rows = pa.array(np.repeat(np.arange(n_buses, dtype=np.int32), n_norms))
+    codes = pa.array(np.ascontiguousarray(status_matrix).ravel())
+    estados = pa.table({
+        'fila': rows,
+        'bus': pa.DictionaryArray.from_arrays(rows, pa.array([str(bus) for bus in bus_ids])),
+        'norma': pa.DictionaryArray.from_arrays(pa.array(np.tile(np.arange(n_norms, dtype=np.int32), n_buses)),
+                                                pa.array([str(norm) for norm in norm_cols])),
+        'estado': pa.DictionaryArray.from_arrays(codes, pa.array([STATUS_LABELS[code] for code in sorted(STATUS_LABELS)])),
+        'codigo': codes
+    })
+    return {'buses': pa.table(buses), 'estados': estados}
+
+# Función para abrir la conexión DuckDB de la consola con las tablas registradas
+def open_sql_console(tables):
+    conn = duckdb.connect(':memory:')
+    for name, table in tables.items():
+        conn.register(name, table)
+    # Sin lectura ni escritura de archivos ni extensiones; la configuración queda bloqueada
+    conn.execute("SET enable_external_access = false")
+    conn.execute("SET lock_configuration = true")
+    return {
+        'conn': conn,
+        'tablas': tables,
+        'esquema': {name: [(field.name, str(field.type)) for field in table.schema] for name, table in tables.items()},
+        'resultados': {},
+        # Las vistas registradas son propias de la conexión: las consultas se ejecutan de a una
+        'lock': threading.Lock()
+    }
+
+# Consola compartida por conjunto de datos; "_" excluye los argumentos de la clave
+@st.cache_resource(max_entries=4)
+def get_sql_console(data_key, _df, _norm_cols, _status_matrix, _bus_ids):
+    return open_sql_console(build_sql_tables(_df, _norm_cols, _status_matrix, _bus_ids))
+
+# Función para validar el texto de la consola: una sola sentencia SELECT
+def sql_statement(console, text):
+    try:
+        statements = console['conn'].extract_statements(text)
+    except duckdb.Error as e:
+        raise ValueError(str(e).splitlines()[0])
+    if len(statements) != 1:
+        raise ValueError("Escribe una sola consulta")
+    if statements[0].type != duckdb.StatementType.SELECT:
+        raise ValueError("Solo se permiten consultas SELECT")
+    return statements[0].query.strip()
+
+# Función para ejecutar una consulta de la consola; los resultados (tablas Arrow) se guardan en la
+# consola y los más antiguos se descartan al superar SQL_RESULT_CACHE_SIZE
+@instrumented('run_sql_query')
+def run_sql_query(console, text):
+    query = sql_statement(console, text)
+    with console['lock']:
+        result = console['resultados'].pop(query, None)
+        if result is None:
+            start = time.perf_counter()
+            try:
+                cursor = console['conn'].execute(f"SELECT * FROM (\n{query}\n) LIMIT {SQL_MAX_ROWS + 1}")
+                table = getattr(cursor, 'to_arrow_table', cursor.fetch_arrow_table)()
+            except duckdb.Error as e:
+                raise ValueError(str(e).splitlines()[0])
+            result = {
+                'tabla': table.slice(0, SQL_MAX_ROWS),
+                'truncado': table.num_rows > SQL_MAX_ROWS,
+                'segundos': time.perf_counter() - start
+            }
+        console['resultados'][query] = result
+        while len(console['resultados']) > SQL_RESULT_CACHE_SIZE:
+            console['resultados'].pop(next(iter(console['resultados'])))
+    return result
+
+# Función para obtener una página del resultado (solo esas filas se convierten a pandas)
+def sql_result_page(result, page):
+    return result['tabla'].slice((page - 1) * SQL_PAGE_SIZE, SQL_PAGE_SIZE).to_pandas()
+
+# Función para escribir el resultado completo como CSV directamente desde Arrow
+def sql_result_csv(result):
+    buffer = pa.BufferOutputStream()
+    pa_csv.write_csv(result['tabla'], buffer)
+    return buffer.getvalue().to_pybytes()
+
+# Función para proponer consultas de ejemplo según las columnas de la planilla
+def sql_examples(console):
+    columns = [name for name, _ in console['esquema']['buses']]
+    group = next((col for col in ('Terminal', 'Subclase') if col in columns), None)
+    examples = [
+        "SELECT norma, count(*) FILTER (WHERE estado = 'Pendiente') AS pendientes,\n"
+        "       round(avg((codigo <> 0)::INT) * 100, 2) AS avance\n"
+        "FROM estados GROUP BY norma ORDER BY avance LIMIT 20"
+    ]
+    if group is not None:
+        examples.insert(0, f'SELECT "{group}", count(*) AS buses, round(avg(progreso), 2) AS avance,\n'
+                           f'       sum(completo::INT) AS completos\n'
+                           f'FROM buses GROUP BY "{group}" ORDER BY avance')
+    examples.append("SELECT b.*, e.norma FROM buses b JOIN estados e USING (fila)\n"
+                    "WHERE e.estado = 'Pendiente' AND b.faltantes = 1")
+    return examples
+
+# METADATOS DE NORMAS
+# Tabla opcional por norma (peso, costo, minutos de instalación y prioridad) para que una
+# calcomanía y un ploteo completo no cuenten igual. Se une una sola vez a las columnas de normas
+# (nombres normalizados) y queda como una matriz normas x medidas (1, peso, costo, horas); las
+# medidas restantes de cada bus salen de un solo producto de la matriz de pendientes por esa
+# matriz, y se agregan por Terminal y Subclase con bincount. Las normas sin fila en la tabla
+# usan peso 1, costo 0 y 0 minutos.
+NORM_METADATA_PATH = os.environ.get(
+    'NORMAS_METADATOS',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'normas_metadatos.csv')
+)
+
+# Columnas de la tabla con sus alias (encabezados normalizados) y valores por defecto
+NORM_METADATA_COLUMNS = {
+    'Norma': ['norma', 'normas', 'nombre', 'columna'],
+    'Peso': ['peso', 'ponderacion', 'weight'],
+    'Costo': ['costo', 'precio', 'valor', 'cost'],
+    'Minutos': ['minutos', 'minutos instalacion', 'tiempo', 'duracion', 'minutes'],
+    'Prioridad': ['prioridad', 'priority']
+}
+NORM_METADATA_DEFAULTS = {'Peso': 1.0, 'Costo': 0.0, 'Minutos': 0.0}
+# Medidas de la matriz normas x medidas (la primera columna cuenta las normas pendientes)
+WEIGHTED_MEASURES = ['pendientes', 'peso', 'costo', 'horas']
+NO_PRIORITY_LABEL = "Sin prioridad"
+
+# Función para convertir una columna numérica de la tabla (acepta coma decimal); error si hay textos
+def _metadata_numbers(values, column):
+    text = values.astype(object).where(values.notna(), None)
+    text = text.map(lambda value: value.strip().replace(',', '.') if isinstance(value, str) else value)
+    numbers = pd.to_numeric(text.replace('', None), errors='coerce')
+    invalid = numbers.isna() & text.notna() & (text != '')
+    if invalid.any():
+        raise ValueError(f"Valores no numéricos en '{column}': " + ", ".join(map(repr, text[invalid].head(5))))
+    if (numbers < 0).any():
+        raise ValueError(f"La columna '{column}' no admite valores negativos")
+    return numbers.astype(float)
+
+# Función para leer la tabla de metadatos desde CSV, Excel o JSON (ruta o archivo subido)
+def read_norm_metadata(source, name=None):
+    name = (name or str(source)).lower()
+    if name.endswith(('.xlsx', '.xls')):
+        table = pd.read_excel(source)
+    elif name.endswith('.json'):
+        if hasattr(source, 'read'):
+            content = source.read()
+            content = content.decode('utf-8') if isinstance(content, bytes) else content
+        else:
+            with open(source, encoding='utf-8') as f:
+                content = f.read()
+        records = json.loads(content)
+        # Lista de filas o un objeto {norma: {peso: ..., costo: ...}}
+        if isinstance(records, dict):
+            records = [dict(values, Norma=norm) for norm, values in records.items()]
+        table = pd.DataFrame(records)
+    else:
+        # Separador detectado (coma o punto y coma, como exporta Excel en español)
+        table = pd.read_csv(source, sep=None, engine='python', dtype=object)
+
+    renames = {}
+    for col in table.columns:
+        key = normalize_column_name(col)
+        role = next((role for role, aliases in NORM_METADATA_COLUMNS.items()
+                     if key == normalize_column_name(role) or key in aliases), None)
+        if role is not None and role not in renames.values():
+            renames[col] = role
+    table = table.rename(columns=renames)[list(renames.values())]
+    if 'Norma' not in table.columns:
+        raise ValueError("La tabla de metadatos debe tener una columna 'Norma'")
+    if not any(col in table.columns for col in ('Peso', 'Costo', 'Minutos', 'Prioridad')):
+        raise ValueError("La tabla de metadatos debe tener al menos una de las columnas: Peso, Costo, Minutos, Prioridad")
+
+    table = table[table['Norma'].notna()].copy()
+    table['Norma'] = table['Norma'].astype(str).str.strip()
+    duplicated = table['Norma'].map(normalize_column_name).duplicated()
+    if duplicated.any():
+        raise ValueError("Normas repetidas en la tabla de metadatos: " + ", ".join(table.loc[duplicated, 'Norma'].head(5)))
+    for col in NORM_METADATA_DEFAULTS:
+        table[col] = _metadata_numbers(table[col], col) if col in table.columns else np.nan
+    if 'Prioridad' not in table.columns:
+        table['Prioridad'] = None
+    table['Prioridad'] = table['Prioridad'].astype(object).where(table['Prioridad'].notna(), None)
+    return table[list(NORM_METADATA_COLUMNS)].reset_index(drop=True)
+
+# Función para cargar la tabla de metadatos por defecto (archivo junto a app.py); None si no existe
+def load_norm_metadata(path=None):
+    path = path or NORM_METADATA_PATH
+    if os.path.exists(path):
+        return read_norm_metadata(path)
+    return None
+
+# Función para obtener la tabla de metadatos activa (la cargada en la sesión o la por defecto)
+def get_norm_metadata():
+    try:
+        table = st.session_state.get('norm_metadata')
+    except Exception:
+        table = None
+    return table if table is not None else load_norm_metadata()
+
+# Función para calcular la clave de la tabla de metadatos (parte de la clave de las métricas ponderadas)
+def norm_metadata_key(table):
+    return background_data_key(table.to_dict('records')) if table is not None else None
+
+# Función para armar una plantilla de metadatos con las normas de la planilla (valores por defecto)
+def norm_metadata_template(norm_cols, table=None):
+    template = pd.DataFrame({'Norma': list(norm_cols)})
+    aligned = align_norm_metadata(table, norm_cols)
+    template['Peso'] = aligned['medidas'][:, WEIGHTED_MEASURES.index('peso')]
+    template['Costo'] = aligned['medidas'][:, WEIGHTED_MEASURES.index('costo')]
+    template['Minutos'] = aligned['medidas'][:, WEIGHTED_MEASURES.index('horas')] * 60
+    template['Prioridad'] = aligned['prioridad']
+    return template
+
+# Función para unir la tabla a las columnas de normas: matriz normas x medidas y prioridad de cada norma
+def align_norm_metadata(table, norm_cols):
+    keys = [normalize_column_name(col) for col in norm_cols]
+    known = set(keys)
+    if table is None or table.empty:
+        joined = pd.DataFrame(index=keys, columns=list(NORM_METADATA_COLUMNS), dtype=object)
+    else:
+        joined = table.set_index(table['Norma'].map(normalize_column_name)).reindex(keys)
+    matched = joined['Norma'].notna().to_numpy()
+    values = {col: pd.to_numeric(joined[col], errors='coerce').fillna(default).to_numpy(dtype=float)
+              for col, default in NORM_METADATA_DEFAULTS.items()}
+    medidas = np.column_stack([np.ones(len(keys)), values['Peso'], values['Costo'], values['Minutos'] / 60])
+    prioridad = joined['Prioridad'].astype(object).where(joined['Prioridad'].notna(), None).to_numpy(dtype=object)
+    return {
+        'norm_cols': list(norm_cols),
+        'medidas': medidas,
+        'prioridad': prioridad,
+        'sin_datos': [col for col, found in zip(norm_cols, matched) if not found],
+        'sin_usar': [] if table is None else [norm for norm in table['Norma'] if normalize_column_name(norm) not in known]
+    }
+
+# Función para calcular las métricas ponderadas: un solo producto pendientes (buses x normas) por
+# la matriz de medidas (normas x medidas) da pendientes, peso, costo y horas restantes por bus
+@instrumented('weighted_metrics')
+def weighted_metrics(status_matrix, aligned):
+    n_buses, n_norms = status_matrix.shape
+    medidas = aligned['medidas']
+    pending = status_matrix == ESTADO_PENDIENTE
+    restante = pending.astype(np.float64) @ medidas
+    pendientes, peso, costo, horas = (restante[:, j] for j in range(len(WEIGHTED_MEASURES)))
+    peso_total = float(medidas[:, WEIGHTED_MEASURES.index('peso')].sum())
+
+    # Eficiencias como en calculate_metrics: No Aplica cuenta como completada
+    with np.errstate(divide='ignore', invalid='ignore'):
+        avance = (1 - pendientes / n_norms) * 100 if n_norms else np.full(n_buses, 100.0)
+        avance_ponderado = (1 - peso / peso_total) * 100 if peso_total > 0 else np.full(n_buses, np.nan)
+    cells = n_buses * n_norms
+    result = {
+        'pendientes': pendientes,
+        'peso_restante': peso,
+        'costo': costo,
+        'horas': horas,
+        'avance': np.round(avance, 2),
+        'avance_ponderado': np.round(avance_ponderado, 2),
+        'peso_total': peso_total,
+        'total_normas': n_norms,
+        'eficiencia': round((1 - pendientes.sum() / cells) * 100, 2) if cells else 0,
+        'eficiencia_ponderada': (round((1 - peso.sum() / (n_buses * peso_total)) * 100, 2)
+                                 if n_buses and peso_total > 0 else None),
+        'costo_restante': float(costo.sum()),
+        'horas_restantes': float(horas.sum())
+    }
+
+    # Restante por prioridad: buses pendientes de cada norma por costo y horas de la norma
+    pending_by_norm = pending.sum(axis=0)
+    labels = np.array([NO_PRIORITY_LABEL if value is None else str(value) for value in aligned['prioridad']], dtype=object)
+    names = sorted(set(labels), key=lambda label: (label == NO_PRIORITY_LABEL, natural_sort_key(label)))
+    position = {label: k for k, label in enumerate(names)}
+    codes = np.array([position[label] for label in labels], dtype=np.int64)
+    result['prioridades'] = pd.DataFrame({
+        'Prioridad': names,
+        'Normas': np.bincount(codes, minlength=len(names)),
+        'Pendientes': np.bincount(codes, weights=pending_by_norm, minlength=len(names)).astype(np.int64),
+        'Costo Restante': np.bincount(codes, weights=pending_by_norm * medidas[:, WEIGHTED_MEASURES.index('costo')],
+                                      minlength=len(names)),
+        'Horas Restantes': np.round(np.bincount(codes, weights=pending_by_norm * medidas[:, WEIGHTED_MEASURES.index('horas')],
+                                                minlength=len(names)), 1)
+    })
+    return result
+
+# Función para agregar las métricas ponderadas por grupo (Terminal o Subclase) con bincount
+def weighted_group_summary(weighted, values, group_col):
+    codes, labels = pd.factorize(np.asarray(values, dtype=object))
+    n_groups = len(labels)
+    buses = np.bincount(codes, minlength=n_groups)
+
+    def total(weights):
+        return np.bincount(codes, weights=weights, minlength=n_groups)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eficiencia = (1 - total(weighted['pendientes']) / (buses * weighted['total_normas'])) * 100
+        ponderada = (1 - total(weighted['peso_restante']) / (buses * weighted['peso_total'])) * 100
+    summary = pd.DataFrame({
+        group_col: labels,
+        'Buses': buses,
+        'Eficiencia (%)': np.round(eficiencia, 2),
+        'Eficiencia Ponderada (%)': np.round(ponderada, 2),
+        'Costo Restante': total(weighted['costo']),
+        'Horas Restantes': np.round(total(weighted['horas']), 1)
+    })
+    return summary.sort_values(['Costo Restante', group_col], ascending=[False, True], kind='stable').reset_index(drop=True)
+
+# Función para armar la tabla por bus de las métricas ponderadas (mayor costo restante primero)
+def weighted_bus_table(metrics, weighted):
+    info = metrics['bus_progress']
+    bus_ids = metrics['bus_ids']
+    table = pd.DataFrame({
+        'Número Interno': bus_ids,
+        'Terminal': [info[bus_id]['terminal'] for bus_id in bus_ids],
+        'Subclase': [info[bus_id]['subclase'] for bus_id in bus_ids],
+        'Progreso': weighted['avance'],
+        'Progreso Ponderado': weighted['avance_ponderado'],
+        'Normas Faltantes': weighted['pendientes'].astype(np.int64),
+        'Costo Restante': weighted['costo'],
+        'Horas Restantes': np.round(weighted['horas'], 1)
+    })
+    return table.sort_values(['Costo Restante', 'Progreso Ponderado'], ascending=[False, True], kind='stable').reset_index(drop=True)
+
+# Métricas ponderadas compartidas entre ejecuciones (clave: datos con correcciones y tabla de metadatos)
+@st.cache_resource(max_entries=8)
+def get_weighted_metrics(data_key, metadata_key, _status_matrix, _norm_cols, _table):
+    aligned = align_norm_metadata(_table, _norm_cols)
+    return aligned, weighted_metrics(_status_matrix, aligned)
+
+# DISTRIBUCIÓN DEL AVANCE
+# Estadísticas del avance por bus calculadas con NumPy sobre el arreglo de avance de
+# calculate_metrics: promedio y desviación en una pasada (sumas), cuantiles, rangos con límites
+# configurables y las mismas medidas por Terminal y Subclase (ordenando una vez por grupo).
+# Límites internos de los rangos de avance (%); los extremos 0 y 100 siempre se agregan
+PROGRESS_BUCKET_EDGES = [int(edge) for edge in os.environ.get('NORMAS_RANGOS_AVANCE', '25,50,70,90').split(',') if edge.strip()]
+PROGRESS_QUANTILES = [0.25, 0.5, 0.75]
+
+# Función para interpretar límites de rangos escritos como texto ("25, 50, 70, 90")
+def parse_bucket_edges(text):
+    try:
+        edges = sorted({int(float(edge)) for edge in re.split(r'[,;\s]+', str(text)) if edge.strip()})
+    except ValueError:
+        raise ValueError(f"Límites de rangos no válidos: '{text}'")
+    if not edges or edges[0] <= 0 or edges[-1] >= 100:
+        raise ValueError("Los límites deben ser números entre 1 y 99")
+    return edges
+
+# Función para calcular los cuantiles de varios grupos a la vez sobre valores ordenados por grupo
+# (interpolación lineal, igual que np.quantile)
+def _grouped_quantiles(sorted_values, starts, counts, q):
+    position = starts + q * np.maximum(counts - 1, 0)
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, starts + np.maximum(counts - 1, 0))
+    weight = position - lower
+    return sorted_values[lower] * (1 - weight) + sorted_values[upper] * weight
+
+# Función para contar los buses de cada rango de avance (el último rango incluye el 100%)
+def progress_buckets(progress, edges=None):
+    edges = [0] + list(edges or PROGRESS_BUCKET_EDGES) + [100]
+    counts = np.bincount(np.clip(np.searchsorted(edges, progress, side='right') - 1, 0, len(edges) - 2),
+                         minlength=len(edges) - 1)
+    labels = [f"{lo}-{hi - 1}%" for lo, hi in zip(edges[:-2], edges[1:-1])] + [f"{edges[-2]}-100%"]
+    buckets = pd.DataFrame({
+        'Rango': labels,
+        'Desde': edges[:-1],
+        'Buses': counts,
+        'Porcentaje': np.round(counts / max(len(progress), 1) * 100, 1)
+    })
+    # De mayor a menor avance, como en los gráficos del dashboard
+    return buckets.iloc[::-1].reset_index(drop=True)
+
+# Función para resumir el avance por grupo (Terminal, Subclase): una fila por valor del grupo
+def grouped_progress_stats(progress, groups):
+    names, codes = np.unique(np.asarray(groups, dtype=object).astype(str), return_inverse=True)
+    codes = codes.ravel()
+    counts = np.bincount(codes, minlength=len(names))
+    sums = np.bincount(codes, weights=progress, minlength=len(names))
+    squares = np.bincount(codes, weights=progress * progress, minlength=len(names))
+    mean = sums / np.maximum(counts, 1)
+    std = np.sqrt(np.maximum(squares / np.maximum(counts, 1) - mean * mean, 0))
+
+    order = np.lexsort((progress, codes))
+    sorted_values = progress[order]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    result = pd.DataFrame({'Grupo': names, 'Buses': counts, 'Promedio': np.round(mean, 1), 'Desv. Estándar': np.round(std, 1)})
+    result['Mínimo'] = sorted_values[starts]
+    for q in PROGRESS_QUANTILES:
+        result[f"P{int(q * 100)}"] = np.round(_grouped_quantiles(sorted_values, starts, counts, q), 1)
+    result['Máximo'] = sorted_values[starts + counts - 1]
+    return result.rename(columns={'P50': 'Mediana'})
+
+# Función para calcular la distribución completa del avance por bus
+@instrumented('progress_distribution')
+def progress_distribution(progress, edges=None, groups=None):
+    progress = np.asarray(progress, dtype=float)
+    count = len(progress)
+    distribution = {'count': count, 'buckets': progress_buckets(progress, edges), 'groups': {}}
+    if count == 0:
+        distribution.update({'mean': None, 'std': None, 'min': None, 'max': None,
+                             'quantiles': {q: None for q in PROGRESS_QUANTILES}})
+        return distribution
+
+    # Promedio y desviación estándar (poblacional) a partir de la suma y la suma de cuadrados
+    total = progress.sum()
+    mean = total / count
+    distribution['mean'] = float(mean)
+    distribution['std'] = float(np.sqrt(max((progress * progress).sum() / count - mean * mean, 0)))
+    # Mínimo, cuantiles y máximo en una sola llamada
+    values = np.quantile(progress, [0] + PROGRESS_QUANTILES + [1])
+    distribution['min'] = float(values[0])
+    distribution['max'] = float(values[-1])
+    distribution['quantiles'] = {q: float(value) for q, value in zip(PROGRESS_QUANTILES, values[1:-1])}
+    for group_col, group_values in (groups or {}).items():
+        distribution['groups'][group_col] = grouped_progress_stats(progress, group_values)
+    return distribution
+
+# FECHAS DE RENOVACIÓN
+# La columna FECHA DE RENOVACION llega mezclada: fechas de Excel, números de serie de Excel
+# (como número o texto) y textos dd/mm/aaaa o aaaa-mm-dd. Se interpreta una sola vez en
+# calculate_metrics a datetime64 (factorizando: cada valor distinto se interpreta una vez) y
+# sobre ese arreglo se calculan vencimientos, avance por mes de renovación y el burn-down.
+# Origen de los números de serie de Excel (sistema 1900, con el 29/02/1900 ficticio)
+EXCEL_EPOCH = np.datetime64('1899-12-30', 'D')
+# Rango de números de serie aceptados como fecha (1950-01-01 a 2099-12-31)
+EXCEL_SERIAL_RANGE = (18264, 73050)
+RENEWAL_DATE_FORMATS = ['%d/%m/%Y', '%d-%m-%Y', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%d/%m/%y', '%d.%m.%Y']
+RENEWAL_WINDOW_DAYS = 90
+RENEWAL_BURNDOWN_MAX_WEEKS = 156
+
+# Función para interpretar valores únicos de fecha (objetos fecha, números de serie y textos)
+def _parse_date_values(values):
+    values = pd.Series(values, dtype=object)
+    parsed = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+
+    # Fechas ya leídas como fecha por read_excel
+    is_date = values.map(lambda v: isinstance(v, (datetime, np.datetime64))).to_numpy(dtype=bool)
+    if is_date.any():
+        parsed[is_date] = pd.to_datetime(values[is_date], errors='coerce')
+
+    # Números de serie de Excel (como número o como texto)
+    serials = pd.to_numeric(values.where(~is_date), errors='coerce')
+    is_serial = serials.between(*EXCEL_SERIAL_RANGE).to_numpy()
+    if is_serial.any():
+        days = np.floor(serials[is_serial].to_numpy(dtype=float)).astype('timedelta64[D]')
+        parsed[is_serial] = (EXCEL_EPOCH + days).astype('datetime64[ns]')
+
+    # Textos: formatos conocidos de a uno (vectorizado) y, al final, interpretación libre
+    pending = ~is_date & ~is_serial & values.notna().to_numpy()
+    if pending.any():
+        text = values[pending].astype(str).str.strip()
+        for date_format in RENEWAL_DATE_FORMATS:
+            todo = parsed[text.index].isna()
+            if not todo.any():
+                break
+            parsed[todo[todo].index] = pd.to_datetime(text[todo], format=date_format, errors='coerce')
+        todo = parsed[text.index].isna()
+        if todo.any():
+            parsed[todo[todo].index] = pd.to_datetime(text[todo], format='mixed', dayfirst=True, errors='coerce')
+    return parsed.dt.normalize().to_numpy(dtype='datetime64[ns]')
+
+# Función para interpretar una columna de fechas a datetime64[ns] (NaT si no se puede)
+@instrumented('parse_renewal_dates')
+def parse_renewal_dates(values):
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    # Los vacíos llegan con código -1, que apunta al NaT agregado al final
+    lookup = np.append(_parse_date_values(np.asarray(uniques, dtype=object)), np.datetime64('NaT', 'ns'))
+    return lookup[codes]
+
+# Función para formatear fechas interpretadas (dd/mm/aaaa); sin fecha se conserva el valor original
+def format_renewal_dates(values, dates=None):
+    values = np.asarray(values, dtype=object)
+    dates = parse_renewal_dates(values) if dates is None else dates
+    text = pd.Series(dates).dt.strftime('%d/%m/%Y').to_numpy(dtype=object)
+    return np.where(np.isnat(dates), values, text)
+
+# Función para obtener la fecha de hoy como datetime64[D]
+def _today(today=None):
+    return np.datetime64(today or datetime.now().date(), 'D')
+
+# Función para armar la tabla base de renovaciones (una fila por bus)
+def renewal_frame(metrics, today=None):
+    status = metrics['status_matrix']
+    dates = metrics['renewal_dates'].astype('datetime64[D]')
+    days_left = (dates - _today(today)).astype('timedelta64[D]').astype(float)
+    days_left[np.isnat(dates)] = np.nan
+    info = [metrics['bus_progress'][bus_id] for bus_id in metrics['bus_ids']]
+    return pd.DataFrame({
+        'N° Interno': metrics['bus_ids'],
+        'PPU': [bus['ppu'] for bus in info],
+        'Terminal': [bus['terminal'] for bus in info],
+        'Fecha Renovación': pd.to_datetime(dates),
+        'Días Restantes': days_left,
+        'Progreso': [bus['progress'] for bus in info],
+        'Instalaciones Pendientes': (status == ESTADO_PENDIENTE).sum(axis=1),
+        'Completo': np.array([bus['completo'] for bus in info], dtype=bool)
+    })
+
+# Función para listar los buses que se renuevan dentro de N días (incluye los vencidos)
+@instrumented('buses_due_for_renewal')
+def buses_due_for_renewal(metrics, days=RENEWAL_WINDOW_DAYS, today=None, only_incomplete=True):
+    frame = renewal_frame(metrics, today)
+    mask = (frame['Días Restantes'] <= days).to_numpy()
+    if only_incomplete:
+        mask &= ~frame['Completo'].to_numpy()
+    due = frame[mask].sort_values(['Días Restantes', 'N° Interno'], kind='stable')
+    due.insert(4, 'Estado Renovación', np.where(due['Días Restantes'] < 0, 'Vencida', 'Por vencer'))
+    due['Días Restantes'] = due['Días Restantes'].astype(int)
+    return due.drop(columns=['Completo']).reset_index(drop=True)
+
+# Función para calcular el avance por mes de renovación (buses sin fecha en una fila aparte)
+@instrumented('completion_by_renewal_month')
+def completion_by_renewal_month(metrics):
+    columns = ['Mes Renovación', 'Buses', 'Completos', '% Completos', 'Instalaciones Pendientes']
+    dates = metrics['renewal_dates']
+    valid = ~np.isnat(dates)
+    complete = np.array([metrics['bus_progress'][bus_id]['completo'] for bus_id in metrics['bus_ids']], dtype=bool)
+    pending = (metrics['status_matrix'] == ESTADO_PENDIENTE).sum(axis=1)
+
+    months, inverse = np.unique(dates[valid].astype('datetime64[M]'), return_inverse=True)
+    buses = np.bincount(inverse, minlength=len(months))
+    completos = np.bincount(inverse, weights=complete[valid], minlength=len(months)).astype(int)
+    pendientes = np.bincount(inverse, weights=pending[valid], minlength=len(months)).astype(int)
+    result = pd.DataFrame({
+        'Mes Renovación': months.astype(str),
+        'Buses': buses,
+        'Completos': completos,
+        '% Completos': np.round(completos / np.maximum(buses, 1) * 100, 1),
+        'Instalaciones Pendientes': pendientes
+    }, columns=columns)
+
+    if (~valid).any():
+        sin_fecha = int((~valid).sum())
+        completos_sin_fecha = int(complete[~valid].sum())
+        result.loc[len(result)] = ['Sin fecha', sin_fecha, completos_sin_fecha,
+                                   round(completos_sin_fecha / sin_fecha * 100, 1), int(pending[~valid].sum())]
+    return result
+
+# Función para proyectar el burn-down de instalaciones pendientes (semanal, días hábiles)
+# - 'Pendientes Proyectadas': lo que queda si se instalan daily_capacity normas por día hábil
+# - 'Máximo por Renovaciones': lo que puede quedar pendiente sin pasar ninguna fecha de renovación
+#   (los buses sin fecha no tienen plazo y siempre cuentan)
+@instrumented('renewal_burndown')
+def renewal_burndown(metrics, daily_capacity, today=None):
+    today = _today(today)
+    daily_capacity = max(float(daily_capacity), 1.0)
+    dates = metrics['renewal_dates'].astype('datetime64[D]')
+    pending = (metrics['status_matrix'] == ESTADO_PENDIENTE).sum(axis=1)
+    total = int(pending.sum())
+
+    # Fecha estimada de término a la capacidad indicada
+    workdays = int(np.ceil(total / daily_capacity))
+    finish = np.busday_offset(today, workdays, roll='forward')
+
+    # Horizonte: hasta el término estimado o la última renovación con pendientes (con tope)
+    has_pending = (pending > 0) & ~np.isnat(dates)
+    end = max(finish, dates[has_pending].max() if has_pending.any() else today)
+    end = min(end, today + np.timedelta64(7 * RENEWAL_BURNDOWN_MAX_WEEKS, 'D'))
+    weeks = np.arange(today, end + np.timedelta64(7, 'D'), np.timedelta64(7, 'D'))
+
+    projected = np.maximum(total - daily_capacity * np.busday_count(today, weeks), 0)
+    # Pendientes con plazo ordenados por fecha; en cada semana se descuenta lo que ya debió quedar listo
+    order = np.argsort(dates[has_pending], kind='stable')
+    due_dates = dates[has_pending][order]
+    due_cumulative = np.concatenate([[0], np.cumsum(pending[has_pending][order])])
+    allowed = total - due_cumulative[np.searchsorted(due_dates, weeks, side='right')]
+
+    burndown = pd.DataFrame({
+        'Semana': pd.to_datetime(weeks),
+        'Pendientes Proyectadas': np.round(projected).astype(int),
+        'Máximo por Renovaciones': allowed.astype(int)
+    })
+    return burndown, pd.Timestamp(finish)
+
+# PRONÓSTICO DE TÉRMINO
+# Cada planilla procesada es un corte con fecha. De cada corte se toman las normas instaladas y
+# requeridas de la flota, de cada terminal y de cada norma, y se suman a una regresión lineal
+# en línea (n, Σt, Σy, Σt², Σty, Σy²) guardada en SQLite: un corte nuevo actualiza las sumas
+# sin volver a ajustar sobre el historial. La pendiente es la velocidad de instalación y su
+# error estándar da la banda de confianza de la fecha de término. Las series se separan por
+# flota (firma de las columnas de información de la planilla), así planillas de otras flotas o
+# de prueba no se mezclan en la misma regresión; los cortes se pueden borrar uno a uno.
+# El historial se acumula durante semanas: vive en un directorio de datos del usuario, no en la
+# caché temporal (REPORT_CACHE_DIR) que el sistema puede borrar
+FORECAST_DB_PATH = os.environ.get('NORMAS_HISTORIAL', '')
+FORECAST_DATA_DIR = os.environ.get('NORMAS_DATOS_DIR', os.path.join(os.path.expanduser('~'), '.normas_graficas'))
+# Origen del eje de tiempo (días) para que las sumas de t² no pierdan precisión
+FORECAST_ORIGIN = np.datetime64('2020-01-01T00:00:00')
+# Cuantil 97,5% de la t de Student por grados de libertad (1 a 30) para la banda de confianza del 95%;
+# con pocos cortes la banda debe ser mucho más ancha que con el cuantil normal (1,96)
+FORECAST_T_975 = np.array([12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+                           2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+                           2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042])
+FORECAST_Z = 1.96
+# Fechas estimadas más allá de este horizonte (días desde el último corte) se informan sin fecha
+FORECAST_MAX_DAYS = 365 * 50
+FORECAST_SERIES_TYPES = ['Flota', 'Terminal', 'Norma']
+
+# Función para obtener la ruta de la base de historial
+def forecast_db_path():
+    return FORECAST_DB_PATH or os.path.join(FORECAST_DATA_DIR, 'historial_cortes.sqlite')
+
+# Función para obtener el cuantil t de la banda para n - 2 grados de libertad (vectorizado). Sobre
+# 30 grados se interpola en 1/gl hacia el cuantil normal (error menor a 0,001)
+def forecast_t_quantile(dof):
+    dof = np.asarray(dof, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table = FORECAST_T_975[np.clip(dof, 1, len(FORECAST_T_975)).astype(int) - 1]
+        tail = FORECAST_Z + (FORECAST_T_975[-1] - FORECAST_Z) * len(FORECAST_T_975) / dof
+    return np.where(dof < 1, np.nan, np.where(dof <= len(FORECAST_T_975), table, tail))
+
+# Función para convertir una fecha a días desde el origen del pronóstico
+def forecast_days(fecha):
+    return float((np.datetime64(pd.Timestamp(fecha).to_datetime64(), 's') - FORECAST_ORIGIN) / np.timedelta64(1, 'D'))
+
+# Función para convertir días desde el origen a fecha
+def forecast_date(days):
+    return pd.Timestamp(FORECAST_ORIGIN) + pd.to_timedelta(days, unit='D')
+
+# Función para calcular las series de un corte: serie -> (instaladas, requeridas)
+def snapshot_series(status_matrix, norm_cols, terminals):
+    installed = status_matrix == ESTADO_INSTALADA
+    required = status_matrix != ESTADO_NO_APLICA
+    series = {('Flota', 'Flota'): (int(installed.sum()), int(required.sum()))}
+    for norm, done, total in zip(norm_cols, installed.sum(axis=0), required.sum(axis=0)):
+        series[('Norma', str(norm))] = (int(done), int(total))
+    names, inverse = np.unique(np.asarray(terminals, dtype=object).astype(str), return_inverse=True)
+    done = np.bincount(inverse.ravel(), weights=installed.sum(axis=1), minlength=len(names))
+    total = np.bincount(inverse.ravel(), weights=required.sum(axis=1), minlength=len(names))
+    for name, d, t in zip(names, done, total):
+        series[('Terminal', str(name))] = (int(d), int(t))
+    return series
+
+# Función para identificar la flota de una planilla: firma de sus columnas de información (las
+# columnas de normas pueden cambiar entre cortes sin cortar la serie)
+def snapshot_fleet_key(columns, norm_cols):
+    norms = set(norm_cols)
+    return header_signature([col for col in columns if col not in norms])
+
+# Función para abrir (o crear) la base de historial de cortes
+def open_forecast_store(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    # Historial anterior a la separación por flota: sus cortes quedan en la flota '' y las sumas se rehacen
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(cortes)")]
+    migrate = bool(columns) and 'flota' not in columns
+    if migrate:
+        conn.executescript("""
+            ALTER TABLE cortes ADD COLUMN flota TEXT NOT NULL DEFAULT '';
+            ALTER TABLE puntos ADD COLUMN flota TEXT NOT NULL DEFAULT '';
+            DROP TABLE IF EXISTS series;
+        """)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS cortes (hash TEXT PRIMARY KEY, nombre TEXT, t REAL, registrado TEXT,
+                                           flota TEXT NOT NULL DEFAULT '');
+        CREATE TABLE IF NOT EXISTS puntos (hash TEXT, tipo TEXT, serie TEXT, t REAL, y REAL, requeridas REAL,
+                                           flota TEXT NOT NULL DEFAULT '', PRIMARY KEY (hash, tipo, serie));
+        CREATE TABLE IF NOT EXISTS series (flota TEXT, tipo TEXT, serie TEXT, n REAL, st REAL, sy REAL, stt REAL,
+                                           sty REAL, syy REAL, ultimo_t REAL, ultimo_y REAL, requeridas REAL,
+                                           PRIMARY KEY (flota, tipo, serie));
+        CREATE INDEX IF NOT EXISTS puntos_flota_serie ON puntos (flota, tipo, serie, t);
+    """)
+    if migrate:
+        with conn:
+            conn.execute("""
+                INSERT INTO series (flota, tipo, serie, n, st, sy, stt, sty, syy, ultimo_t, ultimo_y, requeridas)
+                SELECT flota, tipo, serie, COUNT(*), SUM(t), SUM(y), SUM(t * t), SUM(t * y), SUM(y * y), 0, 0, 0
+                FROM puntos GROUP BY flota, tipo, serie
+            """)
+            _refresh_forecast_last(conn)
+    return {'path': path, 'conn': conn, 'lock': threading.Lock()}
+
+# Base de historial compartida entre sesiones. Un historial que quedó en la caché temporal (ubicación
+# anterior) se copia a la nueva la primera vez
+@st.cache_resource
+def get_forecast_store(path):
+    legacy_path = os.path.join(REPORT_CACHE_DIR, 'historial_cortes.sqlite')
+    if not os.path.exists(path) and os.path.exists(legacy_path) and os.path.abspath(legacy_path) != os.path.abspath(path):
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            shutil.copy2(legacy_path, path)
+        except OSError:
+            pass
+    return open_forecast_store(path)
+
+# Función para sumar (sign=1) o restar (sign=-1) los puntos de un corte a las sumas de cada serie
+# (un corte posterior al último también pasa a ser el último punto de la serie)
+def _apply_forecast_points(conn, rows, sign):
+    conn.executemany("""
+        INSERT INTO series (flota, tipo, serie, n, st, sy, stt, sty, syy, ultimo_t, ultimo_y, requeridas)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (flota, tipo, serie) DO UPDATE SET
+            n = n + excluded.n, st = st + excluded.st, sy = sy + excluded.sy,
+            stt = stt + excluded.stt, sty = sty + excluded.sty, syy = syy + excluded.syy,
+            ultimo_y = CASE WHEN excluded.n > 0 AND excluded.ultimo_t >= ultimo_t THEN excluded.ultimo_y ELSE ultimo_y END,
+            requeridas = CASE WHEN excluded.n > 0 AND excluded.ultimo_t >= ultimo_t THEN excluded.requeridas ELSE requeridas END,
+            ultimo_t = CASE WHEN excluded.n > 0 AND excluded.ultimo_t >= ultimo_t THEN excluded.ultimo_t ELSE ultimo_t END
+    """, [(flota, tipo, serie, sign, sign * t, sign * y, sign * t * t, sign * t * y, sign * y * y, t, y, req)
+          for flota, tipo, serie, t, y, req in rows])
+
+# Función para recalcular el último punto de las series (tras mover un corte)
+def _refresh_forecast_last(conn):
+    conn.execute("""
+        UPDATE series SET (ultimo_t, ultimo_y, requeridas) = (
+            SELECT p.t, p.y, p.requeridas FROM puntos p
+            WHERE p.flota = series.flota AND p.tipo = series.tipo AND p.serie = series.serie
+            ORDER BY p.t DESC LIMIT 1)
+    """)
+    conn.execute("DELETE FROM series WHERE n <= 0")
+
+# Función para quitar los puntos de unos cortes de las sumas y de la base (sin recalcular los últimos)
+def _remove_snapshot_points(conn, hashes):
+    for snapshot_hash in hashes:
+        old = conn.execute("SELECT flota, tipo, serie, t, y, requeridas FROM puntos WHERE hash = ?",
+                           (snapshot_hash,)).fetchall()
+        _apply_forecast_points(conn, old, -1)
+        conn.execute("DELETE FROM puntos WHERE hash = ?", (snapshot_hash,))
+
+# Función para registrar un corte (si el mismo contenido ya estaba con otra fecha, se mueve)
+# Devuelve 'nuevo', 'movido' o 'existente'
+def record_snapshot(store, snapshot_hash, nombre, fecha, series, flota=''):
+    t = forecast_days(fecha)
+    rows = [(flota, tipo, serie, t, float(y), float(req)) for (tipo, serie), (y, req) in series.items()]
+    with store['lock'], store['conn'] as conn:
+        previous = conn.execute("SELECT t, flota FROM cortes WHERE hash = ?", (snapshot_hash,)).fetchone()
+        if previous is not None and abs(previous[0] - t) < 1e-9 and previous[1] == flota:
+            return 'existente'
+        if previous is not None:
+            _remove_snapshot_points(conn, [snapshot_hash])
+        conn.execute("INSERT OR REPLACE INTO cortes (hash, nombre, t, registrado, flota) VALUES (?, ?, ?, ?, ?)",
+                     (snapshot_hash, nombre, t, datetime.now().isoformat(timespec='seconds'), flota))
+        conn.executemany("INSERT INTO puntos (hash, tipo, serie, t, y, requeridas, flota) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         [(snapshot_hash, tipo, serie, t, y, req, fleet) for fleet, tipo, serie, t, y, req in rows])
+        _apply_forecast_points(conn, rows, 1)
+        if previous is not None:
+            _refresh_forecast_last(conn)
+    return 'movido' if previous is not None else 'nuevo'
+
+# Función para obtener la fecha con que está registrado un corte (None si no está)
+def snapshot_recorded_date(store, snapshot_hash):
+    with store['lock']:
+        row = store['conn'].execute("SELECT t FROM cortes WHERE hash = ?", (snapshot_hash,)).fetchone()
+    return forecast_date(row[0]) if row is not None else None
+
+# Función para borrar algunos cortes del historial (las series quedan como si no se hubieran registrado)
+def delete_snapshots(store, hashes):
+    with store['lock'], store['conn'] as conn:
+        _remove_snapshot_points(conn, hashes)
+        conn.executemany("DELETE FROM cortes WHERE hash = ?", [(snapshot_hash,) for snapshot_hash in hashes])
+        _refresh_forecast_last(conn)
+
+# Función para borrar todo el historial de cortes
+def clear_forecast_store(store):
+    with store['lock'], store['conn'] as conn:
+        conn.execute("DELETE FROM cortes")
+        conn.execute("DELETE FROM puntos")
+        conn.execute("DELETE FROM series")
+
+# Función para listar los cortes registrados de una flota (None: todas)
+def list_snapshots(store, flota=None):
+    query = "SELECT nombre, t, registrado, hash, flota FROM cortes"
+    with store['lock']:
+        rows = store['conn'].execute(query + (" WHERE flota = ?" if flota is not None else "") + " ORDER BY t",
+                                     (flota,) if flota is not None else ()).fetchall()
+    return pd.DataFrame({
+        'Planilla': [row[0] for row in rows],
+        'Fecha del Corte': [forecast_date(row[1]) for row in rows],
+        'Registrado': [row[2] for row in rows],
+        'Corte': [row[3] for row in rows],
+        'Flota': [row[4] for row in rows]
+    }, columns=['Planilla', 'Fecha del Corte', 'Registrado', 'Corte', 'Flota'])
+
+# Función para pronosticar todas las series de una flota de una vez a partir de las sumas (vectorizado)
+@instrumented('forecast_completion')
+def forecast_completion(store, tipo=None, flota=''):
+    query = "SELECT tipo, serie, n, st, sy, stt, sty, syy, ultimo_t, ultimo_y, requeridas FROM series WHERE flota = ?"
+    with store['lock']:
+        rows = store['conn'].execute(query + (" AND tipo = ?" if tipo else ""), (flota, tipo) if tipo else (flota,)).fetchall()
+    columns = ['Tipo', 'Serie', 'Cortes', 'Instaladas', 'Requeridas', 'Avance', 'Velocidad (normas/día)',
+               'Velocidad Mínima', 'Velocidad Máxima', 'Fecha Estimada', 'Banda Temprana', 'Banda Tardía']
+    if not rows:
+        return pd.DataFrame(columns=columns)
+
+    data = np.array([row[2:] for row in rows], dtype=float)
+    n, st_, sy, stt, sty, syy, last_t, last_y, required = data.T
+    # Sumas centradas: Stt = Σt² - (Σt)²/n, Sty = Σty - ΣtΣy/n, Syy = Σy² - (Σy)²/n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ctt = stt - st_ * st_ / n
+        cty = sty - st_ * sy / n
+        cyy = syy - sy * sy / n
+        slope = np.where(ctt > 1e-9, cty / ctt, np.nan)
+        sse = np.maximum(cyy - slope * cty, 0)
+        slope_se = np.where(n > 2, np.sqrt(sse / np.maximum(n - 2, 1) / ctt), np.nan)
+
+        # Días hasta el 100% desde el último corte a la velocidad estimada y a los extremos de la banda
+        remaining = np.maximum(required - last_y, 0)
+        t_quantile = forecast_t_quantile(n - 2)
+        fast = slope + t_quantile * slope_se
+        slow = slope - t_quantile * slope_se
+        eta = np.where(remaining == 0, last_t, np.where(slope > 0, last_t + remaining / slope, np.nan))
+        eta_early = np.where(remaining == 0, last_t, np.where(fast > 0, last_t + remaining / fast, np.nan))
+        eta_late = np.where(remaining == 0, last_t, np.where(slow > 0, last_t + remaining / slow, np.nan))
+        # Velocidades casi nulas dan fechas fuera del rango de pandas (desborde al convertirlas)
+        eta, eta_early, eta_late = (np.where(days - last_t <= FORECAST_MAX_DAYS, days, np.nan)
+                                    for days in (eta, eta_early, eta_late))
+        progress = np.where(required > 0, np.round(last_y / required * 100, 2), 100.0)
+
+    def to_dates(days):
+        return pd.to_datetime(np.where(np.isfinite(days), days, np.nan) * 86400, unit='s', origin=pd.Timestamp(FORECAST_ORIGIN)).normalize()
+
+    result = pd.DataFrame({
+        'Tipo': [row[0] for row in rows],
+        'Serie': [row[1] for row in rows],
+        'Cortes': n.astype(int),
+        'Instaladas': last_y.astype(int),
+        'Requeridas': required.astype(int),
+        'Avance': progress,
+        'Velocidad (normas/día)': slope,
+        'Velocidad Mínima': slow,
+        'Velocidad Máxima': fast,
+        'Fecha Estimada': to_dates(eta),
+        'Banda Temprana': to_dates(eta_early),
+        'Banda Tardía': to_dates(eta_late)
+    }, columns=columns)
+    order = result['Tipo'].map({name: i for i, name in enumerate(FORECAST_SERIES_TYPES)})
+    return result.assign(_orden=order).sort_values(['_orden', 'Fecha Estimada', 'Serie'], na_position='last').drop(columns='_orden').reset_index(drop=True)
+
+# Función para obtener el historial y la proyección de una serie de una flota (para el gráfico)
+def forecast_curve(store, forecast_row, points=30, flota=''):
+    with store['lock']:
+        rows = store['conn'].execute("SELECT t, y FROM puntos WHERE flota = ? AND tipo = ? AND serie = ? ORDER BY t",
+                                     (flota, forecast_row['Tipo'], forecast_row['Serie'])).fetchall()
+    history = pd.DataFrame({'Fecha': [forecast_date(row[0]) for row in rows], 'Instaladas': [row[1] for row in rows]})
+    slope = forecast_row['Velocidad (normas/día)']
+    if len(rows) < 2 or not slope > 0:
+        return history, None
+
+    # Proyección desde el último corte hasta el extremo tardío de la banda (o la fecha estimada)
+    last_t, last_y = rows[-1]
+    required = float(forecast_row['Requeridas'])
+    end = forecast_row['Banda Tardía'] if pd.notna(forecast_row['Banda Tardía']) else forecast_row['Fecha Estimada']
+    end_t = forecast_days(end) if pd.notna(end) else last_t + FORECAST_MAX_DAYS
+    t = np.linspace(last_t, max(end_t, last_t + 1), points)
+    projection = pd.DataFrame({
+        'Fecha': forecast_date(t),
+        'Proyección': np.minimum(last_y + slope * (t - last_t), required)
+    })
+    for speed_col, band_col in (('Velocidad Máxima', 'Banda Superior'), ('Velocidad Mínima', 'Banda Inferior')):
+        speed = forecast_row[speed_col]
+        if np.isfinite(speed):
+            projection[band_col] = np.minimum(last_y + max(speed, 0) * (t - last_t), required)
+    return history, projection
+
+# Función para planificar órdenes de trabajo de instalación por terminal y cuadrilla-día
+@instrumented('plan_work_orders')
+def plan_work_orders(status_matrix, bus_ids, norm_cols, terminals, capacity, crews=1):
+    capacity = max(int(capacity), 1)
+    crews = max(int(crews), 1)
+    columns_orden = ['Terminal', 'Día', 'Cuadrilla', 'Orden', 'N° Interno', 'Instalaciones',
+                     'Completa el Bus', 'Normas a Instalar']
+    columns_resumen = ['Terminal', 'Día', 'Cuadrilla', 'Buses', 'Instalaciones',
+                       'Buses Completados', 'Kit de Normas']
+
+    pending = (status_matrix == ESTADO_PENDIENTE)
+    pending_count = pending.sum(axis=1)
+    rows = np.flatnonzero(pending_count > 0)
+    if len(rows) == 0:
+        return pd.DataFrame(columns=columns_orden), pd.DataFrame(columns=columns_resumen)
+
+    terminals = np.asarray(terminals, dtype=object).astype(str)
+    bus_ids = np.asarray(bus_ids, dtype=object)
+
+    # Firma del conjunto de normas faltantes: buses con el mismo kit quedan contiguos
+    _, signature = np.unique(np.packbits(pending[rows], axis=1), axis=0, return_inverse=True)
+    signature = signature.ravel()
+
+    # Greedy: por terminal, primero los buses con menos instalaciones pendientes (maximiza
+    # los buses que llegan al 100% por cuadrilla-día) y, a igualdad, agrupados por kit
+    order = np.lexsort((rows, signature, pending_count[rows], terminals[rows]))
+    rows = rows[order]
+
+    # Normas pendientes de cada bus, extraídas de una sola vez de la matriz
+    pending_rows, pending_norms = np.nonzero(pending[rows])
+    splits = np.split(pending_norms, np.cumsum(np.bincount(pending_rows, minlength=len(rows)))[:-1])
+    norm_names = np.array(norm_cols, dtype=object)
+
+    orden = []
+    resumen = []
+    kit_norms = []
+    current_terminal = None
+    slot = 0
+    remaining = capacity
+    sequence = 0
+
+    # Cierra la cuadrilla-día actual agregando su kit de normas (conteo por norma)
+    def close_slot():
+        if not kit_norms:
+            return
+        norms_used, counts = np.unique(np.concatenate(kit_norms), return_counts=True)
+        resumen[-1]['Kit de Normas'] = ", ".join(
+            f"{norm} x{count}" for norm, count in zip(norm_names[norms_used], counts)
+        )
+        kit_norms.clear()
+
+    for row, norms in zip(rows, splits):
+        terminal = terminals[row]
+        if terminal != current_terminal:
+            current_terminal = terminal
+            slot = 0
+            remaining = capacity
+            sequence = 0
+        elif len(norms) > remaining and remaining < capacity:
+            # El bus no cabe en lo que queda del día: se empieza una nueva cuadrilla-día
+            slot += 1
+            remaining = capacity
+            sequence = 0
+
+        # Los buses con más normas que la capacidad se reparten en varias cuadrillas-día
+        while len(norms) > 0:
+            if sequence == 0:
+                close_slot()
+                resumen.append({
+                    'Terminal': terminal,
+                    'Día': slot // crews + 1,
+                    'Cuadrilla': slot % crews + 1,
+                    'Buses': 0,
+                    'Instalaciones': 0,
+                    'Buses Completados': 0,
+                    'Kit de Normas': ''
+                })
+            take = norms[:remaining]
+            norms = norms[remaining:]
+            sequence += 1
+            orden.append({
+                'Terminal': terminal,
+                'Día': slot // crews + 1,
+                'Cuadrilla': slot % crews + 1,
+                'Orden': sequence,
+                'N° Interno': bus_ids[row],
+                'Instalaciones': len(take),
+                'Completa el Bus': 'Sí' if len(norms) == 0 else 'No',
+                'Normas a Instalar': ", ".join(norm_names[take])
+            })
+            resumen[-1]['Buses'] += 1
+            resumen[-1]['Instalaciones'] += len(take)
+            resumen[-1]['Buses Completados'] += int(len(norms) == 0)
+            kit_norms.append(take)
+
+            remaining -= len(take)
+            if remaining == 0:
+                slot += 1
+                remaining = capacity
+                sequence = 0
+    close_slot()
+
+    orden_df = pd.DataFrame(orden, columns=columns_orden)
+    resumen_df = pd.DataFrame(resumen, columns=columns_resumen)
+
+    return orden_df, resumen_df
+
+# Función para exportar el plan de trabajo como planilla Excel de órdenes de trabajo
+def export_work_orders_excel(orden_df, resumen_df):
+    return write_excel_sheets([
+        {'name': 'Resumen Cuadrillas', 'data': resumen_df, 'widths': {'Kit de Normas': 60}},
+        {'name': 'Orden de Trabajo', 'data': orden_df, 'widths': {'Normas a Instalar': 60}}
+    ])
+
+# Función para calcular el plan de trabajo y su Excel (None si falta xlsxwriter)
+def build_work_plan(status_matrix, bus_ids, norm_cols, terminals, capacity, crews):
+    orden_df, resumen_df = plan_work_orders(status_matrix, bus_ids, norm_cols, terminals, capacity, crews)
     try:
-        total_buses = len(df)
-        metrics = {}
-        
-        # Si no hay buses, devolver métricas predeterminadas
-        if total_buses == 0:
-            return {
-                'efficiency': 0,
-                'total_buses': 0,
-                'total_norms': len(norm_cols),
-                'completed_installations': 0,
-                'pending_installations': 0,
-                'complete_buses': 0,
-                'incomplete_buses': 0,
-                'norm_progress': {},
-                'bus_progress': {}
-            }
-        
-        # Eficiencia global de instalación
-        total_cells = total_buses * len(norm_cols)
-        completed_cells = 0
-        not_applicable_cells = 0
-        
-        # IMPORTANTE: Considerar "no aplica" como una norma completada
-        for col in norm_cols:
-            # IMPORTANTE: Interpretar valores como instalados
-            values = df[col].str.lower()
-            # Contar instaladas - valores que indiquen instalación
-            is_installed = ((values == '1') | 
-                           (values == 'instalada') | 
-                           (values == 'instalado') |
-                           (values.str.contains('instalad')))
-            
-            # Contar no aplica - variantes de "no aplica"
-            is_not_applicable = values.str.contains('no aplica')
-            
-            # Sumar ambos como "completados" (instalado O no aplica)
-            completed_cells += (is_installed | is_not_applicable).sum()
-            not_applicable_cells += is_not_applicable.sum()
-        
-        # Calcular la eficiencia como (instaladas + no aplica) / total
-        efficiency = (completed_cells / total_cells * 100) if total_cells > 0 else 0
-        
-        metrics['efficiency'] = round(efficiency, 2)
-        metrics['total_buses'] = total_buses
-        metrics['total_norms'] = len(norm_cols)
-        metrics['completed_installations'] = int(completed_cells)
-        metrics['pending_installations'] = int(total_cells - completed_cells)
-        
-        # Buses con instalación completa
-        buses_complete = []
-        buses_incomplete = []
-        bus_completion_status = {}
-        
-        for idx, row in df.iterrows():
-            # Determinar el ID del bus
-            if 'N° Interno' in row and not pd.isna(row['N° Interno']):
-                bus_id = str(row['N° Interno'])
-            elif 'Numero Interno' in row and not pd.isna(row['Numero Interno']):
-                bus_id = str(row['Numero Interno'])
-            else:
-                # Buscar otra columna con "INTERNO" en el nombre
-                interno_cols = [col for col in row.index if 'INTERNO' in col.upper()]
-                if interno_cols:
-                    bus_id = str(row[interno_cols[0]])
-                else:
-                    # Usar PPU como fallback
-                    if 'PPU' in row and not pd.isna(row['PPU']):
-                        bus_id = f"PPU_{str(row['PPU'])}"
-                    else:
-                        # Último recurso: usar el índice
-                        bus_id = f"Bus_{idx}"
-            
-            # Verificar si el bus está completo
-            all_complete = True
-            missing_norms = []
-            
-            for col in norm_cols:
-                val = str(row[col]).lower().strip()
-                # Verificar si la norma está instalada o no aplica
-                is_installed = (val == '1' or 
-                              val == 'instalada' or 
-                              val == 'instalado' or
-                              'instalad' in val)
-                is_not_applicable = 'no aplica' in val
-                
-                # Si no está instalada Y no es "no aplica", está faltante
-                if not (is_installed or is_not_applicable):
-                    all_complete = False
-                    missing_norms.append(col)
-            
-            if all_complete:
-                buses_complete.append(bus_id)
-            else:
-                buses_incomplete.append(bus_id)
-                bus_completion_status[bus_id] = missing_norms
-        
-        metrics['complete_buses'] = len(buses_complete)
-        metrics['incomplete_buses'] = len(buses_incomplete)
-        metrics['bus_completion_status'] = bus_completion_status
-        
-        # Lista de buses completos e incompletos
-        metrics['complete_buses_list'] = buses_complete
-        metrics['incomplete_buses_list'] = buses_incomplete
-        
-        # Calcular porcentaje de avance por norma
-        norm_progress = {}
-        for col in norm_cols:
-            values = df[col].str.lower()
-            # IMPORTANTE: Considerar "instalado" O "no aplica" como completado
-            is_installed = ((values == '1') | 
-                           (values == 'instalada') | 
-                           (values == 'instalado') |
-                           (values.str.contains('instalad')))
-            
-            is_not_applicable = values.str.contains('no aplica')
-            
-            # Contar como "completado" si está instalado O no aplica
-            completed = (is_installed | is_not_applicable).sum()
-            
-            # El total siempre es el número de buses (no restamos "no aplica")
-            progress = (completed / total_buses * 100) if total_buses > 0 else 0
-            norm_progress[col] = round(progress, 2)
-        
-        metrics['norm_progress'] = norm_progress
-        
-        # Calcular porcentaje de avance por bus
-        bus_progress = {}
-        for idx, row in df.iterrows():
-            # Determinar el ID del bus
-            if 'N° Interno' in row and not pd.isna(row['N° Interno']):
-                bus_id = str(row['N° Interno'])
-            elif 'Numero Interno' in row and not pd.isna(row['Numero Interno']):
-                bus_id = str(row['Numero Interno'])
-            else:
-                # Buscar otra columna con "INTERNO" en el nombre
-                interno_cols = [col for col in row.index if 'INTERNO' in col.upper()]
-                if interno_cols:
-                    bus_id = str(row[interno_cols[0]])
-                else:
-                    # Usar PPU como fallback
-                    if 'PPU' in row and not pd.isna(row['PPU']):
-                        bus_id = f"PPU_{str(row['PPU'])}"
-                    else:
-                        # Último recurso: usar el índice
-                        bus_id = f"Bus_{idx}"
-            
-            # IMPORTANTE: Contar normas y considerar "no aplica" como completada
-            total_norms = len(norm_cols)  # Total de todas las normas
-            completed_norms = 0
-            applicable_norms = 0  # Normas que aplican a este bus
-            
-            for col in norm_cols:
-                val = str(row[col]).lower().strip()
-                is_not_applicable = 'no aplica' in val
-                
-                # Verificar si está instalada
-                is_installed = (val == '1' or 
-                             val == 'instalada' or 
-                             val == 'instalado' or
-                             'instalad' in val)
-                
-                # Si está instalada O no aplica, cuéntala como completada
-                if is_installed or is_not_applicable:
-                    completed_norms += 1
-                
-                # Contar cuántas normas son aplicables
-                if not is_not_applicable:
-                    applicable_norms += 1
-            
-            # Calcular progreso basado en el total de normas (no solo las aplicables)
-            progress = (completed_norms / total_norms * 100) if total_norms > 0 else 0
-            
-            # Obtener información adicional con manejo seguro
-            bus_info = {
-                'progress': round(progress, 2),
-                'completed': completed_norms,
-                'total_norms': total_norms,
-                'applicable_norms': applicable_norms,
-                'ppu': row['PPU'] if 'PPU' in row and not pd.isna(row['PPU']) else 'N/A',
-            }
-            
-            # Fecha de renovación
-            if 'FECHA DE RENOVACION' in row and not pd.isna(row['FECHA DE RENOVACION']):
-                bus_info['fecha_renovacion'] = row['FECHA DE RENOVACION']
-            else:
-                bus_info['fecha_renovacion'] = 'N/A'
-                
-            # Normas instaladas (contador)
-            if 'NORMA INSTALADA' in row and not pd.isna(row['NORMA INSTALADA']):
-                bus_info['normas_instaladas_contador'] = row['NORMA INSTALADA']
-            else:
-                # Contar solo las instaladas (sin los "no aplica")
-                installed_only = 0
-                for col in norm_cols:
-                    val = str(row[col]).lower().strip()
-                    if val == '1' or val == 'instalada' or val == 'instalado' or 'instalad' in val:
-                        installed_only += 1
-                bus_info['normas_instaladas_contador'] = installed_only
-            
-            # Terminal con manejo seguro
-            terminal_col = next((col for col in row.index if 'term' in col.lower()), None)
-            if terminal_col and not pd.isna(row[terminal_col]):
-                bus_info['terminal'] = row[terminal_col]
-            else:
-                bus_info['terminal'] = 'N/A'
-            
-            # Subclase/Modelo con manejo seguro
-            subclass_col = next((col for col in row.index if 'sub' in col.lower() or 'clas' in col.lower() or 'model' in col.lower()), None)
-            if subclass_col and not pd.isna(row[subclass_col]):
-                bus_info['subclase'] = row[subclass_col]
-            else:
-                bus_info['subclase'] = 'N/A'
-            
-            # Marcar si está completo o no
-            bus_info['completo'] = bus_id in buses_complete
-            
-            # Normas faltantes específicas
-            if bus_id in bus_completion_status:
-                bus_info['normas_faltantes'] = bus_completion_status[bus_id]
-            else:
-                bus_info['normas_faltantes'] = []
-            
-            bus_progress[bus_id] = bus_info
-        
-        metrics['bus_progress'] = bus_progress
-        
-        return metrics
-        
-    except Exception as e:
-        st.error(f"Error al calcular métricas: {str(e)}")
-        # Devolver métricas predeterminadas en caso de error
-        return {
-            'efficiency': 0,
-            'total_buses': total_buses if 'total_buses' in locals() else 0,
-            'total_norms': len(norm_cols),
-            'completed_installations': 0,
-            'pending_installations': 0,
-            'complete_buses': 0,
-            'incomplete_buses': 0,
-            'norm_progress': {},
-            'bus_progress': {}
-        }
+        excel = export_work_orders_excel(orden_df, resumen_df).getvalue() if not resumen_df.empty else None
+    except ImportError:
+        excel = None
+    return orden_df, resumen_df, excel
+
+# Campos de información del bus (no normas); la columna de cada uno sale del mapeo de columnas
+BUS_INFO_FIELDS = ['PPU', 'Unidad', 'Marca chasis', 'Modelo chasis', 'Subclase', 'N° plazas',
+                   'Terminal', 'Taller', 'FECHA DE RENOVACION', 'NORMA INSTALADA']
 
 # Función para generar informe detallado por bus
+@instrumented('generate_bus_report')
 def generate_bus_report(df, bus_id, norm_cols):
     try:
         # Encontrar la fila correspondiente al bus, con manejo de diferentes tipos de ID
+        mapping = resolve_columns(df)
+        interno_col = mapping.get('N° Interno')
+        ppu_col = mapping.get('PPU')
         bus_row = None
-        if 'N° Interno' in df.columns:
-            matching_rows = df[df['N° Interno'].astype(str) == str(bus_id)]
+        if interno_col is not None:
+            matching_rows = df[df[interno_col].astype(str) == str(bus_id)]
             if not matching_rows.empty:
                 bus_row = matching_rows.iloc[0]
         
-        # Si no se encontró, buscar en otras columnas posibles
-        if bus_row is None and 'Numero Interno' in df.columns:
-            matching_rows = df[df['Numero Interno'].astype(str) == str(bus_id)]
-            if not matching_rows.empty:
-                bus_row = matching_rows.iloc[0]
-        
-        # Si aún no se encontró, buscar por PPU si el ID parece ser una patente
-        if bus_row is None and 'PPU' in df.columns and bus_id.startswith("PPU_"):
+        # Si no se encontró, buscar por PPU si el ID parece ser una patente
+        if bus_row is None and ppu_col is not None and bus_id.startswith("PPU_"):
             ppu_value = bus_id.replace("PPU_", "")
-            matching_rows = df[df['PPU'].astype(str) == ppu_value]
+            matching_rows = df[df[ppu_col].astype(str) == ppu_value]
             if not matching_rows.empty:
                 bus_row = matching_rows.iloc[0]
         
@@ -503,49 +3290,25 @@ def generate_bus_report(df, bus_id, norm_cols):
         # Información general del bus con manejo seguro
         bus_info = {'N° Interno': bus_id}
         
-        # Campos comunes a buscar (información del bus, no normas)
-        info_fields = [
-            ('PPU', ['PPU', 'Patente', 'Placa']),
-            ('Unidad', ['Unidad', 'Unid']),
-            ('Marca chasis', ['Marca chasis', 'Marca', 'Marca Bus']),
-            ('Modelo chasis', ['Modelo chasis', 'Modelo', 'Tipo']),
-            ('Subclase', ['Subclase', 'Clase', 'Tipo Bus']),
-            ('N° plazas', ['N° plazas', 'Plazas', 'Capacidad']),
-            ('Terminal', ['Terminal', 'Base', 'Ubicacion']),
-            ('Taller', ['Taller', 'Servicio']),
-            ('FECHA DE RENOVACION', ['FECHA DE RENOVACION', 'Fecha']),
-            ('NORMA INSTALADA', ['NORMA INSTALADA', 'Normas Instaladas', 'Total Instaladas'])
-        ]
-        
-        # Buscar cada campo en las columnas disponibles
-        for field_name, possible_cols in info_fields:
-            # Buscar el primer nombre de columna que exista
-            found_col = next((col for col in possible_cols if col in bus_row.index), None)
-            if found_col:
+        # Buscar cada campo en la columna que le asigna el mapeo
+        for field_name in BUS_INFO_FIELDS:
+            found_col = mapping.get(field_name)
+            if found_col is not None and found_col in bus_row.index:
                 # Usar el valor si no es nulo
                 value = bus_row[found_col]
                 bus_info[field_name] = value if not pd.isna(value) else 'N/A'
             else:
                 # Si no se encuentra, poner N/A
                 bus_info[field_name] = 'N/A'
+        # Fecha de renovación en dd/mm/aaaa (número de serie de Excel, texto o fecha)
+        bus_info['FECHA DE RENOVACION'] = format_renewal_dates([bus_info['FECHA DE RENOVACION']])[0]
         
-        # Estado de las normas con manejo seguro
+        # Estado de las normas con manejo seguro (clasificadas con el vocabulario de estados)
+        available_cols = [col for col in norm_cols if col in bus_row.index]
+        codes = dict(zip(available_cols, classify_status_values(bus_row[available_cols].to_numpy(dtype=object), get_status_matcher())))
         norm_status = {}
         for col in norm_cols:
-            if col in bus_row.index:
-                status = str(bus_row[col]).strip().lower()
-                if status == '1' or status == 'instalada' or status == 'instalado' or 'instalad' in status:
-                    status_text = "Instalada"
-                elif 'no aplica' in status:
-                    status_text = "No Aplica"
-                elif status == '' or status == 'nan' or pd.isna(bus_row[col]):
-                    status_text = "Pendiente"
-                else:
-                    status_text = "Pendiente"
-            else:
-                status_text = "No Disponible"
-            
-            norm_status[col] = status_text
+            norm_status[col] = STATUS_LABELS[codes[col]] if col in codes else "No Disponible"
         
         # Calcular porcentaje de avance
         required_norms = sum(1 for status in norm_status.values() if status != "No Aplica" and status != "No Disponible")
@@ -567,6 +3330,229 @@ def generate_bus_report(df, bus_id, norm_cols):
             'Error': f'Error al generar reporte: {str(e)}'
         }, {col: 'Error' for col in norm_cols}, 0
 
+# REPORTES POR BUS MATERIALIZADOS
+# La ficha de cada bus (campos de información, estado de cada norma y avance) se calcula una
+# vez por conjunto de datos en una pasada vectorizada y se guarda en SQLite con el ID del bus
+# como clave primaria. El detalle, el informe HTML y la API leen una sola fila. El buscador usa
+# un índice ordenado en memoria (N° Interno y PPU) con búsqueda binaria por prefijo. La ficha
+# no depende de los filtros: el almacén es de la planilla completa (contenido, vocabulario, mapeo
+# y correcciones) y las vistas filtradas leen de él. Solo se conservan en disco los almacenes
+# usados más recientemente.
+REPORT_CACHE_DIR = os.environ.get('NORMAS_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'normas_cache'))
+BUS_SEARCH_LIMIT = 20
+# Versión del formato del almacén (cambia el nombre del archivo si cambia la tabla)
+REPORT_STORE_VERSION = 3
+# Cantidad de almacenes que se conservan en disco y abiertos en memoria
+REPORT_STORE_KEEP = int(os.environ.get('NORMAS_REPORTES_CONSERVAR', '8'))
+
+# Función para construir la tabla de reportes por bus (una fila por bus, mismo resultado que generate_bus_report)
+@instrumented('build_bus_report_table')
+def build_bus_report_table(df, norm_cols, status_matrix=None, bus_ids=None):
+    status = status_matrix if status_matrix is not None else compute_status_matrix(df, norm_cols)
+    bus_ids = bus_ids if bus_ids is not None else get_bus_ids(df)
+
+    # Avance del informe: instaladas sobre las normas que aplican (100 si ninguna aplica)
+    installed = (status == ESTADO_INSTALADA).sum(axis=1)
+    required = len(norm_cols) - (status == ESTADO_NO_APLICA).sum(axis=1)
+    progress = np.where(required > 0, np.round(installed / np.maximum(required, 1) * 100, 2), 100.0)
+
+    table = pd.DataFrame({'bus_id': [str(bus_id) for bus_id in bus_ids]})
+    mapping = resolve_columns(df)
+    for field_name in BUS_INFO_FIELDS:
+        table[field_name] = info_column_values(df, mapping.get(field_name))
+    table['FECHA DE RENOVACION'] = format_renewal_dates(table['FECHA DE RENOVACION'])
+    table['progreso'] = progress
+    # Estados como texto de dígitos (un carácter por norma, código 0/1/2)
+    if len(norm_cols) > 0:
+        digits = np.ascontiguousarray(status.astype(np.uint8) + ord('0'))
+        table['estados'] = [value.decode('ascii') for value in digits.view(f'S{len(norm_cols)}').ravel()]
+    else:
+        table['estados'] = ''
+    # Con IDs repetidos se conserva la primera fila, igual que generate_bus_report
+    return table.drop_duplicates('bus_id', keep='first')
+
+# Función para escribir la tabla en SQLite (archivo temporal y reemplazo atómico)
+def write_bus_report_store(table, norm_cols, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    info_cols = BUS_INFO_FIELDS
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute("CREATE TABLE meta (clave TEXT PRIMARY KEY, valor TEXT)")
+        conn.execute("CREATE TABLE buses (bus_id TEXT PRIMARY KEY, ppu TEXT, info TEXT, progreso REAL, estados TEXT)")
+        conn.execute("INSERT INTO meta VALUES ('norm_cols', ?)", (json.dumps(list(norm_cols), ensure_ascii=False),))
+        # Fechas y demás valores se guardan como se muestran en el informe (str)
+        info_json = [
+            json.dumps(dict(zip(info_cols, values)), ensure_ascii=False,
+                       default=lambda value: _json_default(value) if isinstance(value, (np.integer, np.floating)) else str(value))
+            for values in table[info_cols].itertuples(index=False, name=None)
+        ]
+        conn.executemany("INSERT INTO buses VALUES (?, ?, ?, ?, ?)", zip(
+            table['bus_id'], table['PPU'].astype(str), info_json,
+            table['progreso'].astype(float), table['estados']
+        ))
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+
+# Función para normalizar una clave de búsqueda (mayúsculas, sin espacios ni guiones)
+def normalize_search_key(value):
+    return re.sub(r'[\s\-]', '', str(value)).upper()
+
+# Función para construir el índice ordenado de búsqueda (N° Interno y PPU -> ID del bus)
+def build_bus_search_index(bus_ids, ppus):
+    keys, targets = [], []
+    for bus_id, ppu in zip(bus_ids, ppus):
+        keys.append(normalize_search_key(bus_id))
+        targets.append(bus_id)
+        if ppu and ppu != 'N/A':
+            keys.append(normalize_search_key(ppu))
+            targets.append(bus_id)
+    keys = np.array(keys, dtype=str)
+    order = np.argsort(keys, kind='stable')
+    return {'keys': keys[order], 'buses': np.array(targets, dtype=object)[order]}
+
+# Función para buscar buses por prefijo de N° Interno o PPU (búsqueda binaria en el índice)
+# allowed limita los resultados a los buses de la vista filtrada (None: todos)
+def search_buses(index, text, limit=BUS_SEARCH_LIMIT, allowed=None):
+    prefix = normalize_search_key(text)
+    if not prefix or len(index['keys']) == 0:
+        return []
+    lo = np.searchsorted(index['keys'], prefix, side='left')
+    hi = np.searchsorted(index['keys'], prefix + '\uffff', side='left')
+    if allowed is not None:
+        return [bus for bus in dict.fromkeys(index['buses'][lo:hi]) if bus in allowed][:limit]
+    # Un bus aparece a lo más dos veces (número y patente): basta mirar 2 x limit entradas
+    return list(dict.fromkeys(index['buses'][lo:min(hi, lo + 2 * limit)]))[:limit]
+
+# Función para abrir un almacén de reportes ya escrito
+def open_bus_report_store(path):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    norm_cols = json.loads(conn.execute("SELECT valor FROM meta WHERE clave = 'norm_cols'").fetchone()[0])
+    rows = conn.execute("SELECT bus_id, ppu FROM buses").fetchall()
+    return {
+        'path': path,
+        'conn': conn,
+        'lock': threading.Lock(),
+        'norm_cols': norm_cols,
+        'search': build_bus_search_index([row[0] for row in rows], [row[1] for row in rows])
+    }
+
+# Función para obtener la ruta del almacén de reportes de una planilla
+def bus_report_store_path(report_key):
+    return os.path.join(REPORT_CACHE_DIR, f"reportes_v{REPORT_STORE_VERSION}_{report_key}.sqlite")
+
+# Función para borrar los almacenes de reportes menos usados (y los de versiones anteriores del formato)
+def prune_bus_report_stores(keep=REPORT_STORE_KEEP, current=None):
+    try:
+        names = os.listdir(REPORT_CACHE_DIR)
+    except OSError:
+        return
+    prefix = f"reportes_v{REPORT_STORE_VERSION}_"
+    stores, stale = [], []
+    for name in names:
+        if name.startswith('reportes_v') and name.endswith('.sqlite'):
+            (stores if name.startswith(prefix) else stale).append(os.path.join(REPORT_CACHE_DIR, name))
+    stores.sort(key=lambda path: os.path.getmtime(path) if os.path.exists(path) else 0, reverse=True)
+    for path in stale + [path for path in stores if path != current][max(keep - 1, 0):]:
+        try:
+            os.remove(path)
+        except OSError:
+            # En uso (Windows) o ya borrado por otro proceso: se intentará en la próxima limpieza
+            pass
+
+# Función para obtener el almacén de reportes de una planilla (se escribe solo si no existe)
+def ensure_bus_report_store(report_key, df, norm_cols, status_matrix=None, bus_ids=None):
+    path = bus_report_store_path(report_key)
+    if os.path.exists(path):
+        # La fecha de modificación marca el último uso para la limpieza
+        os.utime(path)
+    else:
+        os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+        write_bus_report_store(build_bus_report_table(df, norm_cols, status_matrix, bus_ids), norm_cols, path)
+        prune_bus_report_stores(current=path)
+    return open_bus_report_store(path)
+
+# Función para cerrar la conexión de un almacén que sale de la caché
+def close_bus_report_store(store):
+    with store['lock']:
+        store['conn'].close()
+
+# Almacén compartido entre sesiones; los argumentos con "_" no se usan como clave de caché
+@st.cache_resource(max_entries=REPORT_STORE_KEEP, on_release=close_bus_report_store)
+def get_bus_report_store(report_key, _df, _norm_cols, _status_matrix=None, _bus_ids=None):
+    return ensure_bus_report_store(report_key, _df, _norm_cols, _status_matrix, _bus_ids)
+
+# Función para leer el reporte de un bus (misma forma que generate_bus_report); None si no existe
+# o si el almacén ya se cerró (la ficha se calcula directo)
+def lookup_bus_report(store, bus_id):
+    try:
+        with store['lock']:
+            row = store['conn'].execute(
+                "SELECT info, progreso, estados FROM buses WHERE bus_id = ?", (str(bus_id),)
+            ).fetchone()
+    except sqlite3.ProgrammingError:
+        return None
+    if row is None:
+        return None
+    bus_info = dict({'N° Interno': bus_id}, **json.loads(row[0]))
+    norm_status = {norm: STATUS_LABELS[int(code)] for norm, code in zip(store['norm_cols'], row[2])}
+    return bus_info, norm_status, row[1]
+
+# LISTA PAGINADA DE BUSES
+# Los órdenes (N° Interno con orden natural, avance ascendente y descendente) y los filtros por
+# estado se precalculan una vez por conjunto de datos como arreglos de índices; cada página es
+# un corte de BUS_PAGE_SIZE posiciones de un arreglo ya ordenado y filtrado.
+BUS_PAGE_SIZE = 10
+BUS_LIST_FILTERS = ["Todos", "Completos", "Incompletos", "Críticos (menos de 50%)"]
+BUS_LIST_SORTS = ["Número Interno", "Progreso (mayor a menor)", "Progreso (menor a mayor)"]
+
+# Función para obtener la clave de orden natural de un ID ("Bus 9" antes que "Bus 10")
+def natural_sort_key(value):
+    return tuple((0, int(part), '') if part.isdigit() else (1, 0, part.lower())
+                 for part in re.split(r'(\d+)', str(value)) if part)
+
+# Función para precalcular los índices ordenados de cada combinación de filtro y orden
+@instrumented('build_bus_list_index')
+def build_bus_list_index(bus_progress):
+    bus_ids = np.array(list(bus_progress), dtype=object)
+    progress = np.fromiter((data['progress'] for data in bus_progress.values()), dtype=float, count=len(bus_ids))
+
+    # Posición de cada bus en el orden natural (desempata los órdenes por avance)
+    natural = np.array(sorted(range(len(bus_ids)), key=lambda i: natural_sort_key(bus_ids[i])), dtype=np.int64)
+    natural_rank = np.empty(len(bus_ids), dtype=np.int64)
+    natural_rank[natural] = np.arange(len(bus_ids))
+    sorts = {
+        "Número Interno": natural,
+        "Progreso (mayor a menor)": np.lexsort((natural_rank, -progress)),
+        "Progreso (menor a mayor)": np.lexsort((natural_rank, progress))
+    }
+    masks = {
+        "Todos": np.ones(len(bus_ids), dtype=bool),
+        "Completos": progress == 100,
+        "Incompletos": progress < 100,
+        "Críticos (menos de 50%)": progress < 50
+    }
+    orders = {(filter_name, sort_name): order[mask[order]]
+              for filter_name, mask in masks.items() for sort_name, order in sorts.items()}
+    return {'bus_ids': bus_ids, 'orders': orders}
+
+# Índices compartidos entre ejecuciones; los argumentos con "_" no se usan como clave de caché
+@st.cache_resource(max_entries=8)
+def get_bus_list_index(data_key, _bus_progress):
+    return build_bus_list_index(_bus_progress)
+
+# Función para obtener la cantidad de páginas de una combinación de filtro y orden
+def bus_list_pages(index, filter_name, sort_name, page_size=BUS_PAGE_SIZE):
+    return -(-len(index['orders'][(filter_name, sort_name)]) // page_size)
+
+# Función para obtener los IDs de una página (1 = primera)
+def bus_list_page(index, filter_name, sort_name, page, page_size=BUS_PAGE_SIZE):
+    start = (page - 1) * page_size
+    return index['bus_ids'][index['orders'][(filter_name, sort_name)][start:start + page_size]].tolist()
+
 # Función para generar exportable HTML del informe por bus
 def generate_bus_report_html(bus_info, norm_status, progress):
     # Generar colores para el medidor de progreso
@@ -715,7 +3701,315 @@ def get_html_download_link(html, filename="informe_bus.html", text="Descargar in
     href = f'<a href="data:text/html;base64,{b64}" download="{filename}" style="display: inline-block; padding: 10px 20px; background-color: #4CAF50; color: white; text-decoration: none; border-radius: 5px; font-weight: bold;">{text}</a>'
     return href
 
+# Reglas de formato condicional nativas de Excel (se evalúan en Excel, no en Python)
+EXCEL_RULES = {
+    # Progreso numérico 0-100: verde >= 90, amarillo >= 70, rojo en otro caso
+    'progreso': [
+        ({'type': 'cell', 'criteria': '>=', 'value': 90}, {'bg_color': '#d4edda', 'font_color': '#155724'}),
+        ({'type': 'cell', 'criteria': '>=', 'value': 70}, {'bg_color': '#fff3cd', 'font_color': '#856404'}),
+        ({'type': 'cell', 'criteria': '<', 'value': 70}, {'bg_color': '#f8d7da', 'font_color': '#721c24'})
+    ],
+    # Estado del bus: Completo / Pendiente
+    'estado': [
+        ({'type': 'cell', 'criteria': '==', 'value': '"Completo"'}, {'bg_color': '#d4edda', 'font_color': '#155724'}),
+        ({'type': 'cell', 'criteria': '!=', 'value': '"Completo"'}, {'bg_color': '#f8d7da', 'font_color': '#721c24'})
+    ],
+}
+
+# Colores de Excel por código de estado
+EXCEL_STATUS_STYLES = {
+    ESTADO_PENDIENTE: {'bg_color': '#f8d7da', 'font_color': '#721c24'},
+    ESTADO_INSTALADA: {'bg_color': '#d4edda', 'font_color': '#155724'},
+    ESTADO_NO_APLICA: {'bg_color': '#e2e3e5', 'font_color': '#383d41'}
+}
+
+# Función para traducir el vocabulario de estados a reglas de Excel sobre los valores originales
+def vocabulary_excel_rules(vocabulary):
+    rules = []
+    for section in vocabulary.get('orden') or list(VOCABULARY_STATUS_CODES):
+        section_rules = vocabulary.get(section) or {}
+        style = EXCEL_STATUS_STYLES[VOCABULARY_STATUS_CODES[section]]
+        for value in section_rules.get('exactos', []):
+            escaped = str(value).replace('"', '""')
+            rules.append(({'type': 'cell', 'criteria': '==', 'value': f'"{escaped}"'}, style))
+        for value in section_rules.get('contiene', []):
+            rules.append(({'type': 'text', 'criteria': 'containing', 'value': str(value)}, style))
+    rules.append(({'type': 'blanks'}, EXCEL_STATUS_STYLES[ESTADO_PENDIENTE]))
+    return rules
+
+# Formatos de número por tipo de regla
+EXCEL_NUM_FORMATS = {
+    'progreso': '0.0"%"'
+}
+
+# Filas convertidas a objetos Python por bloque al escribir una hoja
+EXCEL_CHUNK_ROWS = 5000
+
+# Función para convertir una columna a valores Python listos para escribir (NaN/NaT -> celda vacía)
+def _excel_column_values(series):
+    if pd.api.types.is_datetime64_any_dtype(series):
+        series = series.dt.tz_localize(None) if series.dt.tz is not None else series
+    values = series.astype(object)
+    return values.where(series.notna(), None).tolist()
+
+# Función para escribir varias hojas en un solo libro Excel usando el modo de memoria constante
+# sheets: lista de dicts {'name': hoja, 'data': DataFrame, 'rules': {columna: regla}, 'widths': {columna: ancho}}
+@instrumented('write_excel_sheets')
+def write_excel_sheets(sheets):
+    if not XLSXWRITER_AVAILABLE:
+        raise ImportError("La biblioteca xlsxwriter no está instalada")
+
+    buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, {
+        'constant_memory': True,
+        'strings_to_formulas': False,
+        'strings_to_urls': False,
+        'nan_inf_to_errors': True,
+        'default_date_format': 'dd/mm/yyyy'
+    })
+    header_format = workbook.add_format({'bold': True, 'bg_color': '#1E3A8A', 'font_color': 'white', 'border': 1})
+    # Las reglas de valores de norma ('norma') salen del vocabulario de estados activo
+    rule_formats = {
+        name: [(rule, workbook.add_format(style)) for rule, style in rules]
+        for name, rules in dict(EXCEL_RULES, norma=vocabulary_excel_rules(get_status_vocabulary())).items()
+    }
+    num_formats = {name: workbook.add_format({'num_format': fmt}) for name, fmt in EXCEL_NUM_FORMATS.items()}
+
+    for sheet in sheets:
+        data = sheet['data']
+        rules = sheet.get('rules', {})
+        widths = sheet.get('widths', {})
+        worksheet = workbook.add_worksheet(sheet['name'][:31])
+        n_rows = len(data)
+
+        # Anchos y formatos de columna (antes de escribir filas)
+        for j, col in enumerate(data.columns):
+            width = widths.get(col, min(max(len(str(col)) + 2, 12), 40))
+            worksheet.set_column(j, j, width, num_formats.get(rules.get(col)))
+        worksheet.freeze_panes(1, 0)
+
+        # En modo de memoria constante las filas deben escribirse en orden y una sola vez
+        worksheet.write_row(0, 0, [str(col) for col in data.columns], header_format)
+        # Se convierten bloques de EXCEL_CHUNK_ROWS filas a la vez: la memoria extra no crece con la hoja
+        for start in range(0, n_rows, EXCEL_CHUNK_ROWS):
+            chunk = data.iloc[start:start + EXCEL_CHUNK_ROWS]
+            columns = [_excel_column_values(chunk.iloc[:, j]) for j in range(chunk.shape[1])]
+            for i, row in enumerate(zip(*columns), start=start + 1):
+                worksheet.write_row(i, 0, row)
+
+        # Formato condicional como reglas nativas de Excel sobre rangos completos
+        if n_rows > 0:
+            for j, col in enumerate(data.columns):
+                for rule, cell_format in rule_formats.get(rules.get(col), []):
+                    worksheet.conditional_format(1, j, n_rows, j, dict(rule, format=cell_format))
+            worksheet.autofilter(0, 0, n_rows, len(data.columns) - 1)
+
+    workbook.close()
+    buffer.seek(0)
+    return buffer
+
+# Función para preparar las hojas del reporte completo (resumen, por norma, por terminal, buses)
+def build_report_sheets(metrics, reporte_df, buses_pendientes_df=None):
+    resumen_df = pd.DataFrame([
+        ('Eficiencia Global (%)', metrics['efficiency']),
+        ('Total de Buses', metrics['total_buses']),
+        ('Total de Normas', metrics['total_norms']),
+        ('Buses Completos', metrics['complete_buses']),
+        ('Buses Incompletos', metrics['incomplete_buses']),
+        ('Instalaciones Completadas', metrics['completed_installations']),
+        ('Instalaciones Pendientes', metrics['pending_installations']),
+        ('Fecha del Reporte', datetime.now().strftime('%d/%m/%Y %H:%M'))
+    ], columns=['Indicador', 'Valor'])
+
+    sheets = [{'name': 'Resumen', 'data': resumen_df, 'widths': {'Indicador': 30, 'Valor': 20}}]
+
+    if 'missing_index' in metrics:
+        faltantes = index_missing_counts(metrics['missing_index'])
+        por_norma_df = pd.DataFrame({
+            'Norma': list(metrics['norm_progress'].keys()),
+            'Progreso': list(metrics['norm_progress'].values()),
+            'Buses Faltantes': [faltantes.get(norm, 0) for norm in metrics['norm_progress']]
+        }).sort_values('Progreso')
+        sheets.append({'name': 'Por Norma', 'data': por_norma_df, 'rules': {'Progreso': 'progreso'},
+                       'widths': {'Norma': 40}})
+
+        por_terminal_df = group_progress(metrics, 'Terminal')
+        if por_terminal_df is not None:
+            sheets.append({'name': 'Por Terminal', 'data': por_terminal_df, 'rules': {'Progreso': 'progreso'}})
+
+    sheets.append({'name': 'Reporte Completo', 'data': reporte_df,
+                   'rules': {'Progreso': 'progreso', 'Estado': 'estado'}, 'widths': {'Detalle': 60}})
+    if buses_pendientes_df is not None and not buses_pendientes_df.empty:
+        sheets.append({'name': 'Buses Pendientes', 'data': buses_pendientes_df,
+                       'rules': {'Progreso': 'progreso'}, 'widths': {'Detalle': 60}})
+    return sheets
+
+# Función para agregar el avance por grupo (Terminal o Subclase) desde la matriz de estado
+# Progreso = instaladas / (total - no aplica); None si el grupo no existe en los datos
+def group_progress(metrics, group_col):
+    values = metrics.get('bus_groups', {}).get(group_col)
+    if values is None:
+        return None
+    status = metrics['status_matrix']
+    progress_df = pd.DataFrame({
+        group_col: values,
+        'Buses': 1,
+        'Instaladas': (status == ESTADO_INSTALADA).sum(axis=1),
+        'No Aplica': (status == ESTADO_NO_APLICA).sum(axis=1),
+        'Pendientes': (status == ESTADO_PENDIENTE).sum(axis=1),
+        'Bus Completo': ((status == ESTADO_PENDIENTE).sum(axis=1) == 0).astype(int)
+    }).groupby(group_col, as_index=False).sum()
+    requeridas = progress_df['Instaladas'] + progress_df['Pendientes']
+    progress_df['Progreso'] = (progress_df['Instaladas'] / requeridas.where(requeridas > 0) * 100).round(2).fillna(100.0)
+    return progress_df
+
+# Función para crear el reporte completo por bus (ordenado por progreso)
+def build_full_report(metrics):
+    reporte_buses = []
+    for bus_id, info in metrics['bus_progress'].items():
+        reporte_buses.append({
+            'Número Interno': bus_id,
+            'PPU': info.get('ppu', 'N/A'),
+            'Terminal': info.get('terminal', 'N/A'),
+            'Subclase': info.get('subclase', 'N/A'),
+            'Progreso': round(info.get('progress', 0), 1),
+            'Estado': "Completo" if info.get('completo', False) else "Pendiente",
+            'Normas Faltantes': len(info.get('normas_faltantes', [])),
+            'Detalle': ", ".join(info.get('normas_faltantes', [])[:3]) + ("..." if len(info.get('normas_faltantes', [])) > 3 else "")
+        })
+
+    # Ordenar por progreso
+    reporte_buses.sort(key=lambda x: x['Progreso'], reverse=True)
+    return pd.DataFrame(reporte_buses)
+
+# Función para exportar el reporte completo (espera el trabajo del reporte); None si falta xlsxwriter
+def export_full_report(metrics, reporte_job, buses_pendientes_df):
+    reporte_df = reporte_job['future'].result()
+    try:
+        return write_excel_sheets(build_report_sheets(metrics, reporte_df, buses_pendientes_df)).getvalue()
+    except ImportError:
+        return None
+
+# Estilos CSS de las tablas (mismos colores que los informes)
+STYLE_VERDE = 'background-color: #d4edda; color: #155724'
+STYLE_AMARILLO = 'background-color: #fff3cd; color: #856404'
+STYLE_ROJO = 'background-color: #f8d7da; color: #721c24'
+STYLE_GRIS = 'background-color: #e2e3e5; color: #383d41'
+
+# Formato de columna para progresos numéricos (0-100) en st.dataframe
+PROGRESS_COLUMN_CONFIG = {'Progreso': st.column_config.NumberColumn('Progreso', format="%.1f%%")}
+
+# Sobre este número de filas el Styler de pandas (que recorre todas las celdas al
+# renderizar) se reemplaza por column_config: barras de progreso nativas y el color de cada
+# celda como marcador (🟢 🟡 🔴) en el texto o en una columna "Semáforo" junto al número
+STYLER_MAX_ROWS = 2000
+PROGRESS_BAR_COLUMN_CONFIG = {
+    'Progreso': st.column_config.ProgressColumn('Progreso', format="%.1f%%", min_value=0, max_value=100)
+}
+STYLE_MARKERS = {STYLE_VERDE: '🟢', STYLE_AMARILLO: '🟡', STYLE_ROJO: '🔴', STYLE_GRIS: '⚪'}
+
+# Umbrales de color del progreso (verde desde 90%, amarillo desde 70%, rojo bajo 70%)
+PROGRESS_VERDE_MIN = 90
+PROGRESS_AMARILLO_MIN = 70
+
+# Función para el estilo de una celda de progreso
+def progress_style(value):
+    if value >= PROGRESS_VERDE_MIN:
+        return STYLE_VERDE
+    if value >= PROGRESS_AMARILLO_MIN:
+        return STYLE_AMARILLO
+    return STYLE_ROJO
+
+# Función para el estilo de una celda de estado de bus
+def bus_status_style(value):
+    return STYLE_VERDE if value == 'Completo' else STYLE_ROJO
+
+# Función para calcular los estilos de una columna categórica a partir de un mapa valor -> estilo
+def category_styles(values, style_map, default):
+    return pd.Series(values).map(style_map).fillna(default).to_numpy()
+
+# Función para aplicar estilos precalculados solo a las columnas indicadas (sin funciones por celda)
+def style_columns(df, column_styles):
+    styler = df.style
+    for col, styles in column_styles.items():
+        styler = styler.apply(lambda _, styles=styles: styles, subset=[col])
+    return styler
+
+# Función para evaluar el estilo de cada celda de una columna una sola vez por valor distinto
+# (el progreso redondeado y los estados se repiten mucho)
+def column_cell_styles(values, cell_style):
+    codes, uniques = pd.factorize(values)
+    styles = np.array([cell_style(value) for value in uniques] + [''], dtype=object)
+    return styles[codes]
+
+# Función para llevar los colores a marcadores de texto (tablas grandes, sin Styler)
+def mark_styled_columns(df, cell_styles):
+    df = df.copy(deep=False)
+    for col, cell_style in cell_styles.items():
+        markers = pd.Series(column_cell_styles(df[col], cell_style), index=df.index).map(STYLE_MARKERS).fillna('')
+        if pd.api.types.is_numeric_dtype(df[col]):
+            # Las columnas numéricas siguen siendo números (barra de progreso); el marcador va al lado
+            df.insert(df.columns.get_loc(col), 'Semáforo', markers)
+        else:
+            df[col] = markers + ' ' + df[col].astype(str)
+    return df
+
+# Función para mostrar una tabla con progreso: estilo por celda (Styler.map) o, si es grande,
+# marcadores de color y column_config. cell_styles: columna -> función valor -> CSS
+@instrumented('tabla_progreso')
+def show_progress_table(df, cell_styles):
+    if len(df) > STYLER_MAX_ROWS:
+        st.dataframe(mark_styled_columns(df, cell_styles), use_container_width=True,
+                     column_config=PROGRESS_BAR_COLUMN_CONFIG)
+    else:
+        styler = df.style
+        for col, cell_style in cell_styles.items():
+            styler = styler.map(cell_style, subset=[col]) if hasattr(styler, 'map') else styler.applymap(cell_style, subset=[col])
+        st.dataframe(styler, use_container_width=True, column_config=PROGRESS_COLUMN_CONFIG)
+
+# CACHÉ DE GRÁFICOS
+# Las figuras de Plotly se construyen una vez y se comparten entre ejecuciones y sesiones. La
+# clave es la de los datos (archivo, filtros, vocabulario y correcciones), el tipo de gráfico y
+# sus parámetros. Se guardan las figuras ya construidas: st.plotly_chart serializa una figura en
+# pocos ms, mientras que reconstruirla desde JSON la vuelve a validar. Las menos usadas se
+# descartan al superar FIGURE_CACHE_SIZE.
+FIGURE_CACHE_SIZE = int(os.environ.get('NORMAS_CACHE_GRAFICOS', '64'))
+
+@st.cache_resource
+def get_figure_cache():
+    return {'figuras': {}, 'aciertos': 0, 'fallos': 0, 'lock': threading.Lock()}
+
+# Función para obtener una figura de la caché o construirla con build(*args); las figuras de la
+# caché no se modifican después de construidas
+def cached_figure(data_key, chart, params, build, *args):
+    cache = get_figure_cache()
+    key = (data_key, chart, json.dumps(params, sort_keys=True, default=str))
+    with cache['lock']:
+        figure = cache['figuras'].pop(key, None)
+        if figure is not None:
+            cache['figuras'][key] = figure
+            cache['aciertos'] += 1
+            return figure
+        cache['fallos'] += 1
+    figure = build(*args)
+    # Sin Plotly (o con error) no se guarda nada: el aviso se vuelve a mostrar
+    if figure is not None:
+        with cache['lock']:
+            cache['figuras'][key] = figure
+            while len(cache['figuras']) > FIGURE_CACHE_SIZE:
+                cache['figuras'].pop(next(iter(cache['figuras'])))
+    return figure
+
+# Función para resumir el uso de la caché de gráficos
+def figure_cache_stats():
+    cache = get_figure_cache()
+    with cache['lock']:
+        total = cache['aciertos'] + cache['fallos']
+        return {'figuras': len(cache['figuras']), 'aciertos': cache['aciertos'], 'fallos': cache['fallos'],
+                'tasa': cache['aciertos'] / total * 100 if total else 0.0}
+
 # Función para general gráficos de pastel por categorías
+@instrumented('create_pie_charts')
 def create_pie_charts(df, norm_cols):
     try:
         if not PLOTLY_AVAILABLE:
@@ -723,23 +4017,10 @@ def create_pie_charts(df, norm_cols):
             return None, None
             
         # Crear el gráfico de estado global de instalación
-        total_normas = len(df) * len(norm_cols)
-        instaladas = 0
-        no_aplica = 0
-        pendientes = 0
-        
-        for col in norm_cols:
-            # Contar instaladas - valor '1' o 'instalado'
-            values = df[col].astype(str).str.lower()
-            instaladas += ((values == '1') | 
-                          (values == 'instalada') | 
-                          (values == 'instalado') |
-                          (values.str.contains('instalad'))).sum()
-            
-            # Contar no aplica - variantes de "no aplica"
-            no_aplica += values.str.contains('no aplica').sum()
-        
-        pendientes = total_normas - instaladas - no_aplica
+        status = compute_status_matrix(df, norm_cols)
+        instaladas = int((status == ESTADO_INSTALADA).sum())
+        no_aplica = int((status == ESTADO_NO_APLICA).sum())
+        pendientes = int((status == ESTADO_PENDIENTE).sum())
         
         fig_global = px.pie(
             names=['Instaladas', 'No Aplican', 'Pendientes'],
@@ -755,40 +4036,24 @@ def create_pie_charts(df, norm_cols):
         # Crear el gráfico de avance por terminal
         fig_terminal = go.Figure()
         
-        # Verificar si existe alguna columna de terminal
-        terminal_col = None
-        if 'Terminal' in df.columns:
-            terminal_col = 'Terminal'
-        else:
-            # Buscar columnas con nombre similar
-            similar_cols = [col for col in df.columns if 'term' in col.lower()]
-            if similar_cols:
-                terminal_col = similar_cols[0]
+        # Columna de terminal según el mapeo de columnas
+        terminal_col = bus_group_columns(resolve_columns(df))['Terminal']
         
-        if terminal_col:
+        if terminal_col is not None:
             terminal_progress = {}
             for terminal in df[terminal_col].dropna().unique():
                 if not terminal or pd.isna(terminal):
                     continue
                     
-                # Filtrar por terminal
-                df_terminal = df[df[terminal_col].astype(str) == str(terminal)]
-                if df_terminal.empty:
+                # Filtrar por terminal (filas de la matriz de estado)
+                terminal_status = status[(df[terminal_col].astype(str) == str(terminal)).to_numpy()]
+                if len(terminal_status) == 0:
                     continue
                     
-                total = len(df_terminal) * len(norm_cols)
-                installed = 0
-                not_applicable = 0
-                
                 # Contar instaladas y no aplica
-                for col in norm_cols:
-                    values = df_terminal[col].astype(str).str.lower()
-                    installed += ((values == '1') | 
-                                 (values == 'instalada') | 
-                                 (values == 'instalado') |
-                                 (values.str.contains('instalad'))).sum()
-                    
-                    not_applicable += values.str.contains('no aplica').sum()
+                total = terminal_status.size
+                installed = int((terminal_status == ESTADO_INSTALADA).sum())
+                not_applicable = int((terminal_status == ESTADO_NO_APLICA).sum())
                 
                 required = total - not_applicable
                 if required > 0:
@@ -818,6 +4083,7 @@ def create_pie_charts(df, norm_cols):
         return None, None
 
 # Función para crear heatmap de instalación por norma
+@instrumented('create_norm_heatmap')
 def create_norm_heatmap(metrics):
     if not PLOTLY_AVAILABLE:
         st.warning("No se pueden crear gráficos. Por favor instala plotly: pip install plotly")
@@ -863,6 +4129,7 @@ def create_norm_heatmap(metrics):
     return fig
 
 # Función para crear un treemap de estado de normas por bus
+@instrumented('create_bus_treemap')
 def create_bus_treemap(df, bus_id, norm_cols):
     try:
         if not PLOTLY_AVAILABLE:
@@ -872,26 +4139,19 @@ def create_bus_treemap(df, bus_id, norm_cols):
         # Buscar el bus de forma más robusta
         bus_row = None
         
-        # Intentar diferentes estrategias para encontrar el bus
-        if 'N° Interno' in df.columns:
-            matching_rows = df[df['N° Interno'].astype(str) == str(bus_id)]
+        # Buscar por N° Interno y luego por PPU, con las columnas del mapeo
+        mapping = resolve_columns(df)
+        interno_col = mapping.get('N° Interno')
+        ppu_col = mapping.get('PPU')
+        if interno_col is not None:
+            matching_rows = df[df[interno_col].astype(str) == str(bus_id)]
             if not matching_rows.empty:
                 bus_row = matching_rows.iloc[0]
         
-        # Si no se encontró, buscar en "Numero Interno"
-        if bus_row is None and 'Numero Interno' in df.columns:
-            matching_rows = df[df['Numero Interno'].astype(str) == str(bus_id)]
+        if bus_row is None and ppu_col is not None and bus_id.startswith("PPU_"):
+            matching_rows = df[df[ppu_col].astype(str) == bus_id.replace("PPU_", "")]
             if not matching_rows.empty:
                 bus_row = matching_rows.iloc[0]
-                
-        # Probar con NUMERO INTERNO (mayúsculas)
-        if bus_row is None:
-            for col in df.columns:
-                if 'NUMERO' in col.upper() and 'INTERNO' in col.upper():
-                    matching_rows = df[df[col].astype(str) == str(bus_id)]
-                    if not matching_rows.empty:
-                        bus_row = matching_rows.iloc[0]
-                        break
         
         # Si aún no se encontró, buscar por índice
         if bus_row is None and bus_id.startswith("Bus_"):
@@ -911,27 +4171,26 @@ def create_bus_treemap(df, bus_id, norm_cols):
         treemap_data = []
         
         # Crear treemap dividido en dos grandes categorías: Instaladas y Pendientes
-        for col in norm_cols:
-            if col in bus_row.index:
-                status = str(bus_row[col]).strip().lower()
-                
-                # Clasificar el estado de la norma
-                if status == '1' or status == 'instalada' or status == 'instalado' or 'instalad' in status:
-                    status_text = "Instaladas"
-                    color = '#28A745'
-                elif 'no aplica' in status:
-                    status_text = "No Aplican"
-                    color = '#6C757D'
-                else:
-                    status_text = "Pendientes"
-                    color = '#DC3545'
-                
-                treemap_data.append({
-                    'Norma': col,
-                    'Estado': status_text,
-                    'Valor': 1,
-                    'Color': color
-                })
+        available_cols = [col for col in norm_cols if col in bus_row.index]
+        codes = classify_status_values(bus_row[available_cols].to_numpy(dtype=object), get_status_matcher())
+        for col, code in zip(available_cols, codes):
+            # Clasificar el estado de la norma
+            if code == ESTADO_INSTALADA:
+                status_text = "Instaladas"
+                color = '#28A745'
+            elif code == ESTADO_NO_APLICA:
+                status_text = "No Aplican"
+                color = '#6C757D'
+            else:
+                status_text = "Pendientes"
+                color = '#DC3545'
+            
+            treemap_data.append({
+                'Norma': col,
+                'Estado': status_text,
+                'Valor': 1,
+                'Color': color
+            })
         
         # Crear dataframe
         df_treemap = pd.DataFrame(treemap_data)
@@ -995,33 +4254,27 @@ def create_bus_treemap(df, bus_id, norm_cols):
         return None
 
 # Función para crear gráficos de avance por tipo de bus (subclase)
+@instrumented('create_subclass_charts')
 def create_subclass_charts(df, norm_cols):
     if not PLOTLY_AVAILABLE:
         st.warning("No se pueden crear gráficos. Por favor instala plotly: pip install plotly")
         return None
         
-    if 'Subclase' not in df.columns:
+    subclass_col = bus_group_columns(resolve_columns(df))['Subclase']
+    if subclass_col is None:
         st.info("No hay datos de subclase disponibles")
         return None
     
+    status = compute_status_matrix(df, norm_cols)
     subclass_progress = {}
-    for subclass in df['Subclase'].unique():
+    for subclass in df[subclass_col].unique():
         if pd.isna(subclass):
             continue
             
-        df_subclass = df[df['Subclase'] == subclass]
-        total = len(df_subclass) * len(norm_cols)
-        installed = 0
-        not_applicable = 0
-        
-        for col in norm_cols:
-            values = df_subclass[col].astype(str).str.lower()
-            installed += ((values == '1') | 
-                         (values == 'instalada') | 
-                         (values == 'instalado') |
-                         (values.str.contains('instalad'))).sum()
-                         
-            not_applicable += values.str.contains('no aplica').sum()
+        subclass_status = status[(df[subclass_col] == subclass).to_numpy()]
+        total = subclass_status.size
+        installed = int((subclass_status == ESTADO_INSTALADA).sum())
+        not_applicable = int((subclass_status == ESTADO_NO_APLICA).sum())
         
         required = total - not_applicable
         progress = (installed / required * 100) if required > 0 else 0
@@ -1048,7 +4301,265 @@ def create_subclass_charts(df, norm_cols):
     
     return fig
 
-# APLICACIÓN PRINCIPAL
+# Función para el gráfico de buses completos vs pendientes
+def create_completion_chart(complete_buses, incomplete_buses):
+    fig = px.pie(
+        names=['Buses Completos', 'Buses Pendientes'],
+        values=[complete_buses, incomplete_buses],
+        title="Distribución de Buses por Estado de Completitud",
+        color_discrete_sequence=['#28A745', '#DC3545'],
+        hole=0.4
+    )
+    fig.update_layout(legend=dict(orientation="h", yanchor="bottom", y=-0.2, xanchor="center", x=0.5))
+    return fig
+
+# Función para el gráfico de buses por rango de avance (color de rojo a verde según el centro del rango)
+def create_progress_ranges_chart(avance_ranges):
+    bucket_centers = (avance_ranges['Desde'] + np.append(100, avance_ranges['Desde'].to_numpy()[:-1])) / 200
+    return px.bar(
+        avance_ranges,
+        x='Rango',
+        y='Buses',
+        labels={'Rango': 'Rango de Avance', 'Buses': 'Cantidad de Buses'},
+        title="Distribución de Buses por Rango de Avance",
+        color='Rango',
+        color_discrete_map=dict(zip(avance_ranges['Rango'], px.colors.sample_colorscale('RdYlGn', bucket_centers.tolist())))
+    )
+
+# Función para el gráfico de las normas que faltan en más buses
+def create_top_missing_chart(top_normas):
+    fig = px.bar(
+        x=[norm[0] for norm in top_normas],
+        y=[norm[1] for norm in top_normas],
+        labels={'x': 'Norma', 'y': 'Cantidad de Buses'},
+        title="Top 10 Normas Faltantes",
+        color=[norm[1] for norm in top_normas],
+        color_continuous_scale='Reds'
+    )
+    fig.update_layout(xaxis={'categoryorder': 'total descending'})
+    return fig
+
+# APLICACIÓN PRINCIPAL
+# API LOCAL
+# Servidor HTTP/JSON (biblioteca estándar) para otras herramientas internas (dashboard de flota,
+# pantallas de terminal). Usa el mismo motor de estados sobre la planilla de la carpeta vigilada:
+# cada versión se procesa una sola vez y las respuestas se sirven desde memoria, con ETag igual
+# al hash de la planilla y GET condicional (304 si no cambió).
+API_PORT = int(os.environ.get('NORMAS_API_PUERTO', '0') or 0)
+API_HOST = os.environ.get('NORMAS_API_HOST', '127.0.0.1')
+API_CACHE_MAX = 4096
+
+# Función para convertir tipos de numpy/pandas al serializar JSON
+def _json_default(value):
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, (pd.Timestamp, datetime)):
+        return value.isoformat()
+    return str(value)
+
+# Función para serializar una respuesta de la API
+def api_json(payload):
+    return json.dumps(payload, ensure_ascii=False, default=_json_default).encode('utf-8')
+
+# Función para el resumen de un bus en los listados de la API
+def _api_bus_summary(bus_id, info):
+    return {
+        'numero_interno': bus_id,
+        'ppu': info['ppu'],
+        'terminal': info['terminal'],
+        'subclase': info['subclase'],
+        'progreso': info['progress'],
+        'completo': info['completo'],
+        'normas_faltantes': len(info['normas_faltantes'])
+    }
+
+# Función para construir la instantánea de la API de una versión de la planilla. Corre en el hilo
+# del servidor, sin sesión: usa prepare_data (no muestra nada) y el vocabulario que le entrega el dashboard
+def build_api_snapshot(dataset, vocabulary=None):
+    active_vocabulary = vocabulary or load_status_vocabulary()
+    matcher = _compiled_status_matcher(json.dumps(active_vocabulary, sort_keys=True, ensure_ascii=False))
+    processed_df, cols_info, norm_cols, _ = prepare_data(dataset['df'].copy())
+    metrics = calculate_metrics(processed_df, norm_cols, matcher)
+    planilla = {
+        'version': dataset['version'],
+        'archivo': dataset['name'],
+        'hash': dataset['hash'],
+        'cargada': dataset['loaded_at']
+    }
+    faltantes = index_missing_counts(metrics['missing_index']) if 'missing_index' in metrics else {}
+
+    def group_records(group_col):
+        progress_df = group_progress(metrics, group_col) if 'status_matrix' in metrics else None
+        return [] if progress_df is None else progress_df.to_dict(orient='records')
+
+    payloads = {
+        '/api/metricas': {
+            'planilla': planilla,
+            'eficiencia': metrics['efficiency'],
+            'total_buses': metrics['total_buses'],
+            'total_normas': metrics['total_norms'],
+            'buses_completos': metrics['complete_buses'],
+            'buses_incompletos': metrics['incomplete_buses'],
+            'instalaciones_completadas': metrics['completed_installations'],
+            'instalaciones_pendientes': metrics['pending_installations']
+        },
+        '/api/terminales': {'planilla': planilla, 'terminales': group_records('Terminal')},
+        '/api/subclases': {'planilla': planilla, 'subclases': group_records('Subclase')},
+        '/api/normas': {'planilla': planilla, 'normas': [
+            {'norma': norm, 'progreso': progress, 'buses_faltantes': faltantes.get(norm, 0)}
+            for norm, progress in metrics['norm_progress'].items()
+        ]},
+        '/api/buses': {'planilla': planilla, 'buses': [
+            _api_bus_summary(bus_id, info) for bus_id, info in metrics['bus_progress'].items()
+        ]}
+    }
+    payloads['/api'] = {'planilla': planilla, 'rutas': sorted(payloads) + [
+        '/api/buses/<numero_interno>', '/api/buscar?q=<prefijo N° Interno o PPU>', '/api/pendientes?terminal=&subclase='
+    ]}
+
+    # Mismo almacén de reportes por bus que usa el detalle del dashboard
+    store = ensure_bus_report_store(
+        background_data_key(dataset['hash'], active_vocabulary, resolve_columns(dataset['df']), status_edits_key({})),
+        processed_df, norm_cols, metrics.get('status_matrix'), metrics.get('bus_ids')
+    )
+
+    return {
+        'hash': dataset['hash'],
+        'vocabulary': vocabulary,
+        'etag': f'"{dataset["hash"][:32]}"',
+        'planilla': planilla,
+        'metrics': metrics,
+        'store': store,
+        'responses': {path: api_json(body) for path, body in payloads.items()}
+    }
+
+# Función para resolver una ruta de la API; devuelve (código HTTP, cuerpo JSON)
+def api_response(snapshot, path, query=''):
+    path = path.rstrip('/') or '/api'
+    cache_key = f"{path}?{query}" if query else path
+    body = snapshot['responses'].get(cache_key)
+    if body is not None:
+        return 200, body
+
+    metrics = snapshot['metrics']
+    if path.startswith('/api/buses/'):
+        bus_id = unquote(path[len('/api/buses/'):])
+        report = lookup_bus_report(snapshot['store'], bus_id)
+        if report is None:
+            return 404, api_json({'error': f"Bus {bus_id} no encontrado"})
+        bus_info, norm_status, progress = report
+        body = api_json(dict(
+            metrics['bus_progress'].get(bus_id, {}),
+            numero_interno=bus_id,
+            informacion=bus_info,
+            avance_informe=progress,
+            normas=norm_status
+        ))
+    elif path == '/api/buscar':
+        prefix = parse_qs(query).get('q', [''])[0]
+        buses = search_buses(snapshot['store']['search'], prefix)
+        body = api_json({'consulta': prefix, 'buses': [
+            _api_bus_summary(bus_id, metrics['bus_progress'][bus_id]) for bus_id in buses if bus_id in metrics['bus_progress']
+        ]})
+    elif path == '/api/pendientes':
+        params = parse_qs(query)
+        terminal = params.get('terminal', [None])[0]
+        subclase = params.get('subclase', [None])[0]
+        pendientes = []
+        for bus_id, missing_norms in metrics.get('bus_completion_status', {}).items():
+            info = metrics['bus_progress'][bus_id]
+            if (terminal and str(info['terminal']) != terminal) or (subclase and str(info['subclase']) != subclase):
+                continue
+            pendientes.append(dict(_api_bus_summary(bus_id, info), detalle=missing_norms))
+        body = api_json({'planilla': snapshot['planilla'], 'total': len(pendientes), 'buses': pendientes})
+    else:
+        return 404, api_json({'error': f"Ruta {path} no existe", 'rutas': '/api'})
+
+    # Las respuestas calculadas se guardan en la instantánea (con un tope de entradas)
+    if len(snapshot['responses']) < API_CACHE_MAX:
+        snapshot['responses'][cache_key] = body
+    return 200, body
+
+# Función para obtener la instantánea vigente; se reconstruye solo si cambió la planilla o el vocabulario
+def _api_snapshot(api):
+    dataset = api['watcher']['dataset']
+    if dataset is None:
+        return None
+    vocabulary = api.get('vocabulary')
+
+    def stale(snapshot):
+        return snapshot is None or snapshot['hash'] != dataset['hash'] or snapshot['vocabulary'] != vocabulary
+
+    snapshot = api['snapshot']
+    if stale(snapshot):
+        with api['lock']:
+            snapshot = api['snapshot']
+            if stale(snapshot):
+                snapshot = build_api_snapshot(dataset, vocabulary)
+                api['snapshot'] = snapshot
+    return snapshot
+
+# Función para crear el manejador HTTP de la API (http.server exige una clase)
+def make_api_handler(api):
+    class NormasApiHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Encabezados y cuerpo salen en escrituras separadas; sin Nagle no se espera el ACK retardado
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            # Un error al procesar la planilla (o al leer el almacén) se informa como 500 con JSON
+            # en vez de cortar la conexión; la próxima consulta vuelve a intentarlo
+            try:
+                snapshot = _api_snapshot(api)
+                if snapshot is None:
+                    self._send(503, api_json({'error': "Aún no hay una planilla en la carpeta vigilada"}))
+                    return
+                status, body = api_response(snapshot, url.path, url.query)
+            except Exception as e:
+                self._send(500, api_json({'error': f"No se pudo procesar la planilla: {str(e)}"}))
+                return
+            if status == 200:
+                # GET condicional: la planilla no cambió desde la última respuesta del cliente
+                if_none_match = self.headers.get('If-None-Match', '')
+                if if_none_match.strip() == '*' or snapshot['etag'] in [tag.strip() for tag in if_none_match.split(',')]:
+                    self._send(304, b'', snapshot['etag'])
+                    return
+            self._send(status, body, snapshot['etag'] if status == 200 else None)
+
+        def _send(self, status, body, etag=None):
+            self.send_response(status)
+            if status != 304:
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-cache')
+            if etag:
+                self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return NormasApiHandler
+
+# Función para iniciar el servidor de la API sobre un vigilante de carpeta
+def start_api_server(watcher, host=API_HOST, port=API_PORT):
+    api = {'watcher': watcher, 'snapshot': None, 'lock': threading.Lock(), 'vocabulary': None}
+    server = ThreadingHTTPServer((host, port), make_api_handler(api))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='normas-api').start()
+    api['server'] = server
+    api['url'] = f"http://{host}:{server.server_address[1]}/api"
+    return api
+
+# Servidor de la API compartido por todas las sesiones (uno por carpeta y puerto)
+@st.cache_resource
+def get_api_server(watch_path, host, port):
+    return start_api_server(get_folder_watcher(watch_path), host, port)
+
 def main():
     st.markdown('<h1 class="main-header">Sistema de Control de Instalación de Normas Gráficas</h1>', unsafe_allow_html=True)
     
@@ -1056,10 +4567,81 @@ def main():
     with st.sidebar:
         st.image("https://cdn-icons-png.flaticon.com/512/2821/2821637.png", width=100)
         st.markdown("### Carga de Datos")
-        uploaded_file = st.file_uploader("Cargar archivo Excel", type=['xlsx', 'xls'])
-        
-        if uploaded_file is not None:
-            df = load_data(uploaded_file)
+        data_source = st.radio("Origen de datos", ["Subir archivo", "Carpeta vigilada"],
+                               index=1 if WATCH_FOLDER else 0, horizontal=True, key='data_source')
+        uploaded_file = None
+        watched = None
+        if data_source == "Subir archivo":
+            uploaded_file = st.file_uploader("Cargar archivo Excel", type=['xlsx', 'xls'])
+            # Fecha del corte para el pronóstico (permite cargar planillas antiguas)
+            snapshot_date = st.date_input("Fecha del corte", value=datetime.now().date(), key='snapshot_date',
+                                          format="DD/MM/YYYY")
+        else:
+            watch_path = st.text_input("Carpeta con la planilla actualizada", value=WATCH_FOLDER, key='watch_path')
+            if watch_path and os.path.isdir(watch_path):
+                watcher = get_folder_watcher(os.path.abspath(watch_path))
+                watched = watcher['dataset']
+                # La versión pintada queda registrada para que el fragmento solo avise de cambios
+                st.session_state['watched_version'] = watched['version'] if watched is not None else 0
+                show_watched_folder_status(watcher)
+                # API local opcional sobre la misma carpeta (NORMAS_API_PUERTO)
+                if API_PORT:
+                    try:
+                        api = get_api_server(os.path.abspath(watch_path), API_HOST, API_PORT)
+                        # La API clasifica con el vocabulario de la sesión, igual que el dashboard
+                        api['vocabulary'] = get_status_vocabulary()
+                        st.caption(f"🔌 API local: {api['url']}")
+                    except OSError as e:
+                        st.warning(f"No se pudo iniciar la API local en el puerto {API_PORT}: {str(e)}")
+            elif watch_path:
+                st.error(f"La carpeta '{watch_path}' no existe")
+
+        # Vocabulario de estados: ver el activo o cargar uno propio (JSON/YAML)
+        with st.expander("Vocabulario de estados"):
+            st.caption(describe_status_vocabulary(get_status_vocabulary()))
+            vocabulary_file = st.file_uploader("Cargar vocabulario (JSON/YAML)", type=['json', 'yaml', 'yml'],
+                                               key='vocabulary_file')
+            if vocabulary_file is not None:
+                try:
+                    st.session_state['status_vocabulary'] = read_status_vocabulary(vocabulary_file, vocabulary_file.name)
+                    st.success(f"Vocabulario '{vocabulary_file.name}' aplicado")
+                except Exception as e:
+                    st.error(f"No se pudo leer el vocabulario: {str(e)}")
+            elif st.session_state.get('status_vocabulary') is not None:
+                st.session_state['status_vocabulary'] = None
+            st.download_button(
+                label="Descargar vocabulario activo",
+                data=json.dumps(get_status_vocabulary(), indent=2, ensure_ascii=False),
+                file_name="normas_vocabulario.json",
+                mime="application/json"
+            )
+
+        # Metadatos de normas: peso, costo, minutos y prioridad de cada norma (CSV/Excel/JSON)
+        with st.expander("Metadatos de normas"):
+            metadata_file = st.file_uploader("Cargar tabla de metadatos (CSV/Excel/JSON)", type=['csv', 'xlsx', 'json'],
+                                             key='metadata_file',
+                                             help="Columnas: Norma, Peso, Costo, Minutos, Prioridad. Las normas sin fila usan peso 1.")
+            if metadata_file is not None:
+                try:
+                    st.session_state['norm_metadata'] = read_norm_metadata(metadata_file, metadata_file.name)
+                    st.success(f"Metadatos '{metadata_file.name}' aplicados")
+                except Exception as e:
+                    st.error(f"No se pudo leer la tabla de metadatos: {str(e)}")
+            elif st.session_state.get('norm_metadata') is not None:
+                st.session_state['norm_metadata'] = None
+            try:
+                active_metadata = get_norm_metadata()
+            except Exception as e:
+                active_metadata = None
+                st.error(f"No se pudo leer '{NORM_METADATA_PATH}': {str(e)}")
+            st.caption(f"{len(active_metadata)} normas con metadatos" if active_metadata is not None
+                       else "Sin tabla de metadatos: todas las normas pesan lo mismo")
+
+        st.toggle("Cálculo en segundo plano", value=True, key='background_mode',
+                  help="Muestra primero las métricas principales y calcula gráficos, plan de trabajo y reportes en paralelo")
+
+        if uploaded_file is not None or watched is not None:
+            df = watched['df'] if watched is not None else load_data(uploaded_file)
             
             if df is not None:
                 st.success(f"Archivo cargado correctamente! {len(df)} registros encontrados.")
@@ -1068,22 +4650,42 @@ def main():
                 st.markdown("### Columnas detectadas")
                 st.write(df.columns.tolist())
                 
+                # Mapeo de columnas (perfil por formato de encabezados): ver y corregir
+                column_mapping = resolve_columns(df)
+                with st.expander("Mapeo de columnas"):
+                    signature, profile = get_column_profile(df)
+                    st.caption(f"Perfil {signature[:8]} ({'manual' if profile['origen'] == 'manual' else 'detectado'})")
+                    st.dataframe(pd.DataFrame({
+                        'Rol': list(COLUMN_ROLES),
+                        'Columna': [str(column_mapping.get(role, '—')) for role in COLUMN_ROLES]
+                    }), hide_index=True, use_container_width=True)
+                    mapping_role = st.selectbox("Rol", list(COLUMN_ROLES), key='mapping_role')
+                    column_options = ["(sin columna)"] + [str(col) for col in df.columns]
+                    current = column_mapping.get(mapping_role)
+                    current_index = column_options.index(str(current)) if current is not None else 0
+                    mapping_choice = st.selectbox("Columna", column_options, index=current_index,
+                                                  key=f"mapping_column_{signature}_{mapping_role}")
+                    if mapping_choice != column_options[current_index]:
+                        set_column_mapping(df, mapping_role, None if mapping_choice == column_options[0] else mapping_choice)
+                        st.rerun()
+                    if st.button("Volver a detectar", key='mapping_reset'):
+                        reset_column_mapping(df)
+                        # Las selecciones anteriores volverían a fijar el mapeo manual
+                        for key in [key for key in st.session_state if str(key).startswith('mapping_column_')]:
+                            del st.session_state[key]
+                        st.rerun()
+                group_columns = bus_group_columns(column_mapping)
+                
                 # Filtros de Terminal con manejo extremadamente robusto
                 terminal_filter = None
                 try:
-                    # Intentar encontrar la columna 'Terminal' o similares
-                    terminal_column = None
-                    if 'Terminal' in df.columns:
-                        terminal_column = 'Terminal'
-                    else:
-                        # Buscar columnas con nombre similar
-                        similar_columns = [col for col in df.columns if 'term' in col.lower()]
-                        if similar_columns:
-                            terminal_column = similar_columns[0]
-                            st.info(f"Usando '{terminal_column}' como columna de Terminal")
+                    # Columna de Terminal según el mapeo de columnas
+                    terminal_column = group_columns['Terminal']
+                    if terminal_column is not None and terminal_column != 'Terminal':
+                        st.info(f"Usando '{terminal_column}' como columna de Terminal")
                     
                     # Si encontramos una columna adecuada, crear el filtro
-                    if terminal_column:
+                    if terminal_column is not None:
                         # Obtener valores únicos no nulos
                         terminal_values = df[terminal_column].dropna().unique()
                         if len(terminal_values) > 0:
@@ -1101,19 +4703,13 @@ def main():
                 # Filtros de Subclase con manejo extremadamente robusto
                 subclass_filter = None
                 try:
-                    # Intentar encontrar la columna 'Subclase' o similares
-                    subclass_column = None
-                    if 'Subclase' in df.columns:
-                        subclass_column = 'Subclase'
-                    else:
-                        # Buscar columnas con nombre similar
-                        similar_columns = [col for col in df.columns if 'clas' in col.lower() or 'model' in col.lower()]
-                        if similar_columns:
-                            subclass_column = similar_columns[0]
-                            st.info(f"Usando '{subclass_column}' como columna de Subclase/Modelo")
+                    # Columna de Subclase según el mapeo de columnas (o el modelo si no hay Subclase)
+                    subclass_column = group_columns['Subclase']
+                    if subclass_column is not None and subclass_column != 'Subclase':
+                        st.info(f"Usando '{subclass_column}' como columna de Subclase/Modelo")
                     
                     # Si encontramos una columna adecuada, crear el filtro
-                    if subclass_column:
+                    if subclass_column is not None:
                         # Obtener valores únicos no nulos
                         subclass_values = df[subclass_column].dropna().unique()
                         if len(subclass_values) > 0:
@@ -1128,16 +4724,37 @@ def main():
                     st.warning(f"No se pudo crear el filtro de Subclase: {e}")
                     subclass_filter = None
                 
-                # Filtrar dataframe con manejo ultra-seguro
-                filtered_df = df.copy()  # Empezar con una copia del dataframe original
+                # Consulta de buses (se combina con los filtros de Terminal y Subclase)
+                bus_query = st.text_input("Consulta de buses", key='bus_query', help=QUERY_HELP,
+                                          placeholder="terminal in (A, B) and progreso < 50 and falta('Norma X')")
                 
-                # Aplicar filtro de terminal si existe
-                if terminal_filter and terminal_column and terminal_column in filtered_df.columns:
-                    filtered_df = filtered_df[filtered_df[terminal_column].astype(str).isin(terminal_filter)]
+                # Los filtros y la consulta dan una sola máscara sobre la planilla completa
+                content_hash = watched['hash'] if watched is not None else hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+                # Correcciones de estado de la sesión sobre la planilla en memoria
+                status_edits = get_status_edits(content_hash)
+                if status_edits['cambios']:
+                    df = apply_cell_edits(df, status_edits['cambios'])
+                edits_key = status_edits_key(status_edits['cambios'])
+                # Clave de la planilla completa (sin filtros): contexto de consultas y almacén de reportes por bus
+                report_key = background_data_key(content_hash, get_status_vocabulary(), column_mapping, edits_key)
+                query_context = get_query_context(report_key, df, norm_columns(df))
+                # Los filtros de selección se comparan directo con los valores elegidos (sin texto de consulta)
+                filter_mask = np.ones(query_context['n_buses'], dtype=bool)
+                if terminal_filter and terminal_column is not None:
+                    filter_mask &= bus_values_mask(query_context, 'terminal', terminal_filter)
+                if subclass_filter and subclass_column is not None:
+                    filter_mask &= bus_values_mask(query_context, 'subclase', subclass_filter)
+                try:
+                    query_mask = filter_mask & bus_query_mask(query_context, bus_query)
+                except ValueError as e:
+                    st.error(f"Consulta inválida: {str(e)}")
+                    bus_query = ''
+                    query_mask = filter_mask
+                if bus_query:
+                    st.caption(f"{int(query_mask.sum())} de {len(df)} buses cumplen la consulta")
                 
-                # Aplicar filtro de subclase si existe
-                if subclass_filter and subclass_column and subclass_column in filtered_df.columns:
-                    filtered_df = filtered_df[filtered_df[subclass_column].astype(str).isin(subclass_filter)]
+                # Filtrar dataframe con manejo ultra-seguro
+                filtered_df = df[query_mask] if not query_mask.all() else df.copy()
                 
                 # Verificar que el filtrado dejó algún dato
                 if filtered_df.empty:
@@ -1146,7 +4763,60 @@ def main():
                 
                 # Procesar datos
                 processed_df, cols_info, norm_cols = process_data(filtered_df)
-                metrics = calculate_metrics(processed_df, norm_cols)
+                # Las métricas se reutilizan en la sesión mientras no cambien datos ni filtros;
+                # las correcciones de estado se aplican sobre ellas como deltas
+                metrics_key = background_data_key(
+                    content_hash, terminal_filter, subclass_filter, get_status_vocabulary(), column_mapping, bus_query
+                )
+                metrics = session_metrics(metrics_key, processed_df, norm_cols, status_edits['cambios'])
+                # Clave de los trabajos en segundo plano: mismos datos, filtros, vocabulario y correcciones
+                # (el contenido del archivo identifica los datos, así se reutiliza lo ya calculado)
+                data_key = background_data_key(metrics_key, edits_key)
+
+                # Registrar el corte en el historial del pronóstico (flota completa, sin filtros), en la serie
+                # de su flota. La carpeta vigilada se registra sola con la fecha de modificación; un archivo
+                # subido solo al confirmar la fecha del corte. Una planilla sin buses no se registra
+                fleet_key = snapshot_fleet_key(df.columns, norm_cols)
+                if watched is not None:
+                    snapshot_name, snapshot_when = watched['name'], datetime.fromtimestamp(watched['mtime'])
+                else:
+                    snapshot_name, snapshot_when = uploaded_file.name, snapshot_date
+                if 'status_matrix' in metrics and st.session_state.get('recorded_snapshot') != (content_hash, str(snapshot_when)):
+                    try:
+                        forecast_store = get_forecast_store(forecast_db_path())
+                        if watched is not None:
+                            record_requested = True
+                        else:
+                            # El botón se reemplaza por la confirmación al registrar
+                            record_slot = st.empty()
+                            recorded_date = snapshot_recorded_date(forecast_store, content_hash)
+                            if recorded_date is not None and recorded_date.date() == snapshot_when:
+                                # Ya registrada con esta fecha (por otra sesión o antes): se registra de nuevo
+                                # solo para asociarla a la flota si venía del historial anterior
+                                record_requested = True
+                            else:
+                                if recorded_date is not None:
+                                    st.caption(f"Esta planilla está registrada como corte del {recorded_date.strftime('%d/%m/%Y')}")
+                                record_label = "Registrar corte" if recorded_date is None else "Mover corte"
+                                record_requested = record_slot.button(f"{record_label} del {snapshot_when.strftime('%d/%m/%Y')}",
+                                                             key='snapshot_record',
+                                                             help="Agrega esta planilla al historial del pronóstico con la fecha del corte")
+                        if record_requested:
+                            if len(filtered_df) == len(df):
+                                snapshot_status = metrics['status_matrix']
+                                snapshot_terminals = metrics['bus_groups'].get('Terminal', ['N/A'] * len(df))
+                            else:
+                                snapshot_status = compute_status_matrix(df, norm_cols)
+                                snapshot_terminals = info_column_values(df, bus_group_columns(column_mapping)['Terminal'])
+                            record_snapshot(forecast_store, content_hash, snapshot_name, snapshot_when,
+                                            snapshot_series(snapshot_status, norm_cols, snapshot_terminals), fleet_key)
+                            st.session_state['recorded_snapshot'] = (content_hash, str(snapshot_when))
+                            if watched is None:
+                                record_slot.caption(f"Corte registrado en el historial del {snapshot_when.strftime('%d/%m/%Y')}")
+                    except (sqlite3.Error, OSError) as e:
+                        st.warning(f"No se pudo registrar el corte en el historial: {str(e)}")
+                elif 'status_matrix' in metrics and watched is None:
+                    st.caption(f"Corte registrado en el historial del {snapshot_when.strftime('%d/%m/%Y')}")
                 
                 # Mostrar fecha de actualización
                 st.markdown("### Información")
@@ -1160,13 +4830,13 @@ def main():
                 # Descargar datos filtrados
                 if st.button("Exportar Datos Filtrados"):
                     try:
-                        # Intentar guardar con xlsxwriter
-                        buffer = io.BytesIO()
                         try:
-                            # Intentar usar xlsxwriter primero
-                            with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-                                processed_df.to_excel(writer, sheet_name='Datos', index=False)
-                            buffer.seek(0)
+                            # Intentar usar xlsxwriter primero (modo de memoria constante)
+                            buffer = write_excel_sheets([{
+                                'name': 'Datos',
+                                'data': processed_df,
+                                'rules': {col: 'norma' for col in norm_cols}
+                            }])
                             st.download_button(
                                 label="Descargar Excel",
                                 data=buffer,
@@ -1201,7 +4871,7 @@ def main():
             """)
     
     # Contenido principal
-    if 'uploaded_file' in locals() and uploaded_file is not None and 'processed_df' in locals():
+    if 'processed_df' in locals():
         
         # Dashboard principal
         st.markdown('<h2 class="sub-header">Dashboard Principal</h2>', unsafe_allow_html=True)
@@ -1241,49 +4911,61 @@ def main():
                 <div class="metric-label">Buses Incompletos</div>
             </div>
             """, unsafe_allow_html=True)
-        
+        mark_first_paint()
+
+        # Avance de los cálculos en segundo plano (se completa al final de la página)
+        progress_slot = st.container()
+
+        # Los artefactos pesados se envían de inmediato y se pintan a medida que terminan
+        # (las figuras salen de la caché de gráficos si otra ejecución o sesión ya las construyó)
+        pie_job = submit_background('graficos_avance', "gráficos de avance", data_key, cached_figure,
+                                    data_key, 'avance', None, create_pie_charts, processed_df, norm_cols)
+        heatmap_job = submit_background('mapa_normas', "avance por norma", data_key, cached_figure,
+                                        data_key, 'mapa_normas', None, create_norm_heatmap, metrics)
+        subclass_job = submit_background('graficos_subclase', "gráfico por tipo de bus", data_key, cached_figure,
+                                         data_key, 'subclase', None, create_subclass_charts, processed_df, norm_cols)
+        reporte_job = submit_background('reporte_completo', "reporte completo", data_key,
+                                        build_full_report, metrics)
+
         # Gráficos principales
         st.markdown('<h3 class="sub-header">Análisis de Avance</h3>', unsafe_allow_html=True)
         
-        col1, col2 = st.columns(2)
-        
-        with col1:
+        def render_pie_charts(figures):
+            fig_global, fig_terminal = figures
+            col1, col2 = st.columns(2)
+            with col1:
+                render_global_chart(fig_global)
+            with col2:
+                render_terminal_chart(fig_terminal)
+
+        def render_global_chart(fig_global):
             # Estado global de instalación (gráfico de pastel)
-            fig_global, fig_terminal = create_pie_charts(processed_df, norm_cols)
             if fig_global:
                 st.plotly_chart(fig_global, use_container_width=True)
             else:
                 st.info("No se pudo generar el gráfico circular. Para ver todos los gráficos, instala plotly con: pip install plotly")
                 # Mostrar un resumen básico en texto como alternativa
-                total_normas = len(processed_df) * len(norm_cols)
-                instaladas = 0
-                no_aplica = 0
-                
-                for col in norm_cols:
-                    # Contar instaladas y no aplica
-                    values = processed_df[col].astype(str).str.lower()
-                    instaladas += ((values == '1') | 
-                                  (values == 'instalada') | 
-                                  (values == 'instalado') |
-                                  (values.str.contains('instalad'))).sum()
-                    no_aplica += values.str.contains('no aplica').sum()
-                
+                # Contar instaladas y no aplica desde la matriz de estado ya calculada
+                status = metrics['status_matrix'] if 'status_matrix' in metrics else compute_status_matrix(processed_df, norm_cols)
+                total_normas = status.size
+                instaladas = int((status == ESTADO_INSTALADA).sum())
+                no_aplica = int((status == ESTADO_NO_APLICA).sum())
                 pendientes = total_normas - instaladas - no_aplica
                 
                 st.write(f"**Resumen de estado:**")
                 st.write(f"- Normas instaladas: {instaladas} ({instaladas/total_normas*100:.1f}%)")
                 st.write(f"- Normas no aplicables: {no_aplica} ({no_aplica/total_normas*100:.1f}%)")
                 st.write(f"- Normas pendientes: {pendientes} ({pendientes/total_normas*100:.1f}%)")
-            
-        with col2:
+
+        def render_terminal_chart(fig_terminal):
             # Avance por terminal
             if fig_terminal:
                 st.plotly_chart(fig_terminal, use_container_width=True)
             else:
                 st.info("No se pudo generar el gráfico por terminal.")
                 # Si no hay gráfico, mostrar métricas básicas
-                terminal_col = next((col for col in processed_df.columns if 'term' in col.lower()), None)
-                if terminal_col:
+                terminal_col = bus_group_columns(resolve_columns(processed_df))['Terminal']
+                if terminal_col is not None:
                     st.write(f"**Terminales presentes en los datos:**")
                     terminals = processed_df[terminal_col].dropna().unique()
                     for terminal in terminals:
@@ -1292,58 +4974,87 @@ def main():
                         st.write(f"- {terminal}")
                 else:
                     st.write("No se encontró información de terminales en los datos.")
+
+        show_background(pie_job, render_pie_charts)
+
+        # Métricas ponderadas con la tabla de metadatos de normas, junto a las no ponderadas
+        if 'status_matrix' in metrics:
+            st.markdown('<h3 class="sub-header">Métricas Ponderadas</h3>', unsafe_allow_html=True)
+            aligned, weighted = get_weighted_metrics(data_key, norm_metadata_key(active_metadata),
+                                                     metrics['status_matrix'], norm_cols, active_metadata)
+            if active_metadata is None:
+                st.info("Carga una tabla de metadatos de normas (barra lateral) con peso, costo, minutos de instalación "
+                        "y prioridad para ver la eficiencia ponderada, el costo y las horas restantes.")
+            else:
+                col1, col2, col3 = st.columns(3)
+                if weighted['eficiencia_ponderada'] is not None:
+                    col1.metric("Eficiencia ponderada", f"{weighted['eficiencia_ponderada']:.2f}%",
+                                delta=f"{weighted['eficiencia_ponderada'] - metrics['efficiency']:.2f} pp frente a "
+                                      f"{metrics['efficiency']}% sin ponderar", delta_color="off")
+                else:
+                    col1.metric("Eficiencia ponderada", "-", help="Todas las normas tienen peso 0")
+                col2.metric("Costo restante", f"{weighted['costo_restante']:,.0f}")
+                col3.metric("Horas de instalación restantes", f"{weighted['horas_restantes']:,.1f} h")
+                if aligned['sin_datos']:
+                    st.caption(f"{len(aligned['sin_datos'])} normas sin fila en la tabla (peso 1, sin costo ni minutos): "
+                               + ", ".join(map(str, aligned['sin_datos'][:5])) + ("..." if len(aligned['sin_datos']) > 5 else ""))
+                if aligned['sin_usar']:
+                    st.caption(f"{len(aligned['sin_usar'])} filas de la tabla no corresponden a normas de la planilla: "
+                               + ", ".join(aligned['sin_usar'][:5]) + ("..." if len(aligned['sin_usar']) > 5 else ""))
+
+                weighted_tabs = st.tabs(["Por Terminal", "Por Subclase", "Por Prioridad", "Por Bus"])
+                for tab, group_col in zip(weighted_tabs[:2], ['Terminal', 'Subclase']):
+                    with tab:
+                        if group_col in metrics['bus_groups']:
+                            st.dataframe(weighted_group_summary(weighted, metrics['bus_groups'][group_col], group_col),
+                                         use_container_width=True, hide_index=True)
+                        else:
+                            st.info(f"No se encontró la columna {group_col} en los datos.")
+                with weighted_tabs[2]:
+                    st.dataframe(weighted['prioridades'], use_container_width=True, hide_index=True)
+                with weighted_tabs[3]:
+                    weighted_buses = weighted_bus_table(metrics, weighted)
+                    st.dataframe(weighted_buses, use_container_width=True, hide_index=True, column_config={
+                        'Progreso': st.column_config.NumberColumn('Progreso', format="%.1f%%"),
+                        'Progreso Ponderado': st.column_config.NumberColumn('Progreso Ponderado', format="%.1f%%")
+                    })
+                    st.download_button(
+                        label="Descargar métricas ponderadas por bus (CSV)",
+                        data=lambda: weighted_buses.to_csv(index=False).encode('utf-8'),
+                        file_name=f"metricas_ponderadas_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
+                        mime="text/csv",
+                        key='weighted_download'
+                    )
+            st.download_button(
+                label="Descargar plantilla de metadatos (CSV)",
+                data=lambda: norm_metadata_template(norm_cols, active_metadata).to_csv(index=False).encode('utf-8'),
+                file_name="normas_metadatos.csv",
+                mime="text/csv",
+                key='metadata_template_download'
+            )
         
         # Resumen global de completos vs pendientes
         st.markdown('<h3 class="sub-header">Resumen de Estado de Buses</h3>', unsafe_allow_html=True)
+
+        # Distribución del avance por bus (rangos configurables, cuantiles y por grupo), usada por
+        # los gráficos, la versión de texto y el resumen estadístico
+        edges_text = st.text_input("Límites de los rangos de avance (%)", value=", ".join(map(str, PROGRESS_BUCKET_EDGES)),
+                                   key='progress_edges')
+        try:
+            bucket_edges = parse_bucket_edges(edges_text)
+        except ValueError as e:
+            st.warning(f"{str(e)}. Se usan los rangos por defecto.")
+            bucket_edges = PROGRESS_BUCKET_EDGES
+        # Sin buses (o si calculate_metrics falló) no hay arreglo de avance: la distribución queda en cero
+        distribution = progress_distribution(metrics.get('progress_array', np.zeros(0)), bucket_edges,
+                                             metrics.get('bus_groups', {}))
+        avance_ranges = distribution['buckets']
         
         if PLOTLY_AVAILABLE:
-            # Gráfico comparativo de buses completos vs pendientes
-            fig_completion = px.pie(
-                names=['Buses Completos', 'Buses Pendientes'],
-                values=[metrics['complete_buses'], metrics['incomplete_buses']],
-                title="Distribución de Buses por Estado de Completitud",
-                color_discrete_sequence=['#28A745', '#DC3545'],
-                hole=0.4
-            )
-            fig_completion.update_layout(legend=dict(orientation="h", yanchor="bottom", y=-0.2, xanchor="center", x=0.5))
-            
-            # Mostrar desglose por rangos de avance
-            avance_ranges = {
-                "90-100%": 0,
-                "70-89%": 0,
-                "50-69%": 0,
-                "25-49%": 0,
-                "0-24%": 0
-            }
-            
-            for bus_id, info in metrics['bus_progress'].items():
-                progress = info['progress']
-                if progress >= 90:
-                    avance_ranges["90-100%"] += 1
-                elif progress >= 70:
-                    avance_ranges["70-89%"] += 1
-                elif progress >= 50:
-                    avance_ranges["50-69%"] += 1
-                elif progress >= 25:
-                    avance_ranges["25-49%"] += 1
-                else:
-                    avance_ranges["0-24%"] += 1
-            
-            # Mostrar resumen de rangos en gráfico
-            fig_ranges = px.bar(
-                x=list(avance_ranges.keys()),
-                y=list(avance_ranges.values()),
-                labels={'x': 'Rango de Avance', 'y': 'Cantidad de Buses'},
-                title="Distribución de Buses por Rango de Avance",
-                color=list(avance_ranges.keys()),
-                color_discrete_map={
-                    "90-100%": '#28A745',
-                    "70-89%": '#5CB85C',
-                    "50-69%": '#FFC107',
-                    "25-49%": '#FF9800',
-                    "0-24%": '#DC3545'
-                }
-            )
+            # Gráfico comparativo de buses completos vs pendientes y resumen de rangos
+            fig_completion = cached_figure(data_key, 'completitud', None, create_completion_chart,
+                                           metrics['complete_buses'], metrics['incomplete_buses'])
+            fig_ranges = cached_figure(data_key, 'rangos_avance', bucket_edges, create_progress_ranges_chart, avance_ranges)
             
             col1, col2 = st.columns(2)
             with col1:
@@ -1363,32 +5074,10 @@ def main():
                 st.write(f"- Buses Pendientes: {metrics['incomplete_buses']} ({metrics['incomplete_buses']/metrics['total_buses']*100:.1f}%)")
             
             with col2:
-                # Calcular rangos sin gráficos
-                avance_ranges = {
-                    "90-100%": 0,
-                    "70-89%": 0,
-                    "50-69%": 0,
-                    "25-49%": 0,
-                    "0-24%": 0
-                }
-                
-                for bus_id, info in metrics['bus_progress'].items():
-                    progress = info['progress']
-                    if progress >= 90:
-                        avance_ranges["90-100%"] += 1
-                    elif progress >= 70:
-                        avance_ranges["70-89%"] += 1
-                    elif progress >= 50:
-                        avance_ranges["50-69%"] += 1
-                    elif progress >= 25:
-                        avance_ranges["25-49%"] += 1
-                    else:
-                        avance_ranges["0-24%"] += 1
-                
                 st.write("**Distribución de Buses por Rango de Avance:**")
-                for rango, cantidad in avance_ranges.items():
+                for rango, cantidad, porcentaje in avance_ranges[['Rango', 'Buses', 'Porcentaje']].itertuples(index=False):
                     if cantidad > 0:
-                        st.write(f"- {rango}: {cantidad} buses ({cantidad/metrics['total_buses']*100:.1f}%)")
+                        st.write(f"- {rango}: {cantidad} buses ({porcentaje:.1f}%)")
         
         # Mostrar resumen estadístico
         st.markdown("""
@@ -1397,13 +5086,18 @@ def main():
             <div style="display: flex; flex-wrap: wrap; justify-content: space-between;">
         """, unsafe_allow_html=True)
         
-        # Computar estadísticas adicionales
-        progress_values = [info['progress'] for info in metrics['bus_progress'].values()]
+        # Estadísticas de la distribución (mediana e intercuartiles con interpolación, como np.quantile)
+        def percent_text(value):
+            return f"{value:.1f}%" if value is not None else "N/A"
+
+        quantiles = distribution['quantiles']
         stats = {
-            "Promedio de Avance": f"{sum(progress_values) / len(progress_values):.1f}%" if progress_values else "N/A",
-            "Mediana de Avance": f"{sorted(progress_values)[len(progress_values)//2]:.1f}%" if progress_values else "N/A",
-            "Máximo Avance": f"{max(progress_values):.1f}%" if progress_values else "N/A",
-            "Mínimo Avance": f"{min(progress_values):.1f}%" if progress_values else "N/A",
+            "Promedio de Avance": percent_text(distribution['mean']),
+            "Mediana de Avance": percent_text(quantiles[0.5]),
+            "Desviación Estándar": percent_text(distribution['std']),
+            "Rango Intercuartil (P25-P75)": f"{percent_text(quantiles[0.25])} - {percent_text(quantiles[0.75])}",
+            "Máximo Avance": percent_text(distribution['max']),
+            "Mínimo Avance": percent_text(distribution['min']),
             "Buses Completos": f"{metrics['complete_buses']} ({metrics['complete_buses']/metrics['total_buses']*100:.1f}%)" if metrics['total_buses'] > 0 else "0 (0%)",
             "Buses Pendientes": f"{metrics['incomplete_buses']} ({metrics['incomplete_buses']/metrics['total_buses']*100:.1f}%)" if metrics['total_buses'] > 0 else "0 (0%)"
         }
@@ -1420,15 +5114,22 @@ def main():
             </div>
         </div>
         """, unsafe_allow_html=True)
+
+        # Distribución del avance por Terminal y Subclase
+        for group_col, group_stats in distribution['groups'].items():
+            if len(group_stats) > 1:
+                with st.expander(f"Distribución del avance por {group_col}"):
+                    st.dataframe(group_stats.rename(columns={'Grupo': group_col}), use_container_width=True, hide_index=True)
         
         # Análisis por tipo de norma
         st.markdown('<h3 class="sub-header">Análisis por Tipo de Norma</h3>', unsafe_allow_html=True)
         
         # Heatmap de instalación por norma
-        fig_heatmap = create_norm_heatmap(metrics)
-        if fig_heatmap:
-            st.plotly_chart(fig_heatmap, use_container_width=True)
-        else:
+        def render_heatmap(fig_heatmap):
+            if fig_heatmap:
+                st.plotly_chart(fig_heatmap, use_container_width=True)
+                return
+
             st.info("No se pudo generar el gráfico de normas. Para ver este gráfico, instala plotly.")
             # Alternativa: Mostrar las normas y su porcentaje en una tabla
             norm_progress = metrics['norm_progress']
@@ -1441,18 +5142,21 @@ def main():
             # Mostrar tabla con formato condicional
             st.write("**Porcentaje de avance por norma:**")
             st.dataframe(df_normas, use_container_width=True)
+
+        show_background(heatmap_job, render_heatmap)
         
         # Análisis por tipo de bus (subclase)
         st.markdown('<h3 class="sub-header">Análisis por Tipo de Bus</h3>', unsafe_allow_html=True)
         
-        fig_subclass = create_subclass_charts(processed_df, norm_cols)
-        if fig_subclass:
-            st.plotly_chart(fig_subclass, use_container_width=True)
-        else:
+        def render_subclass_charts(fig_subclass):
+            if fig_subclass:
+                st.plotly_chart(fig_subclass, use_container_width=True)
+                return
+
             st.info("No se pudo generar el gráfico por tipo de bus.")
             # Mostrar información básica sobre subclases como alternativa
-            subclass_col = next((col for col in processed_df.columns if 'sub' in col.lower() or 'clas' in col.lower() or 'model' in col.lower()), None)
-            if subclass_col:
+            subclass_col = bus_group_columns(resolve_columns(processed_df))['Subclase']
+            if subclass_col is not None:
                 st.write(f"**Tipos de bus presentes en los datos:**")
                 subclases = [s for s in processed_df[subclass_col].dropna().unique() if not pd.isna(s)]
                 for subclase in subclases:
@@ -1460,19 +5164,18 @@ def main():
                     st.write(f"- {subclase}: {count} buses")
             else:
                 st.write("No se encontró información de tipos de bus en los datos.")
+
+        show_background(subclass_job, render_subclass_charts)
         
         # Análisis de normas faltantes más comunes
-        if 'bus_completion_status' in metrics and metrics['bus_completion_status']:
+        if 'missing_index' in metrics and metrics['bus_completion_status']:
             st.markdown('<h3 class="sub-header">Análisis de Normas Faltantes</h3>', unsafe_allow_html=True)
             
-            # Contar cuántas veces aparece cada norma como faltante
-            normas_faltantes_conteo = {}
-            for bus_id, missing_norms in metrics['bus_completion_status'].items():
-                for norm in missing_norms:
-                    if norm in normas_faltantes_conteo:
-                        normas_faltantes_conteo[norm] += 1
-                    else:
-                        normas_faltantes_conteo[norm] = 1
+            # Contar en cuántos buses falta cada norma (popcount sobre el índice de bitsets)
+            missing_index = metrics['missing_index']
+            normas_faltantes_conteo = {
+                norm: count for norm, count in index_missing_counts(missing_index).items() if count > 0
+            }
             
             if normas_faltantes_conteo:
                 # Ordenar por frecuencia
@@ -1487,15 +5190,7 @@ def main():
                 
                 # Preparar datos para gráfico
                 top_normas = normas_sorted[:10]
-                fig_top_normas = px.bar(
-                    x=[norm[0] for norm in top_normas],
-                    y=[norm[1] for norm in top_normas],
-                    labels={'x': 'Norma', 'y': 'Cantidad de Buses'},
-                    title="Top 10 Normas Faltantes",
-                    color=[norm[1] for norm in top_normas],
-                    color_continuous_scale='Reds'
-                )
-                fig_top_normas.update_layout(xaxis={'categoryorder': 'total descending'})
+                fig_top_normas = cached_figure(data_key, 'top_faltantes', None, create_top_missing_chart, top_normas)
                 st.plotly_chart(fig_top_normas, use_container_width=True)
                 
                 # Mostrar tabla de normas faltantes
@@ -1504,6 +5199,50 @@ def main():
                     for norm in normas_sorted
                 ])
                 st.dataframe(normas_df, use_container_width=True)
+
+                # Desglose de normas faltantes por terminal (intersección de bitsets norma x terminal)
+                if len(missing_index['groups'].get('Terminal', {})) > 1:
+                    with st.expander("Normas faltantes por Terminal"):
+                        por_terminal = index_missing_by_group(missing_index, 'Terminal')
+                        por_terminal = por_terminal.loc[[norm for norm, _ in normas_sorted]]
+                        st.dataframe(por_terminal, use_container_width=True)
+                
+                # Normas que faltan juntas (co-ocurrencia) y kits de normas compartidos por varios buses
+                st.markdown('<h3 class="sub-header">Normas que Faltan Juntas y Kits de Instalación</h3>', unsafe_allow_html=True)
+                missing_patterns = get_missing_patterns(
+                    data_key, metrics['status_matrix'], metrics['bus_ids'], norm_cols, metrics['bus_groups'].get('Terminal')
+                )
+                cooccurrence_measure = st.radio(
+                    "Medida", ["Buses", "Jaccard"], horizontal=True, key='cooccurrence_measure',
+                    help="Buses: cantidad de buses a los que les faltan ambas normas. "
+                         "Jaccard: buses con ambas sobre buses con alguna de las dos."
+                )
+                fig_cooccurrence = cached_figure(data_key, 'coocurrencia', cooccurrence_measure, create_cooccurrence_heatmap,
+                                                 missing_patterns['coocurrencia'], cooccurrence_measure)
+                if fig_cooccurrence is not None:
+                    st.plotly_chart(fig_cooccurrence, use_container_width=True)
+                
+                kits_df = missing_patterns['tabla']
+                if not kits_df.empty:
+                    shared = kits_df[kits_df['Buses'] > 1]
+                    st.markdown(f"**{len(kits_df)} kits distintos** de normas faltantes; "
+                                f"{len(shared)} se repiten en más de un bus ({int(shared['Buses'].sum())} buses).")
+                    st.dataframe(kits_df.head(KIT_TABLE_ROWS), use_container_width=True, hide_index=True,
+                                 column_config={'% Flota': st.column_config.NumberColumn(format="%.1f%%")})
+                    try:
+                        st.download_button(
+                            label="📄 Descargar Kits de Normas Faltantes",
+                            data=write_excel_sheets([{'name': 'Kits', 'data': kits_df, 'widths': {'Normas del Kit': 60}}]),
+                            file_name=f"kits_normas_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
+                            mime="application/vnd.ms-excel"
+                        )
+                    except ImportError:
+                        st.download_button(
+                            label="📄 Descargar Kits como CSV",
+                            data=kits_df.to_csv(index=False),
+                            file_name=f"kits_normas_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
+                            mime="text/csv"
+                        )
                 
                 # Recomendaciones basadas en las normas faltantes
                 st.markdown("""
@@ -1522,8 +5261,395 @@ def main():
                     </ol>
                 </div>
                 """, unsafe_allow_html=True)
-        
-        # Lista detallada de buses con normas faltantes
+
+                # Plan de trabajo: órdenes por terminal y cuadrilla-día
+                st.markdown('<h3 class="sub-header">Plan de Trabajo de Instalación</h3>', unsafe_allow_html=True)
+                col1, col2 = st.columns(2)
+                with col1:
+                    plan_capacity = st.number_input("Instalaciones por cuadrilla-día", min_value=1, value=20, step=1)
+                with col2:
+                    plan_crews = st.number_input("Cuadrillas por terminal", min_value=1, value=1, step=1)
+
+                terminals = metrics['bus_groups'].get('Terminal', np.full(len(metrics['bus_ids']), 'N/A'))
+                plan_job = submit_background(
+                    'plan_trabajo', "plan de trabajo", (data_key, plan_capacity, plan_crews),
+                    build_work_plan, metrics['status_matrix'], metrics['bus_ids'], norm_cols, terminals,
+                    plan_capacity, plan_crews
+                )
+
+                def render_work_plan(plan):
+                    orden_df, resumen_df, excel = plan
+                    if resumen_df.empty:
+                        return
+                    dias = resumen_df.groupby('Terminal')['Día'].max()
+                    col1, col2, col3 = st.columns(3)
+                    col1.metric("Cuadrillas-día necesarias", len(resumen_df))
+                    col2.metric("Días hasta completar (terminal más lenta)", int(dias.max()))
+                    col3.metric("Buses completados el primer día", int(resumen_df.loc[resumen_df['Día'] == 1, 'Buses Completados'].sum()))
+
+                    st.dataframe(resumen_df, use_container_width=True)
+                    with st.expander("Detalle de órdenes de trabajo por bus"):
+                        st.dataframe(orden_df, use_container_width=True)
+
+                    if excel is not None:
+                        st.download_button(
+                            label="📄 Descargar Órdenes de Trabajo",
+                            data=excel,
+                            file_name=f"ordenes_trabajo_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
+                            mime="application/vnd.ms-excel"
+                        )
+                    else:
+                        st.warning("La biblioteca xlsxwriter no está instalada. Para descargar las órdenes de trabajo, instala xlsxwriter con: pip install xlsxwriter")
+
+                show_background(plan_job, render_work_plan)
+
+        # Renovaciones: vencimientos, avance por mes de renovación y burn-down de instalaciones
+        if 'renewal_dates' in metrics and not np.isnat(metrics['renewal_dates']).all():
+            st.markdown('<h3 class="sub-header">Renovaciones y Proyección de Instalaciones</h3>', unsafe_allow_html=True)
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                renewal_days = st.number_input("Renovaciones dentro de (días)", min_value=1, value=RENEWAL_WINDOW_DAYS,
+                                               step=15, key='renewal_days')
+            with col2:
+                terminal_count = max(len(set(metrics['bus_groups'].get('Terminal', ['N/A']))), 1)
+                renewal_capacity = st.number_input("Instalaciones por día hábil (flota)", min_value=1,
+                                                   value=20 * terminal_count, step=5, key='renewal_capacity')
+            with col3:
+                renewal_incomplete = st.toggle("Solo buses incompletos", value=True, key='renewal_incomplete')
+
+            due_df = buses_due_for_renewal(metrics, renewal_days, only_incomplete=renewal_incomplete)
+            burndown_df, finish = renewal_burndown(metrics, renewal_capacity)
+            late = burndown_df['Pendientes Proyectadas'] > burndown_df['Máximo por Renovaciones']
+            col1, col2, col3 = st.columns(3)
+            col1.metric(f"Buses a renovar en {renewal_days} días", int((due_df['Estado Renovación'] == 'Por vencer').sum()))
+            col2.metric("Renovaciones vencidas", int((due_df['Estado Renovación'] == 'Vencida').sum()))
+            col3.metric("Término estimado", finish.strftime('%d/%m/%Y'))
+            if late.any():
+                st.warning(f"A {renewal_capacity} instalaciones por día hábil no se alcanza a cumplir las renovaciones "
+                           f"desde la semana del {burndown_df.loc[late.idxmax(), 'Semana'].strftime('%d/%m/%Y')}")
+
+            if PLOTLY_AVAILABLE:
+                fig_burndown = px.line(burndown_df, x='Semana', y=['Pendientes Proyectadas', 'Máximo por Renovaciones'],
+                                       labels={'value': 'Instalaciones pendientes', 'variable': ''},
+                                       title="Burn-down de instalaciones pendientes")
+                st.plotly_chart(fig_burndown, use_container_width=True)
+            else:
+                st.line_chart(burndown_df.set_index('Semana'))
+
+            col1, col2 = st.columns(2)
+            with col1:
+                st.markdown(f"**Buses con renovación dentro de {renewal_days} días**")
+                st.dataframe(due_df, use_container_width=True, hide_index=True,
+                             column_config=dict(PROGRESS_COLUMN_CONFIG, **{
+                                 'Fecha Renovación': st.column_config.DateColumn('Fecha Renovación', format="DD/MM/YYYY")
+                             }))
+            with col2:
+                st.markdown("**Avance por mes de renovación**")
+                st.dataframe(completion_by_renewal_month(metrics), use_container_width=True, hide_index=True,
+                             column_config={'% Completos': st.column_config.NumberColumn('% Completos', format="%.1f%%")})
+
+        # Pronóstico de término a partir de los cortes registrados
+        st.markdown('<h3 class="sub-header">Pronóstico de Término</h3>', unsafe_allow_html=True)
+        # Solo los cortes de la misma flota (planillas con las mismas columnas de información)
+        forecast_store = get_forecast_store(forecast_db_path())
+        st.caption(f"Historial de cortes guardado en {forecast_store['path']} (cambie la ubicación con NORMAS_HISTORIAL "
+                   "o NORMAS_DATOS_DIR).")
+        forecast_df = forecast_completion(forecast_store, flota=fleet_key)
+        all_snapshots_df = list_snapshots(forecast_store)
+        snapshots_df = all_snapshots_df[all_snapshots_df['Flota'] == fleet_key]
+        fleet_forecast = forecast_df[forecast_df['Tipo'] == 'Flota']
+        if len(snapshots_df) < 2 or fleet_forecast.empty:
+            st.info("El pronóstico necesita al menos 2 cortes con fechas distintas de esta flota. Las planillas de la "
+                    "carpeta vigilada se registran solas (fecha de modificación); un archivo subido se registra con "
+                    "el botón \"Registrar corte\" de la barra lateral, después de elegir la fecha del corte.")
+        else:
+            fleet = fleet_forecast.iloc[0]
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Cortes registrados", int(fleet['Cortes']))
+            col2.metric("Velocidad de la flota", f"{fleet['Velocidad (normas/día)']:.1f} normas/día")
+            if pd.notna(fleet['Fecha Estimada']):
+                band = ""
+                if pd.notna(fleet['Banda Temprana']) and pd.notna(fleet['Banda Tardía']):
+                    band = f"entre {fleet['Banda Temprana'].strftime('%d/%m/%Y')} y {fleet['Banda Tardía'].strftime('%d/%m/%Y')} (95%)"
+                col3.metric("Flota al 100%", fleet['Fecha Estimada'].strftime('%d/%m/%Y'))
+                if band:
+                    col3.caption(band)
+            else:
+                col3.metric("Flota al 100%", "Sin avance")
+
+            history, projection = forecast_curve(forecast_store, fleet, flota=fleet_key)
+            if PLOTLY_AVAILABLE:
+                fig_forecast = go.Figure()
+                fig_forecast.add_trace(go.Scatter(x=history['Fecha'], y=history['Instaladas'], mode='lines+markers', name='Instaladas'))
+                if projection is not None:
+                    if 'Banda Superior' in projection and 'Banda Inferior' in projection:
+                        fig_forecast.add_trace(go.Scatter(x=projection['Fecha'], y=projection['Banda Superior'], mode='lines',
+                                                          line={'width': 0}, showlegend=False, hoverinfo='skip'))
+                        fig_forecast.add_trace(go.Scatter(x=projection['Fecha'], y=projection['Banda Inferior'], mode='lines',
+                                                          line={'width': 0}, fill='tonexty', fillcolor='rgba(30, 136, 229, 0.2)',
+                                                          name='Banda 95%'))
+                    fig_forecast.add_trace(go.Scatter(x=projection['Fecha'], y=projection['Proyección'], mode='lines',
+                                                      line={'dash': 'dash'}, name='Proyección'))
+                fig_forecast.add_hline(y=float(fleet['Requeridas']), line_dash='dot', annotation_text='100%')
+                fig_forecast.update_layout(title="Normas instaladas y proyección de la flota",
+                                           xaxis_title='Fecha', yaxis_title='Normas instaladas')
+                st.plotly_chart(fig_forecast, use_container_width=True)
+            else:
+                st.line_chart(pd.concat([history, projection]).set_index('Fecha') if projection is not None else history.set_index('Fecha'))
+
+            forecast_type = st.radio("Pronóstico por", ['Terminal', 'Norma'], horizontal=True, key='forecast_type')
+            st.dataframe(
+                forecast_df[forecast_df['Tipo'] == forecast_type].drop(columns=['Tipo']),
+                use_container_width=True, hide_index=True,
+                column_config={
+                    'Avance': st.column_config.NumberColumn('Avance', format="%.1f%%"),
+                    'Velocidad (normas/día)': st.column_config.NumberColumn('Velocidad (normas/día)', format="%.2f"),
+                    'Velocidad Mínima': st.column_config.NumberColumn('Velocidad Mínima', format="%.2f"),
+                    'Velocidad Máxima': st.column_config.NumberColumn('Velocidad Máxima', format="%.2f"),
+                    'Fecha Estimada': st.column_config.DateColumn('Fecha Estimada', format="DD/MM/YYYY"),
+                    'Banda Temprana': st.column_config.DateColumn('Banda Temprana', format="DD/MM/YYYY"),
+                    'Banda Tardía': st.column_config.DateColumn('Banda Tardía', format="DD/MM/YYYY")
+                }
+            )
+        with st.expander(f"Cortes registrados ({len(snapshots_df)})"):
+            st.dataframe(snapshots_df.drop(columns=['Corte', 'Flota']), use_container_width=True, hide_index=True,
+                         column_config={'Fecha del Corte': st.column_config.DateColumn('Fecha del Corte', format="DD/MM/YYYY")})
+            snapshot_labels = {row['Corte']: f"{row['Planilla']} ({row['Fecha del Corte'].strftime('%d/%m/%Y')})"
+                               for _, row in snapshots_df.iterrows()}
+            delete_hashes = st.multiselect("Cortes a borrar", options=list(snapshot_labels),
+                                           format_func=snapshot_labels.get, key='forecast_delete')
+            other_snapshots = all_snapshots_df[all_snapshots_df['Flota'] != fleet_key]
+            if len(other_snapshots):
+                st.caption(f"El historial tiene además {len(other_snapshots)} cortes de planillas con otras columnas "
+                           "de información (otras flotas o registrados antes de separar el historial por flota).")
+            col1, col2, col3 = st.columns(3)
+            if col1.button("Borrar cortes seleccionados", key='forecast_delete_selected', disabled=not delete_hashes):
+                delete_snapshots(forecast_store, delete_hashes)
+                st.session_state.pop('recorded_snapshot', None)
+                st.rerun()
+            if len(other_snapshots) and col2.button("Borrar cortes de otras flotas", key='forecast_delete_others'):
+                delete_snapshots(forecast_store, other_snapshots['Corte'].tolist())
+                st.rerun()
+            if col3.button("Borrar historial de cortes", key='forecast_clear'):
+                clear_forecast_store(forecast_store)
+                st.session_state.pop('recorded_snapshot', None)
+                st.rerun()
+
+        # Auditoría de datos: "No Aplica" que se aparta de sus pares y contador NORMA INSTALADA
+        if 'status_matrix' in metrics:
+            st.markdown('<h3 class="sub-header">Auditoría de Datos</h3>', unsafe_allow_html=True)
+            tab_no_aplica, tab_contador = st.tabs(["\"No Aplica\" sospechosos", "Contador NORMA INSTALADA"])
+            
+            with tab_no_aplica:
+                col1, col2 = st.columns(2)
+                with col1:
+                    audit_share = st.slider("Pares que aplican la norma (%)", min_value=50, max_value=100,
+                                            value=int(AUDIT_PEER_SHARE * 100), step=5, key='audit_peer_share')
+                with col2:
+                    audit_min_group = st.number_input("Buses mínimos por grupo", min_value=2, value=AUDIT_MIN_GROUP,
+                                                      step=1, key='audit_min_group')
+                anomalies_df = no_aplica_anomalies(
+                    metrics['status_matrix'], metrics['bus_ids'], norm_cols, metrics['peer_groups'],
+                    min_group=int(audit_min_group), peer_share=audit_share / 100,
+                    group_counts=get_group_status_counts(data_key, metrics['status_matrix'], metrics['peer_groups'])
+                )
+                suspicious = anomalies_df[anomalies_df['Estado'] == STATUS_LABELS[ESTADO_NO_APLICA]]
+                total_cells = metrics['total_buses'] * metrics['total_norms']
+                audited_efficiency = ((metrics['completed_installations'] - len(suspicious)) / total_cells * 100
+                                      if total_cells else 0)
+                
+                col1, col2, col3 = st.columns(3)
+                col1.metric("\"No Aplica\" sospechosos", len(suspicious))
+                col2.metric("Pendientes donde el grupo no aplica", len(anomalies_df) - len(suspicious))
+                col3.metric("Eficiencia sin los sospechosos", f"{audited_efficiency:.2f}%",
+                            delta=f"{audited_efficiency - metrics['efficiency']:.2f} pp", delta_color="off")
+                
+                if anomalies_df.empty:
+                    st.success("No hay celdas que se aparten de su grupo con los umbrales elegidos.")
+                else:
+                    por_norma = suspicious.groupby('Norma').size().sort_values(ascending=False)
+                    if not por_norma.empty:
+                        st.markdown("**Normas con más \"No Aplica\" sospechosos:** " +
+                                    ", ".join(f"{norm} ({count})" for norm, count in por_norma.head(5).items()))
+                    st.dataframe(anomalies_df.drop(columns='_fila'), use_container_width=True, hide_index=True)
+            
+            with tab_contador:
+                if metrics.get('installed_counter') is None:
+                    st.info("La planilla no tiene columna NORMA INSTALADA para conciliar.")
+                    counter_df = pd.DataFrame()
+                else:
+                    counter_df, counter_summary = reconcile_installed_counter(
+                        metrics['installed_counter'], metrics['status_matrix'], metrics['bus_ids']
+                    )
+                    cols = st.columns(len(counter_summary))
+                    for col, (label, count) in zip(cols, counter_summary.items()):
+                        col.metric(label, int(count))
+                    if counter_df.empty:
+                        st.success("El contador NORMA INSTALADA coincide con las normas instaladas en todos los buses.")
+                    else:
+                        st.dataframe(counter_df, use_container_width=True, hide_index=True)
+            
+            # Exportación de la auditoría (ambas hojas)
+            if not anomalies_df.empty or not counter_df.empty:
+                try:
+                    st.download_button(
+                        label="📄 Descargar Auditoría de Datos",
+                        data=write_excel_sheets([
+                            {'name': 'No Aplica Sospechosos', 'data': anomalies_df.drop(columns='_fila')},
+                            {'name': 'Contador NORMA INSTALADA', 'data': counter_df}
+                        ]),
+                        file_name=f"auditoria_normas_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
+                        mime="application/vnd.ms-excel"
+                    )
+                except ImportError:
+                    st.warning("La biblioteca xlsxwriter no está instalada. Para poder descargar en formato Excel, instala xlsxwriter con: pip install xlsxwriter")
+
+        # Corrección de estados: grilla editable de un bus o de una terminal
+        if 'status_matrix' in metrics and norm_cols:
+            st.markdown('<h3 class="sub-header">Corrección de Estados</h3>', unsafe_allow_html=True)
+            col1, col2 = st.columns([1, 3])
+            with col1:
+                edit_scope = st.radio("Editar por", ["Bus", "Terminal"], horizontal=True, key='edit_scope')
+            with col2:
+                edit_bus_ids = np.asarray(metrics['bus_ids'], dtype=object)
+                if edit_scope == "Bus":
+                    edit_choice = st.selectbox("Bus", edit_bus_ids, key='edit_bus')
+                    edit_rows = np.flatnonzero(edit_bus_ids == edit_choice)[:1]
+                else:
+                    edit_terminals = metrics['bus_groups'].get('Terminal', np.full(len(edit_bus_ids), 'N/A'))
+                    edit_choice = st.selectbox("Terminal", sorted(pd.unique(edit_terminals)), key='edit_terminal')
+                    edit_rows = np.flatnonzero(edit_terminals == edit_choice)
+            if len(edit_rows) > EDIT_MAX_ROWS:
+                st.caption(f"Se muestran los primeros {EDIT_MAX_ROWS} de {len(edit_rows)} buses; "
+                           "use la consulta de buses de la barra lateral para acotar la lista.")
+                edit_rows = edit_rows[:EDIT_MAX_ROWS]
+            
+            # Un bus se edita con las normas como filas; una terminal, con un bus por fila
+            edit_grid = status_edit_grid(metrics, edit_rows, norm_cols)
+            edit_view = edit_grid.T.rename_axis('Norma') if edit_scope == "Bus" else edit_grid
+            status_options = [STATUS_LABELS[code] for code in sorted(STATUS_LABELS)]
+            edited_view = st.data_editor(
+                edit_view,
+                key=f"status_editor_{status_edits['version']}_{edit_scope}_{edit_choice}",
+                column_config={str(col): st.column_config.SelectboxColumn(str(col), options=status_options, required=True)
+                               for col in edit_view.columns},
+                use_container_width=True
+            )
+            edit_changes = status_grid_changes(edit_grid, edited_view.T if edit_scope == "Bus" else edited_view, edit_rows)
+            if edit_changes:
+                record_status_edits(status_edits, df, processed_df, edit_changes)
+                st.rerun()
+            
+            cambios = status_edits['cambios']
+            if cambios:
+                edit_positions = dict(zip(processed_df.index, metrics['bus_ids']))
+                st.markdown(f"**{len(cambios)} celdas corregidas** en esta sesión; las métricas ya las incluyen.")
+                st.dataframe(pd.DataFrame([
+                    {'Fila': int(label) + 1, 'Número Interno': edit_positions.get(label, '(fuera del filtro)'), 'Norma': norm,
+                     'Estado': STATUS_LABELS[code], 'Valor en la planilla': '' if value is None else str(value)}
+                    for (label, norm), (code, value) in cambios.items()
+                ]), use_container_width=True, hide_index=True)
+                
+                # La copia se escribe sobre el XML del .xlsx; un .xls (formato binario antiguo) no se puede reescribir
+                original_name = watched['name'] if watched is not None else uploaded_file.name
+                patchable = original_name.lower().endswith('.xlsx')
+                col1, col2 = st.columns(2)
+                with col1:
+                    if patchable:
+                        if st.button("Preparar copia de la planilla con los cambios", key='edit_patch'):
+                            st.session_state['edit_patch_requested'] = edits_key
+                    else:
+                        st.caption("La copia corregida solo está disponible para planillas .xlsx: guarda el "
+                                   "archivo .xls como .xlsx en Excel y vuelve a cargarlo para descargar los cambios.")
+                with col2:
+                    if st.button("Descartar cambios", key='edit_discard'):
+                        status_edits['cambios'] = {}
+                        status_edits['version'] += 1
+                        st.rerun()
+                
+                # Copia del archivo original con solo las celdas corregidas reescritas
+                if patchable and st.session_state.get('edit_patch_requested') == edits_key:
+                    if watched is not None:
+                        with open(watched['path'], 'rb') as f:
+                            original_content = f.read()
+                    else:
+                        original_content = uploaded_file.getvalue()
+                    patch_job = submit_background('planilla_corregida', "copia corregida de la planilla",
+                                                  (content_hash, edits_key), patch_workbook_cells,
+                                                  original_content, list(df.columns), dict(cambios))
+                    
+                    def render_patched_workbook(result):
+                        content, written = result
+                        st.caption(f"{written} celdas reescritas en la copia; el resto del libro queda igual.")
+                        st.download_button(
+                            label="📄 Descargar Planilla Corregida",
+                            data=content,
+                            file_name=f"{os.path.splitext(original_name)[0]}_corregida_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
+                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                        )
+                    
+                    show_background(patch_job, render_patched_workbook)
+
+        # Consola SQL sobre los datos procesados (DuckDB, opcional)
+        if 'status_matrix' in metrics and norm_cols:
+            st.markdown('<h3 class="sub-header">Consola SQL</h3>', unsafe_allow_html=True)
+            if not DUCKDB_AVAILABLE:
+                st.info("Para consultar los datos con SQL instala DuckDB con: pip install duckdb")
+            else:
+                sql_console = get_sql_console(data_key, processed_df, norm_cols, metrics['status_matrix'], metrics['bus_ids'])
+                sql_examples_list = sql_examples(sql_console)
+                with st.expander("Tablas y consultas de ejemplo"):
+                    for table_name, fields in sql_console['esquema'].items():
+                        st.markdown(f"**{table_name}** ({sql_console['tablas'][table_name].num_rows} filas): " +
+                                    ", ".join(f"`{name}` {kind}" for name, kind in fields))
+                    for example in sql_examples_list:
+                        st.code(example, language='sql')
+                sql_text = st.text_area("Consulta SQL", value=sql_examples_list[0], height=120, key='sql_query')
+                
+                if sql_text.strip():
+                    try:
+                        sql_result = run_sql_query(sql_console, sql_text)
+                    except ValueError as e:
+                        st.error(f"Consulta inválida: {str(e)}")
+                        sql_result = None
+                    
+                    if sql_result is not None:
+                        sql_rows = sql_result['tabla'].num_rows
+                        st.caption(f"{sql_rows} filas en {sql_result['segundos'] * 1000:.0f} ms" +
+                                   (f" (se muestran las primeras {SQL_MAX_ROWS})" if sql_result['truncado'] else ""))
+                        sql_pages = max(1, -(-sql_rows // SQL_PAGE_SIZE))
+                        if not 1 <= st.session_state.get('sql_page', 1) <= sql_pages:
+                            st.session_state['sql_page'] = 1
+                        if sql_pages > 1:
+                            sql_page = st.number_input(f"Página (1-{sql_pages})", min_value=1, max_value=sql_pages,
+                                                       step=1, key='sql_page')
+                        else:
+                            sql_page = 1
+                        st.dataframe(sql_result_page(sql_result, int(sql_page)), use_container_width=True, hide_index=True)
+                        
+                        # Exportación del resultado completo (se genera al hacer clic)
+                        col1, col2 = st.columns(2)
+                        with col1:
+                            st.download_button(
+                                label="📄 Descargar Resultado (CSV)",
+                                data=lambda: sql_result_csv(sql_result),
+                                file_name=f"consulta_normas_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
+                                mime="text/csv",
+                                key='sql_download_csv'
+                            )
+                        with col2:
+                            # Límite de filas de una hoja de Excel
+                            if XLSXWRITER_AVAILABLE and sql_rows < 1048576:
+                                st.download_button(
+                                    label="📄 Descargar Resultado (Excel)",
+                                    data=lambda: write_excel_sheets([{'name': 'Consulta', 'data': sql_result['tabla'].to_pandas()}]),
+                                    file_name=f"consulta_normas_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
+                                    mime="application/vnd.ms-excel",
+                                    key='sql_download_excel'
+                                )
+
+        # Lista detallada de buses con normas faltantes (None si no hay buses pendientes)
+        buses_pendientes_df = None
         if 'bus_completion_status' in metrics and metrics['bus_completion_status']:
             st.markdown('<h3 class="sub-header">Listado Detallado de Buses Pendientes</h3>', unsafe_allow_html=True)
             
@@ -1543,56 +5669,69 @@ def main():
                     ["Número de normas faltantes (mayor a menor)", "Número de normas faltantes (menor a mayor)", "Número Interno"]
                 )
             
-            # Crear dataframe de buses pendientes con detalles
-            buses_pendientes_data = []
-            for bus_id, missing_norms in metrics['bus_completion_status'].items():
-                if len(missing_norms) >= filter_min_missing:
-                    # Obtener información adicional del bus
-                    bus_info = metrics['bus_progress'].get(bus_id, {})
-                    
-                    buses_pendientes_data.append({
-                        'Número Interno': bus_id,
-                        'PPU': bus_info.get('ppu', 'N/A'),
-                        'Terminal': bus_info.get('terminal', 'N/A'),
-                        'Subclase': bus_info.get('subclase', 'N/A'),
-                        'Normas Faltantes': len(missing_norms),
-                        'Progreso': f"{bus_info.get('progress', 0):.1f}%",
-                        'Detalle': ", ".join(missing_norms[:3]) + ("..." if len(missing_norms) > 3 else "")
-                    })
+            # Consulta por normas faltantes específicas (se suma a la consulta del listado)
+            selected_missing_norms = []
+            match_mode = "Todas"
+            if 'query_context' in metrics:
+                col1, col2 = st.columns([3, 1])
+                with col1:
+                    selected_missing_norms = st.multiselect(
+                        "Mostrar solo buses a los que les falta",
+                        options=norm_cols
+                    )
+                with col2:
+                    match_mode = st.radio("Coincidencia", ["Todas", "Alguna"], horizontal=True)
+            
+            # Crear dataframe de buses pendientes desde la máscara de la consulta compilada
+            buses_pendientes_df = pd.DataFrame()
+            if 'query_context' in metrics:
+                pending_context = metrics['query_context']
+                min_missing_query = f"faltantes >= {filter_min_missing}"
+                st.caption(f"Consulta: {combine_bus_queries([min_missing_query, query_missing_clause(selected_missing_norms, match_mode == 'Todas')])}")
+                # Las normas elegidas se marcan directo por posición (sin pasar sus nombres por el analizador)
+                rows = np.flatnonzero(bus_query_mask(pending_context, min_missing_query) &
+                                      norm_status_mask(pending_context, selected_missing_norms, match_all=match_mode == "Todas"))
+                bus_ids_rows = pending_context['valores']['interno'][rows]
+                buses_pendientes_df = pd.DataFrame({
+                    'Número Interno': bus_ids_rows,
+                    'PPU': pending_context['valores']['ppu'][rows],
+                    'Terminal': pending_context['valores']['terminal'][rows],
+                    'Subclase': pending_context['valores']['subclase'][rows],
+                    'Normas Faltantes': pending_context['campos']['faltantes'][rows],
+                    'Progreso': pending_context['campos']['progreso'][rows].round(1),
+                    'Detalle': [
+                        ", ".join(missing[:3]) + ("..." if len(missing) > 3 else "")
+                        for missing in (metrics['bus_completion_status'].get(bus_id, []) for bus_id in bus_ids_rows)
+                    ]
+                })
             
-            # Ordenar según la opción seleccionada
-            if sort_option == "Número de normas faltantes (mayor a menor)":
-                buses_pendientes_data.sort(key=lambda x: x['Normas Faltantes'], reverse=True)
-            elif sort_option == "Número de normas faltantes (menor a mayor)":
-                buses_pendientes_data.sort(key=lambda x: x['Normas Faltantes'])
-            else:  # Por número interno
-                buses_pendientes_data.sort(key=lambda x: x['Número Interno'])
+            # Ordenar según la opción seleccionada (orden estable: a igual valor, el de la planilla)
+            if not buses_pendientes_df.empty:
+                if sort_option == "Número de normas faltantes (mayor a menor)":
+                    sort_column, ascending = 'Normas Faltantes', False
+                elif sort_option == "Número de normas faltantes (menor a mayor)":
+                    sort_column, ascending = 'Normas Faltantes', True
+                else:  # Por número interno
+                    sort_column, ascending = 'Número Interno', True
+                buses_pendientes_df = buses_pendientes_df.sort_values(
+                    sort_column, ascending=ascending, kind='stable'
+                ).reset_index(drop=True)
             
             # Crear dataframe
-            if buses_pendientes_data:
-                buses_pendientes_df = pd.DataFrame(buses_pendientes_data)
-                
-                # Mostrar con formato condicional
-                def highlight_progress(val):
-                    progress = float(val.strip('%'))
-                    if progress >= 90:
-                        return 'background-color: #d4edda; color: #155724'
-                    elif progress >= 70:
-                        return 'background-color: #fff3cd; color: #856404'
-                    else:
-                        return 'background-color: #f8d7da; color: #721c24'
+            if not buses_pendientes_df.empty:
                 
-                styled_df = buses_pendientes_df.style.applymap(highlight_progress, subset=['Progreso'])
-                st.dataframe(styled_df, use_container_width=True)
+                # Mostrar con formato condicional (colores del progreso)
+                show_progress_table(buses_pendientes_df, {'Progreso': progress_style})
                 
                 # Opción para exportar la lista
                 try:
-                    # Intentar guardar con xlsxwriter
-                    buffer = io.BytesIO()
                     try:
-                        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-                            buses_pendientes_df.to_excel(writer, sheet_name='Buses Pendientes', index=False)
-                        buffer.seek(0)
+                        buffer = write_excel_sheets([{
+                            'name': 'Buses Pendientes',
+                            'data': buses_pendientes_df,
+                            'rules': {'Progreso': 'progreso'},
+                            'widths': {'Detalle': 60}
+                        }])
                         
                         st.download_button(
                             label="📄 Descargar Listado de Buses Pendientes",
@@ -1616,116 +5755,178 @@ def main():
         # Lista completa de buses con su estado
         st.markdown('<h3 class="sub-header">Reporte Completo por Bus</h3>', unsafe_allow_html=True)
         
-        # Crear reporte completo
-        reporte_buses = []
-        for bus_id, info in metrics['bus_progress'].items():
-            reporte_buses.append({
-                'Número Interno': bus_id,
-                'PPU': info.get('ppu', 'N/A'),
-                'Terminal': info.get('terminal', 'N/A'),
-                'Subclase': info.get('subclase', 'N/A'),
-                'Progreso': f"{info.get('progress', 0):.1f}%",
-                'Estado': "Completo" if info.get('completo', False) else "Pendiente",
-                'Normas Faltantes': len(info.get('normas_faltantes', [])),
-                'Detalle': ", ".join(info.get('normas_faltantes', [])[:3]) + ("..." if len(info.get('normas_faltantes', [])) > 3 else "")
-            })
-        
-        # Ordenar por progreso
-        reporte_buses.sort(key=lambda x: float(x['Progreso'].strip('%')), reverse=True)
+        # Exportación del reporte completo: un solo libro con resumen, avance por norma y
+        # terminal, reporte y pendientes (depende del listado filtrado de pendientes)
+        pendientes_key = int(pd.util.hash_pandas_object(buses_pendientes_df, index=False).sum()) if buses_pendientes_df is not None else None
+        export_job = submit_background('exportacion_reporte', "exportación del reporte", (data_key, pendientes_key),
+                                       export_full_report, metrics, reporte_job, buses_pendientes_df)
+
+        def render_full_report(reporte_df):
+            if reporte_df.empty:
+                return
+            # Formato condicional (colores del estado y del progreso)
+            show_progress_table(reporte_df, {'Estado': bus_status_style, 'Progreso': progress_style})
+            # Opción para exportar
+            show_background(export_job, lambda excel: render_report_download(reporte_df, excel))
+
+        def render_report_download(reporte_df, excel):
+            if excel is not None:
+                st.download_button(
+                    label="📄 Descargar Reporte Completo",
+                    data=excel,
+                    file_name=f"reporte_completo_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
+                    mime="application/vnd.ms-excel"
+                )
+            else:
+                # Si xlsxwriter no está disponible, convertir a CSV
+                csv = reporte_df.to_csv(index=False)
+                b64 = base64.b64encode(csv.encode()).decode()
+                href = f'<a href="data:file/csv;base64,{b64}" download="reporte_completo_{datetime.now().strftime("%Y%m%d_%H%M")}.csv">📄 Descargar como CSV</a>'
+                st.markdown(href, unsafe_allow_html=True)
+                st.warning("La biblioteca xlsxwriter no está instalada. Se ha generado un archivo CSV en su lugar. Para poder descargar en formato Excel, instala xlsxwriter con: pip install xlsxwriter")
+
+        show_background(reporte_job, render_full_report)
         
-        # Crear dataframe
-        if reporte_buses:
-            reporte_df = pd.DataFrame(reporte_buses)
+        # Lista de buses con progreso
+        # Reportes por bus materializados (una fila por bus en SQLite) para el detalle y el buscador; el
+        # almacén es de la planilla completa y no cambia con los filtros ni con la consulta
+        try:
+            bus_store = get_bus_report_store(report_key, df, norm_columns(df),
+                                             query_context['status'], query_context['valores']['interno'])
+        except (OSError, sqlite3.Error) as e:
+            st.warning(f"No se pudo preparar el almacén de reportes por bus: {str(e)}")
+            bus_store = None
+        # Con filtros, el buscador solo muestra los buses de la vista filtrada
+        visible_buses = None if query_mask.all() else set(np.asarray(query_context['valores']['interno'], dtype=object)[query_mask])
+
+        # Función para obtener el reporte de un bus: una fila del almacén o, si no está, el cálculo directo
+        def get_bus_report(bus_id):
+            report = lookup_bus_report(bus_store, bus_id) if bus_store is not None else None
+            return report if report is not None else generate_bus_report(processed_df, bus_id, norm_cols)
+
+        # Función para mostrar el detalle de un bus (lee una fila del almacén de reportes)
+        # origen distingue los elementos cuando el mismo bus aparece en el buscador y en la lista
+        def render_bus_detail(bus_id, origen='lista'):
+            bus_info, norm_status, progress = get_bus_report(bus_id)
+            
+            col1, col2 = st.columns([1, 2])
+            
+            with col1:
+                # Información básica del bus
+                st.markdown("### Información General")
+                for key, value in bus_info.items():
+                    if key not in ['NORMA INSTALADA', 'FECHA DE RENOVACION']:
+                        st.markdown(f"**{key}:** {value}")
+                
+                # Detalles de instalación
+                st.markdown("### Información de Instalación")
+                st.markdown(f"**Fecha de Renovación:** {bus_info.get('FECHA DE RENOVACION', 'N/A')}")
+                st.markdown(f"**Normas Instaladas:** {bus_info.get('NORMA INSTALADA', 'N/A')}")
+                
+                # Medidor de progreso
+                st.markdown("### Progreso de Instalación")
+                st.progress(progress / 100)
+                st.markdown(f"<h2 style='text-align: center;'>{progress}%</h2>", unsafe_allow_html=True)
             
-            # Formato condicional
-            def highlight_estado(val):
-                if val == 'Completo':
-                    return 'background-color: #d4edda; color: #155724'
+            with col2:
+                # Crear treemap
+                fig_treemap = cached_figure(data_key, 'treemap', bus_id, create_bus_treemap, processed_df, bus_id, norm_cols)
+                if fig_treemap:
+                    st.plotly_chart(fig_treemap, use_container_width=True, key=f"treemap_{origen}_{bus_id}")
                 else:
-                    return 'background-color: #f8d7da; color: #721c24'
+                    # Mostrar un resumen en forma de tabla
+                    bus_info, norm_status, progress = get_bus_report(bus_id)
+                    
+                    # Contar normas por estado
+                    instaladas = sum(1 for status in norm_status.values() if status == "Instalada")
+                    no_aplican = sum(1 for status in norm_status.values() if status == "No Aplica")
+                    pendientes = sum(1 for status in norm_status.values() if status == "Pendiente")
+                    
+                    st.write("**Resumen de normas por estado:**")
+                    col1, col2, col3 = st.columns(3)
+                    col1.metric("Instaladas", instaladas)
+                    col2.metric("No Aplican", no_aplican)
+                    col3.metric("Pendientes", pendientes)
+                    
+                    # Mostrar lista de normas pendientes
+                    if pendientes > 0:
+                        st.write("**Normas pendientes:**")
+                        for norm, status in norm_status.items():
+                            if status == "Pendiente":
+                                st.write(f"- {norm}")
             
-            def highlight_progress(val):
-                progress = float(val.strip('%'))
-                if progress >= 90:
-                    return 'background-color: #d4edda; color: #155724'
-                elif progress >= 70:
-                    return 'background-color: #fff3cd; color: #856404'
+            # Resumen de normas por estado
+            normas_pendientes = [norm for norm, status in norm_status.items() if status == "Pendiente"]
+            if normas_pendientes:
+                st.markdown("### Normas Pendientes por Instalar")
+                st.markdown(f"Este bus tiene **{len(normas_pendientes)} normas pendientes** por instalar:")
+                
+                # Mostrar en formato de tabla o lista según cantidad
+                if len(normas_pendientes) <= 10:
+                    for norm in normas_pendientes:
+                        st.markdown(f"- ❌ **{norm}**")
                 else:
-                    return 'background-color: #f8d7da; color: #721c24'
+                    # Para muchas normas, usar columnas
+                    cols = st.columns(3)
+                    for i, norm in enumerate(normas_pendientes):
+                        cols[i % 3].markdown(f"- ❌ **{norm}**")
+            else:
+                st.success("✅ Todas las normas requeridas están instaladas en este bus.")
             
-            styled_df = reporte_df.style.applymap(highlight_estado, subset=['Estado']).applymap(highlight_progress, subset=['Progreso'])
-            st.dataframe(styled_df, use_container_width=True)
+            # Tabla de estado de normas
+            st.markdown("### Estado Completo de Normas Gráficas")
             
-            # Opción para exportar
-            try:
-                # Intentar guardar con xlsxwriter
-                buffer = io.BytesIO()
-                try:
-                    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-                        reporte_df.to_excel(writer, sheet_name='Reporte Completo', index=False)
-                    buffer.seek(0)
-                    
-                    st.download_button(
-                        label="📄 Descargar Reporte Completo",
-                        data=buffer,
-                        file_name=f"reporte_completo_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-                        mime="application/vnd.ms-excel"
-                    )
-                except ImportError:
-                    # Si xlsxwriter no está disponible, convertir a CSV
-                    csv = reporte_df.to_csv(index=False)
-                    b64 = base64.b64encode(csv.encode()).decode()
-                    href = f'<a href="data:file/csv;base64,{b64}" download="reporte_completo_{datetime.now().strftime("%Y%m%d_%H%M")}.csv">📄 Descargar como CSV</a>'
-                    st.markdown(href, unsafe_allow_html=True)
-                    st.warning("La biblioteca xlsxwriter no está instalada. Se ha generado un archivo CSV en su lugar. Para poder descargar en formato Excel, instala xlsxwriter con: pip install xlsxwriter")
-            except Exception as e:
-                st.error(f"Error al exportar datos: {str(e)}")
-                st.info("Sugerencia: Instale xlsxwriter con el comando: pip install xlsxwriter")
-        
-        # Lista de buses con progreso
+            # Crear un DataFrame para mostrar las normas
+            df_norms = pd.DataFrame(list(norm_status.items()), columns=['Norma', 'Estado'])
+            
+            # Aplicar estilo condicional
+            styled_df = style_columns(df_norms, {
+                'Estado': category_styles(df_norms['Estado'], {'Instalada': STYLE_VERDE, 'No Aplica': STYLE_GRIS}, STYLE_ROJO)
+            })
+            st.dataframe(styled_df, use_container_width=True, key=f"normas_{origen}_{bus_id}")
+            
+            # Generar informe HTML descargable
+            bus_report_html = generate_bus_report_html(bus_info, norm_status, progress)
+            st.markdown(get_html_download_link(bus_report_html, f"informe_bus_{bus_id}.html", "📄 Descargar Informe Detallado"), unsafe_allow_html=True)
+
         st.markdown('<h3 class="sub-header">Detalle por Bus</h3>', unsafe_allow_html=True)
+
+        # Buscador por N° Interno o prefijo de PPU (búsqueda binaria en el índice ordenado)
+        if bus_store is not None:
+            busqueda = st.text_input("Buscar bus por N° Interno o PPU", key='bus_search', placeholder="Ej: 1023 o BCDF")
+            if busqueda:
+                resultados = search_buses(bus_store['search'], busqueda, allowed=visible_buses)
+                if resultados:
+                    bus_buscado = st.selectbox(f"Resultados ({len(resultados)})", resultados, key='bus_search_result')
+                    with st.container(border=True):
+                        render_bus_detail(bus_buscado, origen='buscador')
+                else:
+                    st.info(f"No se encontraron buses que comiencen con '{busqueda}'")
         
         # Opciones de filtro para la lista de buses
         col1, col2 = st.columns(2)
         with col1:
-            filter_option = st.selectbox(
-                "Filtrar buses por estado",
-                ["Todos", "Completos", "Incompletos", "Críticos (menos de 50%)"]
-            )
+            filter_option = st.selectbox("Filtrar buses por estado", BUS_LIST_FILTERS)
         
         with col2:
-            sort_option = st.selectbox(
-                "Ordenar por",
-                ["Número Interno", "Progreso (mayor a menor)", "Progreso (menor a mayor)"]
-            )
+            sort_option = st.selectbox("Ordenar por", BUS_LIST_SORTS)
         
-        # Filtrar y ordenar la lista de buses
+        # Índices ordenados y filtrados precalculados con el conjunto de datos: la página es un corte
         bus_progress = metrics['bus_progress']
-        bus_list = list(bus_progress.items())
-        
-        if filter_option == "Completos":
-            bus_list = [(bus_id, data) for bus_id, data in bus_list if data['progress'] == 100]
-        elif filter_option == "Incompletos":
-            bus_list = [(bus_id, data) for bus_id, data in bus_list if data['progress'] < 100]
-        elif filter_option == "Críticos (menos de 50%)":
-            bus_list = [(bus_id, data) for bus_id, data in bus_list if data['progress'] < 50]
-        
-        if sort_option == "Número Interno":
-            bus_list.sort(key=lambda x: x[0])
-        elif sort_option == "Progreso (mayor a menor)":
-            bus_list.sort(key=lambda x: x[1]['progress'], reverse=True)
-        elif sort_option == "Progreso (menor a mayor)":
-            bus_list.sort(key=lambda x: x[1]['progress'])
-        
-        # Mostrar lista paginada
-        bus_list_chunked = [bus_list[i:i + 10] for i in range(0, len(bus_list), 10)]
-        
-        if len(bus_list_chunked) > 0:
-            page_number = st.selectbox(f"Página (1-{len(bus_list_chunked)})", list(range(1, len(bus_list_chunked) + 1)))
-            current_page = bus_list_chunked[page_number - 1]
+        bus_list_index = get_bus_list_index(data_key, bus_progress)
+        total_pages = bus_list_pages(bus_list_index, filter_option, sort_option)
+        
+        if total_pages > 0:
+            # Al cambiar filtro u orden la página guardada puede quedar fuera de rango
+            if not 1 <= st.session_state.get('bus_page', 1) <= total_pages:
+                st.session_state['bus_page'] = 1
+            page_number = st.number_input(f"Página (1-{total_pages})", min_value=1, max_value=total_pages, step=1,
+                                          key='bus_page')
+            current_page = bus_list_page(bus_list_index, filter_option, sort_option, int(page_number))
             
             # Mostrar tabla con los buses de la página actual
-            for bus_id, data in current_page:
+            for bus_id in current_page:
+                data = bus_progress[bus_id]
                 progress = data['progress']
                 progress_color = "success" if progress >= 90 else "warning" if progress >= 50 else "danger"
                 
@@ -1769,93 +5970,7 @@ def main():
                 
                 # Crear una sección colapsable para cada bus
                 with st.expander(f"Detalles del Bus {bus_id}", expanded=False):
-                    bus_info, norm_status, progress = generate_bus_report(processed_df, bus_id, norm_cols)
-                    
-                    col1, col2 = st.columns([1, 2])
-                    
-                    with col1:
-                        # Información básica del bus
-                        st.markdown("### Información General")
-                        for key, value in bus_info.items():
-                            if key not in ['NORMA INSTALADA', 'FECHA DE RENOVACION']:
-                                st.markdown(f"**{key}:** {value}")
-                        
-                        # Detalles de instalación
-                        st.markdown("### Información de Instalación")
-                        st.markdown(f"**Fecha de Renovación:** {bus_info.get('FECHA DE RENOVACION', 'N/A')}")
-                        st.markdown(f"**Normas Instaladas:** {bus_info.get('NORMA INSTALADA', 'N/A')}")
-                        
-                        # Medidor de progreso
-                        st.markdown("### Progreso de Instalación")
-                        st.progress(progress / 100)
-                        st.markdown(f"<h2 style='text-align: center;'>{progress}%</h2>", unsafe_allow_html=True)
-                    
-                    with col2:
-                        # Crear treemap
-                        fig_treemap = create_bus_treemap(processed_df, bus_id, norm_cols)
-                        if fig_treemap:
-                            st.plotly_chart(fig_treemap, use_container_width=True)
-                        else:
-                            # Mostrar un resumen en forma de tabla
-                            bus_info, norm_status, progress = generate_bus_report(processed_df, bus_id, norm_cols)
-                            
-                            # Contar normas por estado
-                            instaladas = sum(1 for status in norm_status.values() if status == "Instalada")
-                            no_aplican = sum(1 for status in norm_status.values() if status == "No Aplica")
-                            pendientes = sum(1 for status in norm_status.values() if status == "Pendiente")
-                            
-                            st.write("**Resumen de normas por estado:**")
-                            col1, col2, col3 = st.columns(3)
-                            col1.metric("Instaladas", instaladas)
-                            col2.metric("No Aplican", no_aplican)
-                            col3.metric("Pendientes", pendientes)
-                            
-                            # Mostrar lista de normas pendientes
-                            if pendientes > 0:
-                                st.write("**Normas pendientes:**")
-                                for norm, status in norm_status.items():
-                                    if status == "Pendiente":
-                                        st.write(f"- {norm}")
-                    
-                    # Resumen de normas por estado
-                    normas_pendientes = [norm for norm, status in norm_status.items() if status == "Pendiente"]
-                    if normas_pendientes:
-                        st.markdown("### Normas Pendientes por Instalar")
-                        st.markdown(f"Este bus tiene **{len(normas_pendientes)} normas pendientes** por instalar:")
-                        
-                        # Mostrar en formato de tabla o lista según cantidad
-                        if len(normas_pendientes) <= 10:
-                            for norm in normas_pendientes:
-                                st.markdown(f"- ❌ **{norm}**")
-                        else:
-                            # Para muchas normas, usar columnas
-                            cols = st.columns(3)
-                            for i, norm in enumerate(normas_pendientes):
-                                cols[i % 3].markdown(f"- ❌ **{norm}**")
-                    else:
-                        st.success("✅ Todas las normas requeridas están instaladas en este bus.")
-                    
-                    # Tabla de estado de normas
-                    st.markdown("### Estado Completo de Normas Gráficas")
-                    
-                    # Crear un DataFrame para mostrar las normas
-                    df_norms = pd.DataFrame(list(norm_status.items()), columns=['Norma', 'Estado'])
-                    
-                    # Aplicar estilo condicional
-                    def highlight_status(val):
-                        if val == 'Instalada':
-                            return 'background-color: #d4edda; color: #155724'
-                        elif val == 'No Aplica':
-                            return 'background-color: #e2e3e5; color: #383d41'
-                        else:
-                            return 'background-color: #f8d7da; color: #721c24'
-                    
-                    styled_df = df_norms.style.applymap(highlight_status, subset=['Estado'])
-                    st.dataframe(styled_df, use_container_width=True)
-                    
-                    # Generar informe HTML descargable
-                    bus_report_html = generate_bus_report_html(bus_info, norm_status, progress)
-                    st.markdown(get_html_download_link(bus_report_html, f"informe_bus_{bus_id}.html", "📄 Descargar Informe Detallado"), unsafe_allow_html=True)
+                    render_bus_detail(bus_id)
         else:
             st.warning("No se encontraron buses que cumplan con los criterios de filtrado.")
         
@@ -1865,6 +5980,11 @@ def main():
             <p>Sistema de Control de Instalación de Normas Gráficas © 2025</p>
         </div>
         """, unsafe_allow_html=True)
+
+        # Mientras quede algún artefacto sin pintar, un fragmento consulta su avance
+        if any(background_needs_paint(job) for job in current_background_jobs()):
+            with progress_slot:
+                show_background_progress()
     
     else:
         # Mostrar instrucciones cuando no hay archivo cargado
@@ -1889,5 +6009,102 @@ def main():
         st.markdown('<h3 class="sub-header">Vista previa del dashboard</h3>', unsafe_allow_html=True)
         st.image("https://i.imgur.com/NvNGJO3.png", caption="Ejemplo de visualización del dashboard")
 
+# Función para mostrar el panel opcional "Rendimiento" en la barra lateral
+def render_performance_panel():
+    with st.sidebar:
+        st.markdown("---")
+        if not st.toggle("Rendimiento", key='perf_panel', help="Tiempos, memoria y caché de cada etapa del pipeline"):
+            return
+
+        records = _perf_state()['records']
+        rerun = next((r for r in records if r['stage'] == 'rerun'), None)
+        if rerun:
+            st.metric("Tiempo total de la ejecución", f"{rerun['seconds']:.2f} s")
+        first_paint = next((r for r in records if r['stage'] == 'primer_pintado'), None)
+        if first_paint:
+            st.metric("Primer pintado significativo", f"{first_paint['seconds']:.2f} s",
+                      help="Desde el inicio de la ejecución hasta que se muestran las tarjetas principales")
+        summary = summarize_perf_records([r for r in records if r['stage'] not in ('rerun', 'primer_pintado')])
+        st.dataframe(summary, use_container_width=True, hide_index=True)
+
+        figures = figure_cache_stats()
+        st.caption(f"Caché de gráficos: {figures['figuras']} figuras, {figures['aciertos']} aciertos, "
+                   f"{figures['fallos']} fallos ({figures['tasa']:.0f}% de aciertos)")
+
+        background = summarize_background_jobs()
+        if not background.empty:
+            st.markdown("**Cálculos en segundo plano**")
+            st.dataframe(background, use_container_width=True, hide_index=True)
+
+        st.download_button(
+            label="Descargar métricas (JSON)",
+            data=perf_records_json(records),
+            file_name=f"rendimiento_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+            mime="application/json"
+        )
+
+        st.checkbox(
+            "Perfilar cada ejecución (pyinstrument si está disponible, si no cProfile)",
+            key='perf_profile'
+        )
+        profile = st.session_state.get('perf_profile_result')
+        if profile:
+            st.download_button(
+                label=f"Descargar perfil ({profile['tool']})",
+                data=profile['data'],
+                file_name=profile['file_name'],
+                mime=profile['mime']
+            )
+            if profile.get('text'):
+                with st.expander("Funciones más costosas"):
+                    st.code(profile['text'])
+
+# Función para detener el perfilador y guardar el resultado en la sesión
+def save_profile(profiler):
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    if PYINSTRUMENT_AVAILABLE:
+        profiler.stop()
+        st.session_state['perf_profile_result'] = {
+            'tool': 'pyinstrument',
+            'data': profiler.output_html(),
+            'file_name': f"perfil_{timestamp}.html",
+            'mime': 'text/html',
+            'text': profiler.output_text()
+        }
+    else:
+        profiler.disable()
+        profiler.create_stats()
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(25)
+        st.session_state['perf_profile_result'] = {
+            'tool': 'cProfile',
+            'data': marshal.dumps(profiler.stats),
+            'file_name': f"perfil_{timestamp}.prof",
+            'mime': 'application/octet-stream',
+            'text': text.getvalue()
+        }
+
+# Función para ejecutar la aplicación con instrumentación y, si se pidió, captura de perfil
+def run_app():
+    reset_perf_records()
+    begin_background_run()
+    profiling = st.session_state.get('perf_profile', False)
+
+    profiler = None
+    if profiling:
+        profiler = PyinstrumentProfiler() if PYINSTRUMENT_AVAILABLE else cProfile.Profile()
+        profiler.start() if PYINSTRUMENT_AVAILABLE else profiler.enable()
+
+    # El perfilador se detiene aunque main() termine con una excepción (st.rerun() incluido),
+    # para no dejarlo enganchado al hilo del script
+    try:
+        with perf_stage('rerun'):
+            main()
+    finally:
+        if profiler is not None:
+            save_profile(profiler)
+
+    render_performance_panel()
+
 if __name__ == "__main__":
-    main()
+    run_app()
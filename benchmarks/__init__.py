@@ -0,0 +1,5 @@
+# Benchmarks reproducibles del sistema de control de normas gráficas
+#
+# - synthetic: generador de planillas de flota sintéticas
+# - run_pipeline: tiempos de cada etapa del pipeline y del render de main() (AppTest)
+# - bench_export / bench_styling: comparaciones puntuales de exportación y estilos
@@ -0,0 +1,99 @@
+# Benchmark de la API local: solicitudes por segundo servidas desde memoria
+#
+# Crea una carpeta vigilada con una planilla sintética, inicia la API sobre ella y la consulta
+# desde varios clientes con conexiones persistentes (HTTP/1.1), con y sin GET condicional.
+#
+# Uso:
+#     python -m benchmarks.bench_api --buses 10000 --norms 200 --clients 8 --seconds 5
+import argparse
+import http.client
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from streamlit import logger as st_logger  # noqa: E402
+
+st_logger.set_log_level('error')
+warnings.filterwarnings('ignore')
+
+import app  # noqa: E402
+from benchmarks.synthetic import make_fleet_frame, write_fleet_workbook  # noqa: E402
+
+
+# Función para consultar una ruta durante un tiempo fijo; devuelve la cantidad de respuestas por código
+def hammer(port, path, seconds, etag, counts):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {'If-None-Match': etag} if etag else {}
+    deadline = time.perf_counter() + seconds
+    local = {}
+    while time.perf_counter() < deadline:
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        local[response.status] = local.get(response.status, 0) + 1
+    conn.close()
+    for status, count in local.items():
+        counts[status] = counts.get(status, 0) + count
+
+
+def measure(label, port, path, clients, seconds, etag=None):
+    counts = {}
+    threads = [threading.Thread(target=hammer, args=(port, path, seconds, etag, counts)) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    print(f"{label:<36} {total / elapsed:10.0f} req/s  {counts}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la API local")
+    parser.add_argument('--buses', type=int, default=10000)
+    parser.add_argument('--norms', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='normas_api_')
+    path = os.path.join(folder, 'flota.xlsx')
+    write_fleet_workbook(make_fleet_frame(args.buses, args.norms), path)
+    # Fecha de modificación en el pasado para que el vigilante no espere a que termine la copia
+    past = time.time() - 60
+    os.utime(path, (past, past))
+
+    start = time.perf_counter()
+    watcher = app.get_folder_watcher(folder)
+    print(f"Planilla de {args.buses} buses x {args.norms} normas leída en {time.perf_counter() - start:.1f} s")
+
+    api = app.start_api_server(watcher, '127.0.0.1', 0)
+    port = api['server'].server_address[1]
+
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    start = time.perf_counter()
+    conn.request('GET', '/api/metricas')
+    response = conn.getresponse()
+    response.read()
+    etag = response.getheader('ETag')
+    print(f"Primera solicitud (procesa la planilla): {time.perf_counter() - start:.2f} s, ETag {etag}")
+    conn.close()
+
+    bus_id = api['snapshot']['store']['search']['buses'][0]
+    measure("/api/metricas", port, '/api/metricas', args.clients, args.seconds)
+    measure("/api/metricas (If-None-Match)", port, '/api/metricas', args.clients, args.seconds, etag)
+    measure(f"/api/buses/{bus_id}", port, f'/api/buses/{bus_id}', args.clients, args.seconds)
+    measure("/api/terminales", port, '/api/terminales', args.clients, args.seconds)
+    api['server'].shutdown()
+
+
+if __name__ == '__main__':
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+    main()
@@ -0,0 +1,82 @@
+# Benchmark de clasificación de estados de normas sobre la matriz completa
+#
+# Compara tres formas de construir la matriz int8 de estados (buses x normas):
+#   - regex por columna: .astype(str).str.lower() / .str.contains() en cada celda (enfoque anterior)
+#   - factorize por columna: cada columna se factoriza y se clasifican sus únicos
+#   - factorize del bloque: una sola factorización de todas las celdas (app.compute_status_matrix)
+#
+# Uso:
+#     python -m benchmarks.bench_classification --buses 10000 --norms 200
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import app  # noqa: E402
+from benchmarks.synthetic import make_fleet_frame  # noqa: E402
+
+
+# Enfoque anterior: operaciones de texto vectorizadas sobre cada celda de cada columna
+def classify_regex_per_column(df, norm_cols):
+    status = np.full((len(df), len(norm_cols)), app.ESTADO_PENDIENTE, dtype=np.int8)
+    for j, col in enumerate(norm_cols):
+        values = df[col].astype(str).str.lower().str.strip()
+        not_applicable = values.str.contains('no aplica', na=False)
+        installed = ((values == '1') | values.str.contains('instalad', na=False)) & ~not_applicable
+        status[installed.to_numpy(), j] = app.ESTADO_INSTALADA
+        status[not_applicable.to_numpy(), j] = app.ESTADO_NO_APLICA
+    return status
+
+
+# Factorización columna por columna (clasificación de únicos por columna)
+def classify_factorize_per_column(df, norm_cols, matcher):
+    status = np.full((len(df), len(norm_cols)), app.ESTADO_PENDIENTE, dtype=np.int8)
+    for j, col in enumerate(norm_cols):
+        status[:, j] = app.classify_status_array(df[col].to_numpy(dtype=object), matcher)
+    return status
+
+
+def measure(label, fn, repeat):
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    print(f"{label:<28} {best * 1000:9.1f} ms")
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de clasificación de estados de normas")
+    parser.add_argument('--buses', type=int, default=10000)
+    parser.add_argument('--norms', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    df = make_fleet_frame(args.buses, args.norms, seed=args.seed)
+    norm_cols = [col for col in df.columns if str(col).startswith('Norma ')]
+    # Vocabulario histórico, el mismo que aplica el enfoque por regex
+    matcher = app.compile_status_vocabulary(app.DEFAULT_STATUS_VOCABULARY)
+    distinct = len(np.unique(df[norm_cols].to_numpy(dtype=object).ravel().astype(str)))
+    print(f"Matriz de {args.buses} buses x {len(norm_cols)} normas ({distinct} valores distintos)")
+
+    regex, expected = measure("regex por columna", lambda: classify_regex_per_column(df, norm_cols), args.repeat)
+    per_column, by_column = measure("factorize por columna",
+                                    lambda: classify_factorize_per_column(df, norm_cols, matcher), args.repeat)
+    block, by_block = measure("factorize del bloque",
+                              lambda: app.compute_status_matrix(df, norm_cols, matcher), args.repeat)
+
+    if not (np.array_equal(expected, by_column) and np.array_equal(expected, by_block)):
+        print("Advertencia: las matrices de estado no coinciden entre enfoques")
+    print(f"Aceleración factorize por columna: {regex / per_column:.1f}x")
+    print(f"Aceleración factorize del bloque: {regex / block:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
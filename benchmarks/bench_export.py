@@ -0,0 +1,73 @@
+# Benchmark de exportación a Excel: pd.ExcelWriter vs write_excel_sheets (memoria constante)
+#
+# Uso:
+#     python -m benchmarks.bench_export --rows 50000 --norms 30
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import app  # noqa: E402
+from benchmarks.synthetic import make_fleet_frame  # noqa: E402
+
+
+# Función para crear un DataFrame procesado de prueba (valores de norma como texto)
+def make_processed_frame(rows, norms, seed=0):
+    df = make_fleet_frame(buses=rows, norms=norms, seed=seed)
+    norm_cols = [col for col in df.columns if col.startswith('Norma ')]
+    df[norm_cols] = df[norm_cols].fillna('')
+    return df
+
+
+# Función para medir tiempo (sin trazado) y pico de memoria (con tracemalloc, en otra pasada)
+def measure(label, fn):
+    start = time.perf_counter()
+    buffer = fn()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    size = len(buffer.getvalue())
+    print(f"{label:<32} {elapsed:8.2f} s   pico {peak / 2**20:8.1f} MiB   archivo {size / 2**20:6.1f} MiB")
+    return elapsed, peak
+
+
+def export_pandas(df):
+    buffer = app.io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
+        df.to_excel(writer, sheet_name='Datos', index=False)
+    buffer.seek(0)
+    return buffer
+
+
+def export_constant_memory(df, norm_cols):
+    return app.write_excel_sheets([{
+        'name': 'Datos',
+        'data': df,
+        'rules': {col: 'norma' for col in norm_cols}
+    }])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de exportación a Excel")
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--norms', type=int, default=30)
+    args = parser.parse_args()
+
+    df = make_processed_frame(args.rows, args.norms)
+    norm_cols = [col for col in df.columns if col.startswith('Norma ')]
+    print(f"Exportando {args.rows} filas x {len(df.columns)} columnas")
+
+    measure("pd.ExcelWriter (xlsxwriter)", lambda: export_pandas(df))
+    measure("write_excel_sheets", lambda: export_constant_memory(df, norm_cols))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# Benchmark de estilos del reporte completo: Styler.applymap por celda (tablas de hasta
+# STYLER_MAX_ROWS filas) vs marcadores de color con column_config (tablas más grandes)
+#
+# Uso:
+#     python -m benchmarks.bench_styling --rows 10000
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from streamlit import dataframe_util
+from streamlit.elements.lib.pandas_styler_utils import marshall_styler
+from streamlit.proto.ArrowData_pb2 import ArrowData as ArrowProto
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import app  # noqa: E402
+
+
+# Función para crear un reporte completo de prueba
+def make_report_frame(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    progress = rng.uniform(0, 100, rows).round(1)
+    return pd.DataFrame({
+        'Número Interno': np.arange(1000, 1000 + rows).astype(str),
+        'PPU': [f"AB{i:05d}" for i in range(rows)],
+        'Terminal': rng.choice(['El Salto', 'Lo Espejo', 'Maipú'], rows),
+        'Subclase': rng.choice(['A1', 'B1', 'C'], rows),
+        'Progreso': progress,
+        'Estado': np.where(progress >= 100, 'Completo', 'Pendiente'),
+        'Normas Faltantes': rng.integers(0, 20, rows),
+    })
+
+
+# Estilo anterior: funciones Python por celda y progreso como texto '85.0%'
+def style_applymap(df):
+    df = df.assign(Progreso=df['Progreso'].map(lambda v: f"{v:.1f}%"))
+
+    def highlight_estado(val):
+        if val == 'Completo':
+            return 'background-color: #d4edda; color: #155724'
+        else:
+            return 'background-color: #f8d7da; color: #721c24'
+
+    def highlight_progress(val):
+        progress = float(val.strip('%'))
+        if progress >= 90:
+            return 'background-color: #d4edda; color: #155724'
+        elif progress >= 70:
+            return 'background-color: #fff3cd; color: #856404'
+        else:
+            return 'background-color: #f8d7da; color: #721c24'
+
+    styler = df.style
+    # Styler.map reemplaza a applymap desde pandas 2.1 (applymap ya no existe en pandas 3)
+    map_cells = styler.map if hasattr(styler, 'map') else styler.applymap
+    styler = map_cells(highlight_estado, subset=['Estado'])
+    return styler.map(highlight_progress, subset=['Progreso']) if hasattr(styler, 'map') else styler.applymap(highlight_progress, subset=['Progreso'])
+
+
+# Sin Styler: colores como marcadores de texto y progreso numérico con column_config
+def serialize_marked(df):
+    marked = app.mark_styled_columns(df, {'Estado': app.bus_status_style, 'Progreso': app.progress_style})
+    dataframe_util.convert_pandas_df_to_arrow_bytes(marked)
+
+
+# Función para medir la construcción del Styler más su serialización como lo hace st.dataframe
+def serialize_styler(build):
+    def run(df):
+        styler = build(df)
+        marshall_styler(ArrowProto(), styler, 'bench')
+        dataframe_util.convert_pandas_df_to_arrow_bytes(styler.data)
+    return run
+
+
+def measure(label, df, run, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(df)
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    print(f"{label:<28} {best * 1000:9.1f} ms")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de estilos de tablas")
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df = make_report_frame(args.rows)
+    print(f"Reporte de {args.rows} filas")
+    before = measure("Styler.applymap", df, serialize_styler(style_applymap), args.repeat)
+    marked = measure("Marcadores + column_config", df, serialize_marked, args.repeat)
+    print(f"Aceleración marcadores + column_config: {before / marked:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
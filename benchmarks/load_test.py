@@ -0,0 +1,435 @@
+# Prueba de carga: varias sesiones simultáneas del dashboard en un mismo proceso
+#
+# Cada sesión es un AppTest de Streamlit que ejecuta app.py en su propio hilo, igual que el
+# servidor ejecuta una sesión por navegador: comparten el proceso, el GIL y las cachés
+# (st.cache_resource / st.cache_data). Cada sesión sigue un guion de interacciones y se mide la
+# latencia de cada re-ejecución, la memoria residente (RSS) y el uso de CPU del proceso para
+# cada cantidad de sesiones.
+#
+# Pasos del guion:
+#     subir     carga la planilla (siempre es el primer paso)
+#     filtro    alterna el filtro de Terminal entre una terminal y todas
+#     consulta  alterna la consulta de buses entre 'progreso < 50' y vacía
+#     pagina    avanza una página en la lista de buses
+#     detalle   busca un bus y abre su detalle
+#     exportar  pulsa "Exportar Datos Filtrados"
+#
+# Uso:
+#     python -m benchmarks.load_test --sessions 1,2,4,8 --buses 2000 --norms 100 --rounds 3
+#     python -m benchmarks.load_test --workbooks flota_a.xlsx flota_b.xlsx --script subir,filtro,detalle
+#     python -m benchmarks.load_test --output carga.json --compare benchmarks/results/carga_base.json
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+import types
+import warnings
+from datetime import datetime
+from unittest.mock import MagicMock
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+import streamlit as st  # noqa: E402
+from streamlit import logger as st_logger  # noqa: E402
+from streamlit.runtime import Runtime  # noqa: E402
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache  # noqa: E402
+from streamlit.testing.v1 import AppTest, app_test, local_script_runner  # noqa: E402
+
+st_logger.set_log_level('error')
+warnings.filterwarnings('ignore')
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from benchmarks.synthetic import make_fleet_frame, write_fleet_workbook  # noqa: E402
+
+# AppTest está pensado para una sesión a la vez: en cada ejecución instala un Runtime simulado
+# (y lo quita al terminar), activa la opción global.appTest y compila app.py de nuevo. Con varias
+# sesiones en hilos eso se pisa entre ellas (y ast.parse desde varios hilos falla en Python
+# 3.11). La prueba instala una sola vez lo que el servidor tiene una sola vez para todas las
+# sesiones: un Runtime (archivos, cachés) y la caché de código compilado de app.py.
+# Todo lo que se reemplaza queda registrado en el ExitStack devuelto y se restaura al cerrarlo.
+def install_shared_runtime():
+    stack = contextlib.ExitStack()
+    originals = [(Runtime, '_instance', Runtime._instance), (app_test, 'Runtime', app_test.Runtime),
+                 (app_test, 'patch_config_options', app_test.patch_config_options),
+                 (app_test, 'ScriptCache', app_test.ScriptCache),
+                 (local_script_runner, 'ScriptCache', local_script_runner.ScriptCache)]
+    for owner, name, value in originals:
+        stack.callback(setattr, owner, name, value)
+
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = app_test.MediaFileManager(app_test.MemoryMediaFileStorage("/mock/media"))
+    runtime.dataframe_source_mgr = app_test.DataframeSourceManager()
+    runtime.cache_storage_manager = app_test.MemoryCacheStorageManager()
+    components = app_test.BidiComponentManager()
+    components.discover_and_register_components(start_file_watching=False)
+    runtime.bidi_component_registry = components
+    Runtime._instance = runtime
+    # Lo que cada ejecución de AppTest asigna o restaura queda fuera del Runtime real
+    app_test.Runtime = types.SimpleNamespace(_instance=None)
+
+    stack.enter_context(app_test.patch_config_options({"global.appTest": True}))
+    app_test.patch_config_options = lambda options: contextlib.nullcontext()
+
+    script_cache = ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: script_cache
+    return stack
+
+
+STEPS = ['subir', 'filtro', 'consulta', 'pagina', 'detalle', 'exportar']
+DEFAULT_SCRIPT = 'subir,filtro,pagina,detalle,exportar'
+XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+# Función para leer el guion de interacciones ("subir,filtro,pagina")
+def parse_script(text):
+    steps = [step.strip() for step in text.split(',') if step.strip()]
+    unknown = [step for step in steps if step not in STEPS]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Pasos desconocidos: {', '.join(unknown)} (disponibles: {', '.join(STEPS)})")
+    if not steps or steps[0] != 'subir':
+        raise argparse.ArgumentTypeError("El guion debe comenzar con 'subir'")
+    return steps
+
+
+# Función para leer la lista de cantidades de sesiones ("1,2,4,8")
+def parse_sessions(text):
+    try:
+        counts = sorted({int(count) for count in text.split(',') if count.strip()})
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Cantidades de sesiones no válidas: '{text}'")
+    if not counts or counts[0] < 1:
+        raise argparse.ArgumentTypeError("Las cantidades de sesiones deben ser enteros positivos")
+    return counts
+
+
+# Función para preparar las planillas: archivos indicados o sintéticas (una por variante)
+def load_workbooks(args):
+    workbooks = []
+    if args.workbooks:
+        for path in args.workbooks:
+            with open(path, 'rb') as f:
+                content = f.read()
+            df = pd.read_excel(io.BytesIO(content))
+            workbooks.append({'name': os.path.basename(path), 'content': content,
+                              'buses': df.iloc[:, 0].dropna().astype(str).tolist()})
+    else:
+        for variant in range(args.variants):
+            df = make_fleet_frame(args.buses, args.norms, args.terminals, seed=args.seed + variant)
+            workbooks.append({'name': f'flota_{variant}.xlsx', 'content': write_fleet_workbook(df).getvalue(),
+                              'buses': df['N° Interno'].astype(str).tolist()})
+    return workbooks
+
+
+# Función para buscar el widget de un tipo por clave o por el comienzo de su etiqueta
+def find_widget(widgets, key=None, label=None):
+    for widget in widgets:
+        if (key is not None and widget.key == key) or (label is not None and str(widget.label).startswith(label)):
+            return widget
+    return None
+
+
+# Función para aplicar un paso del guion a una sesión (k: veces que ya se hizo ese paso);
+# devuelve False si el widget no existe
+def apply_step(at, step, workbook, k, rng):
+    if step == 'subir':
+        at.sidebar.file_uploader[0].set_value((workbook['name'], workbook['content'], XLSX_MIME))
+    elif step == 'filtro':
+        widget = find_widget(at.sidebar.multiselect, label="Filtrar por")
+        if widget is None or not widget.options:
+            return False
+        widget.set_value(widget.options[:1] if k % 2 == 0 else list(widget.options))
+    elif step == 'consulta':
+        widget = find_widget(at.sidebar.text_input, key='bus_query')
+        if widget is None:
+            return False
+        widget.set_value('progreso < 50' if k % 2 == 0 else '')
+    elif step == 'pagina':
+        widget = find_widget(at.number_input, key='bus_page')
+        if widget is None:
+            return False
+        widget.set_value(int(widget.value) % int(widget.max) + 1)
+    elif step == 'detalle':
+        widget = find_widget(at.text_input, key='bus_search')
+        if widget is None:
+            return False
+        widget.set_value(workbook['buses'][rng.integers(len(workbook['buses']))])
+    elif step == 'exportar':
+        widget = find_widget(at.sidebar.button, label="Exportar Datos Filtrados")
+        if widget is None:
+            return False
+        widget.click()
+    return True
+
+
+# Función para ejecutar una sesión: el guion completo, repitiendo rounds veces los pasos tras 'subir'
+def run_session(index, workbook, script, rounds, sync, barrier, samples, lock):
+    rng = np.random.default_rng(index)
+    try:
+        at = AppTest.from_file(os.path.join(ROOT, 'app.py'), default_timeout=900)
+        if sync:
+            # Sin trabajos en segundo plano: cada re-ejecución incluye todos los cálculos
+            at.session_state['background_mode'] = False
+        at.run()
+    except Exception as e:
+        # Una sesión que no abre no debe dejar esperando a las demás
+        barrier.abort()
+        with lock:
+            samples.append({'sesion': index, 'paso': 'inicio', 'segundos': 0.0, 'error': f"{type(e).__name__}: {e}"})
+        return
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        pass
+
+    steps = script[:1] + script[1:] * rounds
+    done = {}
+    for step in steps:
+        error = None
+        start = time.perf_counter()
+        try:
+            if apply_step(at, step, workbook, done.get(step, 0), rng):
+                at.run()
+                if at.exception:
+                    error = str(at.exception[0].value).splitlines()[0]
+            else:
+                error = "widget no encontrado"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        elapsed = time.perf_counter() - start
+        done[step] = done.get(step, 0) + 1
+        with lock:
+            samples.append({'sesion': index, 'paso': step, 'segundos': elapsed, 'error': error})
+
+
+# Función para leer la memoria residente: actual (psutil) o, sin psutil, el máximo del proceso (getrusage)
+def process_rss(process):
+    if process is not None:
+        return process.memory_info().rss
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+# Función para iniciar el muestreo de memoria del proceso mientras corren las sesiones
+def start_monitor(interval=0.2):
+    process = psutil.Process() if psutil is not None else None
+    monitor = {'process': process, 'stop': threading.Event(), 'rss_inicial': process_rss(process),
+               'cpu': time.process_time(), 'inicio': time.perf_counter()}
+    monitor['rss_pico'] = monitor['rss_inicial']
+
+    def sample():
+        while not monitor['stop'].wait(interval):
+            monitor['rss_pico'] = max(monitor['rss_pico'], process_rss(process))
+
+    monitor['thread'] = threading.Thread(target=sample, daemon=True)
+    monitor['thread'].start()
+    return monitor
+
+
+# Función para detener el muestreo y resumir memoria y CPU
+def finish_monitor(monitor):
+    monitor['stop'].set()
+    monitor['thread'].join()
+    wall = time.perf_counter() - monitor['inicio']
+    return {
+        'segundos': wall,
+        'rss_inicial_mib': monitor['rss_inicial'] / 2**20,
+        'rss_pico_mib': max(monitor['rss_pico'], process_rss(monitor['process'])) / 2**20,
+        # Tiempo de CPU de todos los hilos del proceso sobre el tiempo real (100% = un núcleo)
+        'cpu_pct': (time.process_time() - monitor['cpu']) / wall * 100 if wall > 0 else 0.0
+    }
+
+
+# Función para resumir latencias en segundos
+def latency_stats(values):
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return {'n': 0, 'p50': None, 'p95': None, 'max': None}
+    return {'n': int(len(values)), 'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)), 'max': float(values.max())}
+
+
+# Función para dirigir la caché en disco y los datos de la app (historial, perfiles) a un
+# directorio temporal que se borra al cerrar el stack; las variables de entorno se restauran
+def use_temporary_dirs(stack):
+    directory = stack.enter_context(tempfile.TemporaryDirectory(prefix='normas_carga_', ignore_cleanup_errors=True))
+    for name in ('NORMAS_CACHE_DIR', 'NORMAS_DATOS_DIR'):
+        previous = os.environ.get(name)
+        stack.callback(lambda name=name, previous=previous: os.environ.pop(name, None) if previous is None
+                       else os.environ.__setitem__(name, previous))
+        os.environ[name] = directory
+    # Antes de borrar el directorio se liberan las cachés que tienen archivos abiertos en él
+    stack.callback(st.cache_resource.clear)
+    return directory
+
+
+# Función para correr una cantidad de sesiones simultáneas y resumir sus mediciones
+def run_level(count, workbooks, args):
+    with contextlib.ExitStack() as stack:
+        if not args.warm:
+            # Cada nivel parte con las cachés vacías, así los niveles son comparables
+            st.cache_resource.clear()
+            st.cache_data.clear()
+            use_temporary_dirs(stack)
+        return _run_level(count, workbooks, args)
+
+
+def _run_level(count, workbooks, args):
+
+    samples, lock = [], threading.Lock()
+    barrier = threading.Barrier(count + 1)
+    threads = [
+        threading.Thread(target=run_session, args=(i, workbooks[i % len(workbooks)], args.script, args.rounds,
+                                                   args.sync, barrier, samples, lock))
+        for i in range(count)
+    ]
+    for thread in threads:
+        thread.start()
+    # Las sesiones parten juntas una vez abiertas (la primera ejecución sin planilla no se mide)
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        pass
+    monitor = start_monitor()
+    for thread in threads:
+        thread.join()
+    resources = finish_monitor(monitor)
+
+    ok = [sample['segundos'] for sample in samples if sample['error'] is None]
+    errors = [sample for sample in samples if sample['error'] is not None]
+    level = dict(
+        {'sesiones': count, 'reruns_por_segundo': len(ok) / resources['segundos'] if resources['segundos'] else 0.0,
+         'errores': len(errors)},
+        **latency_stats(ok), **resources,
+        pasos={step: latency_stats([s['segundos'] for s in samples if s['paso'] == step and s['error'] is None])
+               for step in args.script}
+    )
+    for error in sorted({sample['error'] for sample in errors})[:3]:
+        print(f"  Error en {count} sesiones: {error}")
+    return level
+
+
+# Función para comparar con una ejecución anterior; devuelve las cantidades de sesiones que empeoraron
+def compare_levels(current, baseline, threshold):
+    regressions = []
+    base_levels = {level['sesiones']: level for level in baseline['niveles']}
+    print(f"\n{'Sesiones':>8} {'Base p95 (s)':>13} {'Actual p95 (s)':>15} {'Razón':>8}")
+    for level in current['niveles']:
+        base = base_levels.get(level['sesiones'])
+        if base is None or not base.get('p95') or level['p95'] is None:
+            continue
+        ratio = level['p95'] / base['p95']
+        flag = "  <-- regresión" if ratio > threshold else ""
+        print(f"{level['sesiones']:>8} {base['p95']:13.2f} {level['p95']:15.2f} {ratio:8.2f}{flag}")
+        if ratio > threshold:
+            regressions.append(str(level['sesiones']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga del dashboard con sesiones simultáneas")
+    parser.add_argument('--sessions', type=parse_sessions, default=parse_sessions('1,2,4'),
+                        help="Cantidades de sesiones simultáneas a medir (ej: 1,2,4,8)")
+    parser.add_argument('--script', type=parse_script, default=parse_script(DEFAULT_SCRIPT),
+                        help=f"Pasos de cada sesión separados por coma ({', '.join(STEPS)})")
+    parser.add_argument('--rounds', type=int, default=2, help="Repeticiones de los pasos que siguen a 'subir'")
+    parser.add_argument('--workbooks', nargs='+', default=None, help="Planillas a usar (se reparten entre sesiones)")
+    parser.add_argument('--buses', type=int, default=2000)
+    parser.add_argument('--norms', type=int, default=100)
+    parser.add_argument('--terminals', type=int, default=4)
+    parser.add_argument('--variants', type=int, default=1,
+                        help="Planillas sintéticas distintas (1 = todas las sesiones cargan la misma)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sync', action='store_true', help="Desactivar el cálculo en segundo plano en cada sesión")
+    parser.add_argument('--warm', action='store_true', help="No vaciar las cachés entre cantidades de sesiones")
+    parser.add_argument('--output', default=None, help="Archivo JSON donde guardar los resultados")
+    parser.add_argument('--compare', default=None, help="JSON de una ejecución anterior para comparar")
+    parser.add_argument('--threshold', type=float, default=1.3, help="Razón de p95 actual/base considerada regresión")
+    args = parser.parse_args()
+
+    workbooks = load_workbooks(args)
+    print(f"{len(workbooks)} planilla(s): " + ", ".join(f"{wb['name']} ({len(wb['buses'])} buses, "
+                                                         f"{len(wb['content']) / 2**20:.1f} MiB)" for wb in workbooks))
+    print(f"Guion: {' -> '.join(args.script)} (pasos tras 'subir' x{args.rounds})"
+          + (", sin segundo plano" if args.sync else ""))
+    if psutil is None:
+        print("psutil no está instalado: la memoria informada es el máximo del proceso (getrusage)")
+
+    config = {
+        'sessions': args.sessions, 'script': args.script, 'rounds': args.rounds,
+        'workbooks': args.workbooks, 'buses': args.buses, 'norms': args.norms, 'terminals': args.terminals,
+        'variants': args.variants, 'seed': args.seed, 'sync': args.sync, 'warm': args.warm
+    }
+    levels = []
+
+    def fmt(value):
+        return f"{value:8.2f}" if value is not None else f"{'-':>8}"
+
+    print(f"\n{'Sesiones':>8} {'Reruns':>7} {'p50 (s)':>8} {'p95 (s)':>8} {'Máx (s)':>8} {'Reruns/s':>9} "
+          f"{'RSS pico (MiB)':>15} {'CPU (%)':>8} {'Errores':>8}")
+    with install_shared_runtime() as stack:
+        if args.warm:
+            # Con cachés tibias todos los niveles comparten un directorio temporal
+            use_temporary_dirs(stack)
+        for count in args.sessions:
+            level = run_level(count, workbooks, args)
+            levels.append(level)
+            print(f"{count:>8} {level['n']:>7} {fmt(level['p50'])} {fmt(level['p95'])} {fmt(level['max'])} "
+                  f"{level['reruns_por_segundo']:9.2f} {level['rss_pico_mib']:15.0f} {level['cpu_pct']:8.0f} {level['errores']:>8}")
+
+    headers = [f"{level['sesiones']} ses. p50/p95 (s)" for level in levels]
+    print(f"\n{'Paso':<10}" + "".join(f"{header:>24}" for header in headers))
+    for step in args.script:
+        cells = []
+        for level in levels:
+            stats = level['pasos'][step]
+            cells.append(f"{stats['p50']:.2f} / {stats['p95']:.2f}" if stats['n'] else "-")
+        print(f"{step:<10}" + "".join(f"{cell:>24}" for cell in cells))
+
+    results = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'streamlit': st.__version__
+        },
+        'config': config,
+        'niveles': levels
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\nResultados guardados en {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print("\nAdvertencia: la configuración de la prueba no coincide con la de la base")
+        regressions = compare_levels(results, baseline, args.threshold)
+        if regressions:
+            print(f"\nRegresiones detectadas con {', '.join(regressions)} sesiones")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    # AppTest vuelve a configurar los registros de Streamlit; los avisos de cada sesión se silencian
+    logging.disable(logging.WARNING)
+    main()
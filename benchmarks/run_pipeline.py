@@ -0,0 +1,285 @@
+# Benchmark reproducible de cada etapa del pipeline y del render completo de main()
+#
+# Uso:
+#     python -m benchmarks.run_pipeline --buses 2000 --norms 100 --output benchmarks/results/actual.json
+#     python -m benchmarks.run_pipeline --compare benchmarks/results/base.json
+#
+# Los resultados se guardan como JSON (mediana, mínimo y máximo por etapa) para poder
+# comparar contra una ejecución anterior y detectar regresiones.
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import warnings
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+import streamlit as st  # noqa: E402
+from streamlit import logger as st_logger  # noqa: E402
+
+# En modo script Streamlit advierte en cada llamada a st.*; aquí solo interesa medir
+st_logger.set_log_level('error')
+warnings.filterwarnings('ignore')
+
+import app  # noqa: E402
+from benchmarks.synthetic import make_fleet_frame, parse_value_mix, write_fleet_workbook  # noqa: E402
+
+
+# Función para medir una etapa varias veces y devolver estadísticas en segundos
+def time_stage(fn, repeat):
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return {
+        'median': statistics.median(times),
+        'min': min(times),
+        'max': max(times),
+        'repeat': repeat
+    }, result
+
+
+# Función para medir las etapas del pipeline directamente sobre las funciones de app.py
+def run_pipeline_stages(workbook, repeat):
+    stages = {}
+
+    def load():
+        # Se limpia la caché para medir siempre la lectura real del Excel
+        app.load_data.__wrapped__.clear()
+        return app.load_data(io.BytesIO(workbook))
+
+    stages['load_data'], df = time_stage(load, repeat)
+    stages['process_data'], (processed_df, cols_info, norm_cols) = time_stage(
+        lambda: app.process_data(df.copy()), repeat)
+    stages['calculate_metrics'], metrics = time_stage(
+        lambda: app.calculate_metrics(processed_df, norm_cols), repeat)
+    stages['create_pie_charts'], _ = time_stage(lambda: app.create_pie_charts(processed_df, norm_cols), repeat)
+    stages['create_norm_heatmap'], _ = time_stage(lambda: app.create_norm_heatmap(metrics), repeat)
+    stages['create_subclass_charts'], _ = time_stage(lambda: app.create_subclass_charts(processed_df, norm_cols), repeat)
+
+    bus_id = metrics['bus_ids'][0]
+    stages['generate_bus_report'], _ = time_stage(lambda: app.generate_bus_report(processed_df, bus_id, norm_cols), repeat)
+    stages['create_bus_treemap'], _ = time_stage(lambda: app.create_bus_treemap(processed_df, bus_id, norm_cols), repeat)
+
+    # Almacén de reportes por bus: construcción completa (archivo nuevo) y lectura de una fila
+    store_dir = tempfile.mkdtemp(prefix='normas_bench_')
+    store_path = os.path.join(store_dir, 'reportes.sqlite')
+
+    def build_store():
+        table = app.build_bus_report_table(processed_df, norm_cols, metrics['status_matrix'], metrics['bus_ids'])
+        app.write_bus_report_store(table, norm_cols, store_path)
+        return app.open_bus_report_store(store_path)
+
+    stages['bus_report_store'], store = time_stage(build_store, repeat)
+    stages['lookup_bus_report'], _ = time_stage(lambda: app.lookup_bus_report(store, bus_id), repeat)
+    stages['search_buses'], _ = time_stage(lambda: app.search_buses(store['search'], str(bus_id)[:2]), repeat)
+    stages['norm_cooccurrence'], _ = time_stage(
+        lambda: app.norm_cooccurrence(metrics['status_matrix'], norm_cols), repeat)
+    stages['kit_table'], _ = time_stage(
+        lambda: app.kit_table(metrics['status_matrix'], metrics['bus_ids'], norm_cols), repeat)
+    stages['no_aplica_anomalies'], _ = time_stage(lambda: app.no_aplica_anomalies(
+        metrics['status_matrix'], metrics['bus_ids'], norm_cols, metrics['peer_groups']), repeat)
+    # Corrección de estados: 50 celdas aplicadas como deltas sobre las métricas ya calculadas
+    rng = np.random.default_rng(0)
+    edit_rows = rng.integers(0, len(metrics['bus_ids']), 50)
+    edit_cols = rng.integers(0, len(norm_cols), 50)
+    edit_codes = (metrics['status_matrix'][edit_rows, edit_cols] + 1) % 3
+    stages['apply_status_changes'], _ = time_stage(
+        lambda: app.apply_status_changes(metrics, edit_rows, edit_cols, edit_codes), repeat)
+    cambios = {(processed_df.index[r], norm_cols[c]): (int(code), app.edit_cell_value(df[norm_cols[c]], code))
+               for r, c, code in zip(edit_rows, edit_cols, edit_codes)}
+    stages['patch_workbook_cells'], _ = time_stage(
+        lambda: app.patch_workbook_cells(workbook, list(df.columns), cambios), repeat)
+    query = f"progreso < 50 and faltantes >= 2 and falta({app.query_quote(norm_cols[0])})"
+    stages['evaluate_bus_query'], _ = time_stage(
+        lambda: app.evaluate_bus_query(metrics['query_context'], app.compile_bus_query(query)), repeat)
+    stages['build_bus_list_index'], bus_list_index = time_stage(
+        lambda: app.build_bus_list_index(metrics['bus_progress']), repeat)
+    stages['bus_list_page'], _ = time_stage(
+        lambda: app.bus_list_page(bus_list_index, "Incompletos", "Progreso (menor a mayor)", 2), repeat)
+    store['conn'].close()
+    shutil.rmtree(store_dir, ignore_errors=True)
+
+    # Consola SQL (solo si DuckDB está instalado): registro de las tablas y una agregación sobre "estados"
+    if app.DUCKDB_AVAILABLE:
+        stages['build_sql_tables'], sql_tables = time_stage(lambda: app.build_sql_tables(
+            processed_df, norm_cols, metrics['status_matrix'], metrics['bus_ids']), repeat)
+        sql_console = app.open_sql_console(sql_tables)
+        sql = ("SELECT norma, count(*) FILTER (WHERE estado = 'Pendiente') AS pendientes, "
+               "avg((codigo <> 0)::INT) AS avance FROM estados GROUP BY norma")
+
+        def run_sql():
+            sql_console['resultados'].clear()
+            return app.run_sql_query(sql_console, sql)
+
+        stages['run_sql_query'], _ = time_stage(run_sql, repeat)
+        sql_console['conn'].close()
+
+    stages['plan_work_orders'], _ = time_stage(lambda: app.plan_work_orders(
+        metrics['status_matrix'], metrics['bus_ids'], norm_cols,
+        metrics['bus_groups'].get('Terminal', np.full(len(metrics['bus_ids']), 'N/A')), 20), repeat)
+
+    # Métricas ponderadas con una tabla de metadatos sintética (peso, costo y minutos por norma)
+    rng = np.random.default_rng(0)
+    metadata = pd.DataFrame({'Norma': norm_cols, 'Peso': rng.integers(1, 10, len(norm_cols)).astype(float),
+                             'Costo': rng.integers(1, 200, len(norm_cols)) * 1000.0,
+                             'Minutos': rng.integers(5, 240, len(norm_cols)).astype(float),
+                             'Prioridad': rng.choice(['Alta', 'Media', 'Baja'], len(norm_cols))})
+    aligned = app.align_norm_metadata(metadata, norm_cols)
+    stages['weighted_metrics'], _ = time_stage(lambda: app.weighted_metrics(metrics['status_matrix'], aligned), repeat)
+
+    stages['progress_distribution'], _ = time_stage(
+        lambda: app.progress_distribution(metrics['progress_array'], groups=metrics['bus_groups']), repeat)
+
+    # Analítica de renovaciones sobre las fechas ya interpretadas en calculate_metrics
+    stages['buses_due_for_renewal'], _ = time_stage(lambda: app.buses_due_for_renewal(metrics, 90), repeat)
+    stages['completion_by_renewal_month'], _ = time_stage(lambda: app.completion_by_renewal_month(metrics), repeat)
+    stages['renewal_burndown'], _ = time_stage(lambda: app.renewal_burndown(metrics, 200), repeat)
+
+    # Pronóstico: registrar un corte (suma incremental) y pronosticar todas las series
+    forecast_dir = tempfile.mkdtemp(prefix='normas_pronostico_')
+    forecast_store = app.open_forecast_store(os.path.join(forecast_dir, 'historial.sqlite'))
+    terminals = metrics['bus_groups'].get('Terminal', np.full(len(metrics['bus_ids']), 'N/A'))
+    snapshot_count = iter(range(10 ** 6))
+
+    def record():
+        k = next(snapshot_count)
+        series = app.snapshot_series(metrics['status_matrix'], norm_cols, terminals)
+        app.record_snapshot(forecast_store, f"corte{k}", "bench", pd.Timestamp('2025-01-01') + pd.Timedelta(days=k), series)
+
+    stages['record_snapshot'], _ = time_stage(record, repeat)
+    record()
+    stages['forecast_completion'], _ = time_stage(lambda: app.forecast_completion(forecast_store), repeat)
+    forecast_store['conn'].close()
+    shutil.rmtree(forecast_dir, ignore_errors=True)
+
+    reporte_df = pd.DataFrame([
+        {'Número Interno': bus, 'Progreso': info['progress'],
+         'Estado': "Completo" if info['completo'] else "Pendiente"}
+        for bus, info in metrics['bus_progress'].items()
+    ])
+    stages['write_excel_sheets'], _ = time_stage(
+        lambda: app.write_excel_sheets(app.build_report_sheets(metrics, reporte_df)), repeat)
+    return stages
+
+
+# Función para medir el render completo de main() con el arnés AppTest de Streamlit
+def run_apptest(workbook, repeat):
+    from streamlit.testing.v1 import AppTest
+
+    stages = {}
+    at = AppTest.from_file(os.path.join(ROOT, 'app.py'), default_timeout=600)
+    at.run()
+
+    def upload():
+        at.sidebar.file_uploader[0].set_value(
+            ('flota.xlsx', workbook, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        ).run()
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+
+    stages['apptest_first_render'], _ = time_stage(upload, 1)
+    # Primer pintado significativo de la primera ejecución tras la carga (tarjetas principales)
+    paints = at.session_state['perf_state'].get('paint_history', [])
+    if paints:
+        stages['apptest_primer_pintado'] = {'median': paints[0], 'min': paints[0], 'max': paints[0], 'repeat': 1}
+    stages['apptest_rerun'], _ = time_stage(lambda: at.run(), repeat)
+    return stages
+
+
+# Función para comparar con una ejecución anterior; devuelve las etapas que empeoraron
+def compare_results(current, baseline, threshold):
+    regressions = []
+    print(f"\n{'Etapa':<28} {'Base (ms)':>12} {'Actual (ms)':>12} {'Razón':>8}")
+    for stage, stats in current['stages'].items():
+        base = baseline['stages'].get(stage)
+        if base is None:
+            print(f"{stage:<28} {'-':>12} {stats['median'] * 1000:12.1f} {'nueva':>8}")
+            continue
+        ratio = stats['median'] / base['median'] if base['median'] > 0 else float('inf')
+        flag = "  <-- regresión" if ratio > threshold else ""
+        print(f"{stage:<28} {base['median'] * 1000:12.1f} {stats['median'] * 1000:12.1f} {ratio:8.2f}{flag}")
+        if ratio > threshold:
+            regressions.append(stage)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline de normas gráficas")
+    parser.add_argument('--buses', type=int, default=2000)
+    parser.add_argument('--norms', type=int, default=100)
+    parser.add_argument('--terminals', type=int, default=4)
+    parser.add_argument('--subclasses', type=int, default=4)
+    parser.add_argument('--value-mix', type=parse_value_mix, default=None)
+    parser.add_argument('--header-offset', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip-apptest', action='store_true', help="No medir el render de main() con AppTest")
+    parser.add_argument('--output', default=None, help="Archivo JSON donde guardar los resultados")
+    parser.add_argument('--compare', default=None, help="JSON de una ejecución anterior para comparar")
+    parser.add_argument('--threshold', type=float, default=1.2, help="Razón actual/base considerada regresión")
+    args = parser.parse_args()
+
+    config = {
+        'buses': args.buses, 'norms': args.norms, 'terminals': args.terminals,
+        'subclasses': args.subclasses, 'value_mix': args.value_mix,
+        'header_offset': args.header_offset, 'seed': args.seed, 'repeat': args.repeat
+    }
+    df = make_fleet_frame(args.buses, args.norms, args.terminals, args.subclasses, args.value_mix, args.seed)
+    workbook = write_fleet_workbook(df, header_offset=args.header_offset).getvalue()
+    print(f"Planilla sintética: {args.buses} buses x {args.norms} normas ({len(workbook) / 2**20:.1f} MiB)")
+
+    stages = run_pipeline_stages(workbook, args.repeat)
+    if not args.skip_apptest:
+        stages.update(run_apptest(workbook, args.repeat))
+
+    results = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'streamlit': st.__version__
+        },
+        'config': config,
+        'stages': stages
+    }
+
+    print(f"\n{'Etapa':<28} {'Mediana (ms)':>14} {'Mín (ms)':>10} {'Máx (ms)':>10}")
+    for stage, stats in stages.items():
+        print(f"{stage:<28} {stats['median'] * 1000:14.1f} {stats['min'] * 1000:10.1f} {stats['max'] * 1000:10.1f}")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\nResultados guardados en {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print("\nAdvertencia: la configuración de la planilla no coincide con la de la base")
+        regressions = compare_results(results, baseline, args.threshold)
+        if regressions:
+            print(f"\nRegresiones detectadas: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+    main()
@@ -0,0 +1,128 @@
+# Generador de planillas de flota sintéticas para benchmarks
+#
+# Uso:
+#     python -m benchmarks.synthetic --buses 10000 --norms 200 --output flota.xlsx
+import argparse
+import io
+
+import numpy as np
+import pandas as pd
+
+# Mezcla de valores por defecto en las columnas de normas
+DEFAULT_VALUE_MIX = {
+    '1': 0.55,
+    'instalada': 0.10,
+    'No Aplica': 0.10,
+    '': 0.20,
+    'noise': 0.05
+}
+
+# Textos "ruido" que aparecen en planillas reales y que se interpretan como pendientes
+NOISE_VALUES = ['pendiente', '-', '?', 'falta', 'revisar', ' ', '0']
+
+TERMINAL_NAMES = ['El Salto', 'Lo Espejo', 'Maipú', 'La Florida', 'Quilicura', 'Peñalolén',
+                  'Pudahuel', 'La Reina', 'Recoleta', 'San Bernardo']
+SUBCLASS_NAMES = ['A1', 'A2', 'B1', 'B2', 'C', 'C1', 'D', 'E']
+
+
+# Letras usadas en las patentes chilenas (sin vocales)
+PPU_LETTERS = 'BCDFGHJKLPRSTVWXYZ'
+
+
+# Función para crear una patente única con formato LLLL-NN a partir de un número
+def make_ppu(i):
+    number, i = i % 100, i // 100
+    letters = ''
+    for _ in range(4):
+        letters = PPU_LETTERS[i % len(PPU_LETTERS)] + letters
+        i //= len(PPU_LETTERS)
+    return f"{letters}{number:02d}"
+
+
+# Función para generar el DataFrame de una flota sintética
+def make_fleet_frame(buses=1000, norms=50, terminals=4, subclasses=4, value_mix=None, seed=0):
+    rng = np.random.default_rng(seed)
+    value_mix = value_mix or DEFAULT_VALUE_MIX
+
+    terminal_values = [TERMINAL_NAMES[i] if i < len(TERMINAL_NAMES) else f"Terminal {i + 1}" for i in range(terminals)]
+    subclass_values = [SUBCLASS_NAMES[i] if i < len(SUBCLASS_NAMES) else f"Subclase {i + 1}" for i in range(subclasses)]
+
+    data = {
+        'N° Interno': np.arange(1000, 1000 + buses),
+        'PPU': [make_ppu(i) for i in range(buses)],
+        'Unidad': rng.integers(1, 9, buses),
+        'Marca chasis': rng.choice(['Volvo', 'Mercedes Benz', 'Scania', 'BYD', 'Foton'], buses),
+        'Modelo chasis': rng.choice(['B8R', 'O500U', 'K310', 'K9', 'U12'], buses),
+        'Subclase': rng.choice(subclass_values, buses),
+        'N° plazas': rng.choice([80, 90, 100, 160], buses),
+        'Terminal': rng.choice(terminal_values, buses),
+        'Taller': rng.choice(['Taller Norte', 'Taller Sur'], buses),
+        'FECHA DE RENOVACION': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 900, buses), unit='D'),
+    }
+
+    # Valores de normas según la mezcla configurada (el ruido se reparte entre NOISE_VALUES)
+    choices = list(value_mix.keys())
+    weights = np.array(list(value_mix.values()), dtype=float)
+    weights = weights / weights.sum()
+    installed = np.zeros(buses, dtype=int)
+    for j in range(norms):
+        values = rng.choice(choices, buses, p=weights).astype(object)
+        noise = values == 'noise'
+        values[noise] = rng.choice(NOISE_VALUES, int(noise.sum()))
+        values[values == ''] = None
+        installed += np.isin(values, ['1', 'instalada'])
+        data[f"Norma {j + 1:03d}"] = values
+
+    df = pd.DataFrame(data)
+    df.insert(df.columns.get_loc('FECHA DE RENOVACION'), 'NORMA INSTALADA', installed)
+    return df
+
+
+# Función para escribir la flota como planilla Excel (con filas previas al encabezado opcionales)
+def write_fleet_workbook(df, target=None, header_offset=0):
+    target = target if target is not None else io.BytesIO()
+    with pd.ExcelWriter(target, engine='xlsxwriter') as writer:
+        df.to_excel(writer, sheet_name='Flota', index=False, startrow=header_offset)
+        if header_offset > 0:
+            writer.sheets['Flota'].write(0, 0, "Control de Instalación de Normas Gráficas")
+    if hasattr(target, 'seek'):
+        target.seek(0)
+    return target
+
+
+# Función para crear directamente los bytes de una planilla sintética
+def make_fleet_workbook(buses=1000, norms=50, terminals=4, subclasses=4, value_mix=None,
+                        header_offset=0, seed=0):
+    df = make_fleet_frame(buses, norms, terminals, subclasses, value_mix, seed)
+    return write_fleet_workbook(df, header_offset=header_offset).getvalue()
+
+
+# Función para interpretar una mezcla de valores del tipo "1=0.6,instalada=0.1,No Aplica=0.1,=0.15,noise=0.05"
+def parse_value_mix(text):
+    mix = {}
+    for item in text.split(','):
+        key, _, weight = item.rpartition('=')
+        mix[key] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera una planilla de flota sintética")
+    parser.add_argument('--buses', type=int, default=1000)
+    parser.add_argument('--norms', type=int, default=50)
+    parser.add_argument('--terminals', type=int, default=4)
+    parser.add_argument('--subclasses', type=int, default=4)
+    parser.add_argument('--value-mix', type=parse_value_mix, default=None,
+                        help="p. ej. '1=0.6,instalada=0.1,No Aplica=0.1,=0.15,noise=0.05'")
+    parser.add_argument('--header-offset', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='flota_sintetica.xlsx')
+    args = parser.parse_args()
+
+    df = make_fleet_frame(args.buses, args.norms, args.terminals, args.subclasses, args.value_mix, args.seed)
+    write_fleet_workbook(df, args.output, args.header_offset)
+    print(f"Planilla generada: {args.output} ({args.buses} buses x {args.norms} normas)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+import logging
+import os
+import sys
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# app.py se importa fuera de "streamlit run": se silencian los avisos del modo sin servidor
+warnings.filterwarnings('ignore')
+logging.getLogger('streamlit').setLevel(logging.ERROR)
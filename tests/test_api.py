@@ -0,0 +1,61 @@
+import http.client
+import json
+
+import pandas as pd
+
+import app
+
+
+def get_json(port, path):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        conn.request('GET', path)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        conn.close()
+
+
+def test_snapshot_errors_answer_500_and_are_retried(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'REPORT_CACHE_DIR', str(tmp_path))
+    df = pd.DataFrame({'N° Interno': ['1', '2'], 'PPU': ['AA0001', 'AA0002'], 'Norma 1': ['Instalada', '']})
+    dataset = {'version': 1, 'name': 'flota.xlsx', 'hash': 'a' * 64, 'loaded_at': pd.Timestamp('2025-01-01'), 'df': df}
+    api = app.start_api_server({'dataset': dataset}, '127.0.0.1', 0)
+    port = api['server'].server_address[1]
+    try:
+        calculate_metrics = app.calculate_metrics
+
+        def failing_metrics(*args, **kwargs):
+            raise ValueError("planilla dañada")
+
+        monkeypatch.setattr(app, 'calculate_metrics', failing_metrics)
+        status, body = get_json(port, '/api/metricas')
+        assert status == 500
+        assert 'planilla dañada' in body['error']
+        assert api['snapshot'] is None
+
+        # El lock queda libre y la siguiente consulta reconstruye la instantánea
+        monkeypatch.setattr(app, 'calculate_metrics', calculate_metrics)
+        status, body = get_json(port, '/api/metricas')
+        assert status == 200
+        assert body['total_buses'] == 2
+    finally:
+        api['server'].shutdown()
+
+
+def test_snapshot_uses_the_dashboard_vocabulary(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'REPORT_CACHE_DIR', str(tmp_path))
+    df = pd.DataFrame({'N° Interno': ['1', '2'], 'PPU': ['AA0001', 'AA0002'], 'Norma 1': ['colocada', '']})
+    dataset = {'version': 1, 'name': 'flota.xlsx', 'hash': 'b' * 64, 'loaded_at': pd.Timestamp('2025-01-01'), 'df': df}
+    api = app.start_api_server({'dataset': dataset}, '127.0.0.1', 0)
+    port = api['server'].server_address[1]
+    try:
+        status, body = get_json(port, '/api/metricas')
+        assert status == 200 and body['buses_completos'] == 0
+
+        # Un cambio de vocabulario en el dashboard reconstruye la instantánea con el nuevo
+        api['vocabulary'] = dict(app.DEFAULT_STATUS_VOCABULARY, instalada={'exactos': ['colocada'], 'contiene': []})
+        status, body = get_json(port, '/api/metricas')
+        assert status == 200 and body['buses_completos'] == 1
+    finally:
+        api['server'].shutdown()
@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+import app
+
+
+def make_context(terminals, subclasses=None, norm_cols=('Norma 1', "Norma O'Higgins \"Sur\"")):
+    n_buses = len(terminals)
+    status = np.zeros((n_buses, len(norm_cols)), dtype=np.int8)
+    status[::2, 0] = app.ESTADO_INSTALADA
+    return app.build_query_context(status, list(norm_cols), {
+        'interno': [str(i) for i in range(n_buses)],
+        'ppu': ['N/A'] * n_buses,
+        'terminal': list(terminals),
+        'subclase': list(subclasses or ['N/A'] * n_buses),
+        'renovacion': np.full(n_buses, np.datetime64('NaT'), dtype='datetime64[ns]')
+    })
+
+
+def test_quote_escapes_both_quote_kinds():
+    value = 'O\'Higgins "Sur"'
+    text = f"terminal = {app.query_quote(value)}"
+    assert app.parse_bus_query(text) == ('en', 'terminal', (value,))
+    context = make_context([value, 'Maipú'])
+    assert app.bus_query_mask(context, text).tolist() == [True, False]
+
+
+def test_unclosed_quote_is_an_error():
+    with pytest.raises(ValueError):
+        app.parse_bus_query("terminal = 'Maipú")
+
+
+def test_values_mask_with_both_quotes():
+    context = make_context(['O\'Higgins "Sur"', 'Maipú'])
+    assert app.bus_values_mask(context, 'terminal', ['O\'Higgins "Sur"']).tolist() == [True, False]
+
+
+def test_values_mask_treats_asterisk_literally():
+    context = make_context(['A*', 'AB', 'AC'])
+    assert app.bus_values_mask(context, 'terminal', ['A*']).tolist() == [True, False, False]
+    # En una consulta escrita, el valor exacto de la planilla gana al comodín
+    assert app.bus_query_mask(context, "terminal = 'A*'").tolist() == [True, False, False]
+    assert app.bus_query_mask(context, "terminal = 'A?*'").tolist() == [False, False, False]
+    assert app.bus_query_mask(context, "terminal = B* or terminal = A*").tolist() == [True, False, False]
+
+
+def test_wildcard_without_exact_value():
+    context = make_context(['La Florida', 'La Reina', 'Maipú'])
+    assert app.bus_query_mask(context, "terminal = 'la *'").tolist() == [True, True, False]
+
+
+def test_accents_and_case_do_not_merge_exact_values():
+    context = make_context(['Maipú', 'MAIPU', 'Lo Espejo'])
+    assert app.bus_values_mask(context, 'terminal', ['MAIPU']).tolist() == [False, True, False]
+    assert app.bus_query_mask(context, "terminal = MAIPU").tolist() == [False, True, False]
+    assert app.bus_query_mask(context, "terminal = 'Maipú'").tolist() == [True, False, False]
+    # Sin valor exacto se compara sin tildes ni mayúsculas
+    assert app.bus_query_mask(context, "terminal = maipu").tolist() == [True, True, False]
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("subclase = Bus no articulado", ('en', 'subclase', ('Bus no articulado',))),
+    ("subclase = Bus en servicio", ('en', 'subclase', ('Bus en servicio',))),
+    ("terminal = Cerrillos y Maipú", ('en', 'terminal', ('Cerrillos y Maipú',))),
+    ("subclase = Bus o Minibus", ('en', 'subclase', ('Bus o Minibus',))),
+    ("subclase in (Bus no articulado, Minibus)", ('en', 'subclase', ('Bus no articulado', 'Minibus'))),
+])
+def test_spanish_keywords_inside_unquoted_values(text, expected):
+    assert app.parse_bus_query(text) == expected
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("terminal = Maipú y completo", ('and', (('en', 'terminal', ('Maipú',)), ('bandera', 'completo')))),
+    ("terminal = Maipú o progreso < 50",
+     ('or', (('en', 'terminal', ('Maipú',)), ('comparar', 'progreso', '<', 50.0)))),
+    ("terminal = Maipú y no completo",
+     ('and', (('en', 'terminal', ('Maipú',)), ('not', ('bandera', 'completo'))))),
+    ("subclase no en (A, B)", ('not', ('en', 'subclase', ('A', 'B')))),
+    ("terminal = Maipú and falta(X)",
+     ('and', (('en', 'terminal', ('Maipú',)), ('estado', app.ESTADO_PENDIENTE, ('X',))))),
+])
+def test_spanish_keywords_still_join_conditions(text, expected):
+    assert app.parse_bus_query(text) == expected
+
+
+def test_keyword_value_matches_buses():
+    context = make_context(['A', 'A', 'B'], ['Bus no articulado', 'Bus articulado', 'Bus no articulado'])
+    assert app.bus_query_mask(context, "subclase = Bus no articulado").tolist() == [True, False, True]
+
+
+def test_error_messages_use_original_text():
+    with pytest.raises(ValueError, match="desde 'no'"):
+        app.parse_bus_query("completo no")
+
+
+def test_whitespace_inside_quoted_literal_is_kept():
+    context = make_context(['La  Florida', 'La Florida'])
+    assert app.bus_query_mask(context, "terminal = 'La  Florida'").tolist() == [True, False]
+    assert app.bus_query_mask(context, "  terminal   =   'La Florida'  ").tolist() == [False, True]
+    assert app.combine_bus_queries(["terminal = 'La  Florida'", "completo"]) == "(terminal = 'La  Florida') and (completo)"
+
+
+def test_norm_names_with_quotes():
+    context = make_context(['A', 'B', 'C'])
+    norm = "Norma O'Higgins \"Sur\""
+    assert app.norm_status_mask(context, [norm]).tolist() == [True, True, True]
+    assert app.norm_status_mask(context, ['Norma 1', norm]).tolist() == [False, True, False]
+    assert app.norm_status_mask(context, ['Norma 1', norm], match_all=False).tolist() == [True, True, True]
+    for match_all in (True, False):
+        text = app.query_missing_clause(['Norma 1', norm], match_all)
+        assert (app.bus_query_mask(context, text).tolist()
+                == app.norm_status_mask(context, ['Norma 1', norm], match_all=match_all).tolist())
@@ -0,0 +1,53 @@
+import os
+
+import pandas as pd
+
+import app
+
+
+def fleet_frame(n_buses=5):
+    return pd.DataFrame({
+        'N° Interno': [str(100 + i) for i in range(n_buses)],
+        'PPU': [f"AB{i:04d}" for i in range(n_buses)],
+        'Terminal': ['A', 'B'] * (n_buses // 2) + ['A'] * (n_buses % 2),
+        'Norma 1': ['Instalada', ''] * (n_buses // 2) + ['Instalada'] * (n_buses % 2),
+        'Norma 2': ['No aplica'] * n_buses,
+    })
+
+
+def test_store_is_reused_and_old_files_are_pruned(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'REPORT_CACHE_DIR', str(tmp_path))
+    df = fleet_frame()
+    norm_cols = app.norm_columns(df)
+    # Un archivo de una versión anterior del formato se borra siempre
+    (tmp_path / 'reportes_v1_viejo.sqlite').write_bytes(b'')
+    paths = []
+    for i in range(app.REPORT_STORE_KEEP + 3):
+        store = app.ensure_bus_report_store(f"clave{i}", df, norm_cols)
+        store['conn'].close()
+        paths.append(store['path'])
+        os.utime(store['path'], (i, i))
+    remaining = sorted(name for name in os.listdir(tmp_path) if name.startswith('reportes_v'))
+    assert len(remaining) == app.REPORT_STORE_KEEP
+    assert 'reportes_v1_viejo.sqlite' not in remaining
+    assert os.path.basename(paths[-1]) in remaining
+    assert not os.path.exists(paths[0])
+
+    # Reabrir un almacén existente no lo reescribe y lo marca como usado
+    mtime = os.path.getmtime(paths[-1])
+    store = app.ensure_bus_report_store(f"clave{app.REPORT_STORE_KEEP + 2}", df, norm_cols)
+    assert os.path.getmtime(store['path']) > mtime
+    assert app.lookup_bus_report(store, '100')[2] == 100.0
+    store['conn'].close()
+    # Con la conexión cerrada la ficha se calcula directo
+    assert app.lookup_bus_report(store, '100') is None
+
+
+def test_search_is_limited_to_visible_buses(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'REPORT_CACHE_DIR', str(tmp_path))
+    df = fleet_frame(12)
+    store = app.ensure_bus_report_store('clave', df, app.norm_columns(df))
+    assert app.search_buses(store['search'], '10', limit=3) == ['100', '101', '102']
+    assert app.search_buses(store['search'], '10', limit=3, allowed={'103', '109', '110'}) == ['103', '109']
+    assert app.search_buses(store['search'], 'ab000', allowed={'103'}) == ['103']
+    store['conn'].close()
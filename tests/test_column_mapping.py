@@ -0,0 +1,37 @@
+import pandas as pd
+
+import app
+
+
+def fleet_frame(n_buses=20):
+    return pd.DataFrame({
+        'Bus': [str(1000 + i) for i in range(n_buses)],
+        'Patente': [f"BCDF{i:02d}" for i in range(n_buses)],
+        'Numeración lateral': ['1', '0'] * (n_buses // 2),
+        'Señalética interna': ['instalada', ''] * (n_buses // 2),
+        'Terminación asientos': ['1'] * n_buses,
+        'Clasificación extintor': ['No Aplica'] * n_buses,
+    })
+
+
+def test_prefix_alone_does_not_take_a_norm_column():
+    mapping = app.score_columns(fleet_frame())
+    assert mapping == {'PPU': 'Patente'}
+
+
+def test_prefix_with_identifier_values_is_mapped():
+    df = fleet_frame().rename(columns={'Bus': 'Interno flota'})
+    mapping = app.score_columns(df)
+    assert mapping['N° Interno'] == 'Interno flota'
+    assert 'Numeración lateral' not in mapping.values()
+
+
+def test_norm_columns_keep_prefix_lookalikes(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'COLUMN_PROFILES_PATH', str(tmp_path / 'perfiles.json'))
+    app.get_column_profiles.clear()
+    df = fleet_frame()
+    norm_cols = app.norm_columns(df)
+    assert 'Numeración lateral' in norm_cols
+    assert 'Terminación asientos' in norm_cols
+    assert 'Clasificación extintor' in norm_cols
+    assert app.weak_column_mappings(df) == {}
@@ -0,0 +1,20 @@
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+import app
+
+
+def test_sheets_are_written_in_chunks(monkeypatch):
+    monkeypatch.setattr(app, 'EXCEL_CHUNK_ROWS', 3)
+    df = pd.DataFrame({
+        'Número Interno': [str(100 + i) for i in range(10)],
+        'Progreso': np.linspace(0, 100, 10),
+        'Renovación': pd.to_datetime(['2025-01-01', None] * 5),
+    })
+    buffer = app.write_excel_sheets([{'name': 'Reporte', 'data': df, 'rules': {'Progreso': 'progreso'}}])
+    result = pd.read_excel(BytesIO(buffer.getvalue()), dtype={'Número Interno': str})
+    assert result['Número Interno'].tolist() == df['Número Interno'].tolist()
+    assert np.allclose(result['Progreso'], df['Progreso'])
+    assert result['Renovación'].isna().tolist() == df['Renovación'].isna().tolist()
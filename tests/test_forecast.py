@@ -0,0 +1,101 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import app
+
+
+def series_for(installed, required=100):
+    return {('Flota', 'Flota'): (installed, required), ('Terminal', 'A'): (installed, required)}
+
+
+def fleet_row(store, flota):
+    forecast = app.forecast_completion(store, 'Flota', flota=flota)
+    return forecast.iloc[0] if len(forecast) else None
+
+
+def test_series_are_partitioned_by_fleet(tmp_path):
+    store = app.open_forecast_store(str(tmp_path / 'historial.sqlite'))
+    app.record_snapshot(store, 'a1', 'a1.xlsx', pd.Timestamp('2025-01-01'), series_for(10), 'flota_a')
+    app.record_snapshot(store, 'a2', 'a2.xlsx', pd.Timestamp('2025-01-11'), series_for(30), 'flota_a')
+    # Una planilla de otra flota (o de prueba) no cambia la velocidad de la flota A
+    app.record_snapshot(store, 'b1', 'b1.xlsx', pd.Timestamp('2025-01-11'), series_for(90), 'flota_b')
+    row = fleet_row(store, 'flota_a')
+    assert row['Cortes'] == 2
+    assert np.isclose(row['Velocidad (normas/día)'], 2.0)
+    assert fleet_row(store, 'flota_b')['Cortes'] == 1
+    assert len(app.list_snapshots(store, 'flota_a')) == 2
+    history, _ = app.forecast_curve(store, row, flota='flota_a')
+    assert history['Instaladas'].tolist() == [10, 30]
+
+
+def test_delete_snapshot_restores_series(tmp_path):
+    store = app.open_forecast_store(str(tmp_path / 'historial.sqlite'))
+    app.record_snapshot(store, 'a1', 'a1.xlsx', pd.Timestamp('2025-01-01'), series_for(10), 'f')
+    app.record_snapshot(store, 'a2', 'a2.xlsx', pd.Timestamp('2025-01-11'), series_for(30), 'f')
+    app.record_snapshot(store, 'a3', 'a3.xlsx', pd.Timestamp('2025-01-21'), series_for(35), 'f')
+    app.delete_snapshots(store, ['a3'])
+    row = fleet_row(store, 'f')
+    assert row['Cortes'] == 2
+    assert row['Instaladas'] == 30
+    assert np.isclose(row['Velocidad (normas/día)'], 2.0)
+    assert app.snapshot_recorded_date(store, 'a3') is None
+    app.delete_snapshots(store, ['a1', 'a2'])
+    assert fleet_row(store, 'f') is None
+    assert app.list_snapshots(store).empty
+
+
+def test_fleet_key_ignores_norm_columns():
+    base = ['N° Interno', 'PPU', 'Terminal']
+    assert (app.snapshot_fleet_key(base + ['Norma 1'], ['Norma 1'])
+            == app.snapshot_fleet_key(base + ['Norma 1', 'Norma 2'], ['Norma 1', 'Norma 2']))
+    assert app.snapshot_fleet_key(base + ['Norma 1'], ['Norma 1']) != app.snapshot_fleet_key(['Patente', 'Norma 1'], ['Norma 1'])
+
+
+def test_history_without_fleets_is_migrated(tmp_path):
+    path = str(tmp_path / 'historial.sqlite')
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE cortes (hash TEXT PRIMARY KEY, nombre TEXT, t REAL, registrado TEXT);
+        CREATE TABLE puntos (hash TEXT, tipo TEXT, serie TEXT, t REAL, y REAL, requeridas REAL,
+                             PRIMARY KEY (hash, tipo, serie));
+        CREATE TABLE series (tipo TEXT, serie TEXT, n REAL, st REAL, sy REAL, stt REAL, sty REAL,
+                             syy REAL, ultimo_t REAL, ultimo_y REAL, requeridas REAL, PRIMARY KEY (tipo, serie));
+    """)
+    for k, (t, y) in enumerate([(1000.0, 10.0), (1010.0, 30.0)]):
+        conn.execute("INSERT INTO cortes VALUES (?, ?, ?, ?)", (f"h{k}", f"p{k}.xlsx", t, ''))
+        conn.execute("INSERT INTO puntos VALUES (?, 'Flota', 'Flota', ?, ?, 100)", (f"h{k}", t, y))
+    conn.commit()
+    conn.close()
+
+    store = app.open_forecast_store(path)
+    row = fleet_row(store, '')
+    assert row['Cortes'] == 2 and row['Instaladas'] == 30
+    assert np.isclose(row['Velocidad (normas/día)'], 2.0)
+    # Al volver a registrar la misma planilla con la misma fecha pasa a la serie de su flota
+    app.record_snapshot(store, 'h1', 'p1.xlsx', app.forecast_date(1010.0), {('Flota', 'Flota'): (30, 100)}, 'f')
+    assert fleet_row(store, '')['Cortes'] == 1
+    assert fleet_row(store, 'f')['Cortes'] == 1
+
+
+def test_band_uses_student_t_quantile():
+    assert np.allclose(app.forecast_t_quantile([1, 2, 30]), [12.706, 4.303, 2.042])
+    assert np.isclose(app.forecast_t_quantile(120), 1.9805, atol=1e-3)
+    assert np.isnan(app.forecast_t_quantile(0))
+
+
+def test_band_with_three_snapshots_is_wide(tmp_path):
+    store = app.open_forecast_store(str(tmp_path / 'historial.sqlite'))
+    for i, installed in enumerate([10, 32, 50]):
+        app.record_snapshot(store, f"a{i}", f"a{i}.xlsx", pd.Timestamp('2025-01-01') + pd.Timedelta(days=10 * i),
+                            series_for(installed), 'f')
+    row = fleet_row(store, 'f')
+    # Con 1 grado de libertad el extremo rápido usa t = 12,706 (no 1,96): la velocidad máxima
+    # se aleja de la estimada 12,706 errores estándar
+    slope, fast = row['Velocidad (normas/día)'], row['Velocidad Máxima']
+    assert np.isclose(slope, 2.0)
+    t = np.arange(3) * 10.0
+    residuals = np.array([10, 32, 50]) - (slope * t + (np.mean([10, 32, 50]) - slope * 10))
+    se = np.sqrt((residuals ** 2).sum() / 1 / ((t - t.mean()) ** 2).sum())
+    assert np.isclose(fast - slope, 12.706 * se, rtol=1e-2)
@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+
+import app
+
+
+def test_large_tables_keep_colours_as_markers():
+    df = pd.DataFrame({'Estado': ['Completo', 'Pendiente', 'Pendiente'], 'Progreso': [100.0, 75.0, 10.0]})
+    marked = app.mark_styled_columns(df, {'Estado': app.bus_status_style, 'Progreso': app.progress_style})
+    assert list(marked.columns) == ['Estado', 'Semáforo', 'Progreso']
+    assert marked['Estado'].tolist() == ['🟢 Completo', '🔴 Pendiente', '🔴 Pendiente']
+    assert marked['Semáforo'].tolist() == ['🟢', '🟡', '🔴']
+    # El progreso sigue siendo numérico (barra de progreso) y el original no cambia
+    assert marked['Progreso'].dtype == np.float64
+    assert df['Estado'].tolist()[0] == 'Completo'
+
+
+def test_cell_styles_follow_progress_thresholds():
+    values = pd.Series([90.0, 89.9, 70.0, 69.9, 90.0])
+    assert app.column_cell_styles(values, app.progress_style).tolist() == [
+        app.STYLE_VERDE, app.STYLE_AMARILLO, app.STYLE_AMARILLO, app.STYLE_ROJO, app.STYLE_VERDE
+    ]
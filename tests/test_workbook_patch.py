@@ -0,0 +1,154 @@
+import re
+import zipfile
+from io import BytesIO
+from xml.etree import ElementTree
+
+import openpyxl
+import pandas as pd
+import pytest
+from openpyxl.styles import PatternFill
+
+import app
+
+NS = {'m': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+
+
+def workbook_bytes(rows, setup=None):
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    for row in rows:
+        ws.append(row)
+    if setup is not None:
+        setup(ws)
+    buffer = BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def sheet_xml(content):
+    with zipfile.ZipFile(BytesIO(content)) as archive:
+        return archive.read(app.first_sheet_path(archive))
+
+
+def with_sheet_xml(content, xml):
+    buffer = BytesIO()
+    with zipfile.ZipFile(BytesIO(content)) as archive, zipfile.ZipFile(buffer, 'w') as output:
+        sheet_path = app.first_sheet_path(archive)
+        for info in archive.infolist():
+            output.writestr(info, xml if info.filename == sheet_path else archive.read(info.filename))
+    return buffer.getvalue()
+
+
+def sheet_rows(xml):
+    root = ElementTree.fromstring(xml)
+    return {int(row.get('r')): row for row in root.find('m:sheetData', NS)}
+
+
+def cell_refs(row):
+    return [cell.get('r') for cell in row]
+
+
+def test_header_in_second_row_with_blank_intermediate_rows():
+    content = workbook_bytes([
+        ['Control de normas', None, None, None],
+        ['N° Interno', 'PPU', 'Norma 1', 'Norma 2'],
+        [101, 'AA0001', 'Instalada', None],
+        [None, None, None, None],
+        [102, 'AA0002', None, 'Instalada'],
+    ])
+    df = pd.read_excel(BytesIO(content), header=1)
+    assert df.loc[2, 'N° Interno'] == 102
+    cambios = {(0, 'Norma 2'): (app.ESTADO_INSTALADA, 'Instalada'), (2, 'Norma 1'): (app.ESTADO_NO_APLICA, 'No aplica'),
+               (2, 'Norma 2'): (app.ESTADO_PENDIENTE, None)}
+    patched, written = app.patch_workbook_cells(content, list(df.columns), cambios)
+    assert written == 3
+    result = pd.read_excel(BytesIO(patched), header=1)
+    assert result.loc[0, 'Norma 2'] == 'Instalada'
+    assert result.loc[2, 'Norma 1'] == 'No aplica'
+    assert pd.isna(result.loc[2, 'Norma 2'])
+    # El resto de la hoja queda igual
+    assert result.drop(columns=['Norma 1', 'Norma 2']).equals(df.drop(columns=['Norma 1', 'Norma 2']))
+    assert result.loc[0, 'Norma 1'] == 'Instalada'
+
+
+def test_duplicate_headers_map_to_their_own_column():
+    content = workbook_bytes([
+        ['N° Interno', 'PPU', 'Norma', 'Norma', 'Norma'],
+        [101, 'AA0001', 'a', 'b', 'c'],
+    ])
+    df = pd.read_excel(BytesIO(content))
+    assert list(df.columns)[2:] == ['Norma', 'Norma.1', 'Norma.2']
+    cambios = {(0, 'Norma'): (app.ESTADO_INSTALADA, 'x'), (0, 'Norma.2'): (app.ESTADO_INSTALADA, 'z')}
+    patched, written = app.patch_workbook_cells(content, list(df.columns), cambios)
+    assert written == 2
+    ws = openpyxl.load_workbook(BytesIO(patched)).active
+    assert [ws.cell(2, col).value for col in (3, 4, 5)] == ['x', 'b', 'z']
+
+
+def test_self_closing_rows_and_cells_keep_style_and_order():
+    fill = PatternFill('solid', fgColor='FFFF00')
+
+    def setup(ws):
+        # Celda vacía con formato (<c .../>) y fila vacía con alto propio
+        ws['D2'].fill = fill
+        ws.row_dimensions[3].height = 30
+
+    content = workbook_bytes([
+        ['N° Interno', 'PPU', 'Norma 1', 'Norma 2', 'Norma 3'],
+        [101, 'AA0001', 'Instalada'],
+        [],
+        [102, 'AA0002', None, None, 'Instalada'],
+    ], setup)
+    # Excel escribe las filas vacías como <row .../>; openpyxl las deja con etiqueta de cierre
+    xml = re.sub(rb'(<row r="3"[^>]*?)\s*></row>', rb'\1/>', sheet_xml(content))
+    assert re.search(rb'<c r="D2" s="\d+"[^>]*/>', xml)
+    assert re.search(rb'<row r="3"[^>]*/>', xml)
+    content = with_sheet_xml(content, xml)
+
+    df = pd.read_excel(BytesIO(content))
+    cambios = {(0, 'Norma 2'): (app.ESTADO_INSTALADA, 'Instalada'), (1, 'Norma 1'): (app.ESTADO_NO_APLICA, 'No aplica'),
+               (2, 'Norma 2'): (app.ESTADO_INSTALADA, 'Instalada')}
+    patched, _ = app.patch_workbook_cells(content, list(df.columns), cambios)
+    rows = sheet_rows(sheet_xml(patched))
+    assert cell_refs(rows[2]) == ['A2', 'B2', 'C2', 'D2']
+    assert cell_refs(rows[3]) == ['C3']
+    assert rows[3].get('ht') == '30'
+    # La celda nueva se inserta en orden entre las existentes
+    assert cell_refs(rows[4]) == ['A4', 'B4', 'D4', 'E4']
+
+    ws = openpyxl.load_workbook(BytesIO(patched)).active
+    assert ws['D2'].value == 'Instalada'
+    assert ws['D2'].fill.fgColor.rgb == fill.fgColor.rgb
+    assert ws['C3'].value == 'No aplica'
+    assert ws['D4'].value == 'Instalada'
+    assert ws['E4'].value == 'Instalada'
+
+
+def test_patch_sheet_xml_inserts_missing_rows_before_the_next_row():
+    xml = (b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+           b'<row r="1"><c r="A1"><v>1</v></c></row><row r="4"><c r="B4" s="2"/></row>'
+           b'</sheetData></worksheet>')
+    patched = app.patch_sheet_xml(xml, {(2, 1): 'x', (4, 1): 7, (4, 2): 'y', (6, 3): None})
+    rows = sheet_rows(patched)
+    assert list(rows) == [1, 2, 4, 6]
+    assert cell_refs(rows[4]) == ['A4', 'B4']
+    assert rows[4][1].get('s') == '2'
+    assert rows[4][0].find('m:v', NS).text == '7'
+    assert rows[6][0].get('r') == 'C6' and len(rows[6][0]) == 0
+
+
+def test_patch_sheet_xml_keeps_namespace_prefix():
+    xml = (b'<x:worksheet xmlns:x="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><x:sheetData>'
+           b'<x:row r="1"><x:c r="A1"><x:v>1</x:v></x:c></x:row><x:row r="4"><x:c r="B4" s="2"/></x:row>'
+           b'</x:sheetData></x:worksheet>')
+    patched = app.patch_sheet_xml(xml, {(2, 1): 'x', (4, 2): 'y', (6, 3): 5})
+    rows = sheet_rows(patched)
+    assert list(rows) == [1, 2, 4, 6]
+    assert rows[2][0].find('m:is/m:t', NS).text == 'x'
+    assert rows[4][0].get('s') == '2' and rows[4][0].find('m:is/m:t', NS).text == 'y'
+    assert rows[6][0].find('m:v', NS).text == '5'
+
+
+def test_patch_sheet_xml_without_sheet_data_is_a_clear_error():
+    with pytest.raises(ValueError, match='no es compatible'):
+        app.patch_sheet_xml(b'<worksheet/>', {(2, 1): 'x'})